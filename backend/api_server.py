@@ -3,16 +3,23 @@ Simple Flask API server for local development.
 This wraps the Lambda handlers to provide HTTP endpoints.
 """
 import datetime
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, Response, request, jsonify, send_file, make_response
 from flask_cors import CORS
 import os
 import sys
+import mimetypes
+from urllib.parse import quote
 
 # Add src to path
 sys.path.insert(0, '/app')
 
 from src.app import handlers
-from src.utils import local_adapter
+from src.utils import local_adapter, common, change_feed, profiling, idempotency
+
+try:
+    from flask_sock import Sock
+except ImportError:  # the WebSocket feed is optional; /images/changes (SSE) works without it
+    Sock = None
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend
@@ -23,21 +30,75 @@ os.environ.setdefault('TABLE_NAME', 'ImageMetadata')
 os.environ.setdefault('AWS_ENDPOINT_URL', 'http://localstack:4566')
 os.environ.setdefault('USE_LOCAL_STORAGE', 'true') # Default to local storage for easier setup
 
+# Process-wide sampling, only with PROFILE_CONTINUOUS_HZ set (per worker: threads do not survive a fork)
+profiling.start_continuous()
+
 def add_cors(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,Idempotency-Key'
     response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE,OPTIONS'
     return response
 
+@app.after_request
+def compress_response(response):
+    # gzip/brotli negotiation for JSON payloads (listings are the big ones).
+    # File downloads are streamed via send_file and left untouched.
+    if (response.direct_passthrough or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = common.negotiate_encoding(request.headers.get('Accept-Encoding'))
+    if response.is_streamed:
+        # get_data() would buffer the whole stream; compress it chunk by chunk instead
+        if encoding:
+            response.response = common.compress_stream(response.response, encoding)
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+    data = response.get_data()
+    if encoding and len(data) >= common.COMPRESSION_MIN_BYTES:
+        response.set_data(common.compress_body(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _json_headers(response):
+    # Retry-After tells clients how long to back off from a 503 (see resilience)
+    # X-Profile names the profile written for a request sent with X-Profile-Token (see profiling)
+    # Idempotent-Replayed marks a response replayed for a retried Idempotency-Key (see idempotency)
+    headers = {'Content-Type': 'application/json'}
+    for name in ('Retry-After', 'X-Profile', idempotency.REPLAYED_HEADER):
+        if name in response.get('headers', {}):
+            headers[name] = response['headers'][name]
+    return headers
+
+def _profile_headers():
+    # Only the profiling trigger: e.g. Accept-Encoding would make handlers compress what compress_response does
+    token = request.headers.get(profiling.TOKEN_HEADER)
+    return {profiling.TOKEN_HEADER: token} if token else {}
+
+def request_to_event(req):
+    """API Gateway style event for a Flask request (query string, headers and body)."""
+    return {
+        'queryStringParameters': req.args.to_dict(),
+        'headers': dict(req.headers),
+        'body': req.get_data(as_text=True),
+    }
+
+def _authorized(method, object_name):
+    # Cheap check (one HMAC) before touching the disk
+    return local_adapter.verify_local_url(method, object_name, request.args.get('expires'), request.args.get('sig'))
+
 @app.route('/local-store/<object_name>', methods=['PUT', 'OPTIONS'])
 def local_upload(object_name):
     if request.method == 'OPTIONS':
         return add_cors(make_response('', 204))
     
-    content = request.get_data()
     # Ensure it's not a directory traversal attempt (simple check)
     if '..' in object_name or '/' in object_name:
         return add_cors(make_response('', 400))
+    if not _authorized('PUT', object_name):
+        return add_cors(make_response('', 403))
+    content = request.get_data()
     local_adapter.save_file_content(object_name, content)
     return add_cors(make_response('', 200))
 
@@ -49,17 +110,33 @@ def local_download(object_name):
     # Ensure it's not a directory traversal attempt
     if '..' in object_name or '/' in object_name:
         return add_cors(make_response('', 400))
+    if not _authorized('GET', object_name):
+        return add_cors(make_response('', 403))
     path = local_adapter.get_file_content(object_name)
-    if path:
-        return add_cors(make_response(send_file(path)))
-    return add_cors(make_response('', 404))
+    if not path:
+        return add_cors(make_response('', 404))
+
+    if local_adapter.SENDFILE_MODE in ('x-accel', 'x-sendfile'):
+        # Python only authorizes; the front server streams the bytes
+        response = make_response('', 200)
+        response.headers['Content-Type'] = mimetypes.guess_type(object_name)[0] or 'application/octet-stream'
+        if local_adapter.SENDFILE_MODE == 'x-accel':
+            relative = os.path.relpath(path, local_adapter.IMAGES_DIR).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = local_adapter.ACCEL_PREFIX + quote(relative)
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        return add_cors(response)
+    return add_cors(make_response(send_file(path)))
 
 @app.route('/images/upload', methods=['POST', 'OPTIONS'])
 def upload_image():
     if request.method == 'OPTIONS':
         return '', 204
     
-    event = {'body': request.get_data(as_text=True)}
+    headers = _profile_headers()
+    if request.headers.get(idempotency.HEADER):
+        headers[idempotency.HEADER] = request.headers[idempotency.HEADER]
+    event = {'body': request.get_data(as_text=True), 'headers': headers}
     response = handlers.generate_upload_url_handler(event, None)
     
     import json
@@ -67,23 +144,87 @@ def upload_image():
     if isinstance(body, str):
         body = json.loads(body)
     
-    return jsonify(body), response.get('statusCode', 200)
+    return jsonify(body), response.get('statusCode', 200), _json_headers(response)
 
 @app.route('/images', methods=['GET', 'OPTIONS'])
 def list_images():
     if request.method == 'OPTIONS':
         return '', 204
     
-    event = {'queryStringParameters': request.args.to_dict()}
+    event = {'queryStringParameters': request.args.to_dict(), 'headers': _profile_headers()}
     response = handlers.list_images_handler(event, None)
-    
-    # Parse JSON body if it's a string
-    import json
-    body = response.get('body', '{}')
-    if isinstance(body, str):
-        body = json.loads(body)
-    
-    return jsonify(body), response.get('statusCode', 200)
+    if 'stream' in response:
+        # ?stream=true: chunked transfer, written page by page as the query runs
+        return Response(response['stream'], response.get('statusCode', 200), headers=response['headers'])
+
+    # The handler already serialized the listing; pass it through instead of
+    # parsing and re-serializing it (compression happens in compress_response)
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         _json_headers(response))
+
+@app.route('/images/export', methods=['GET', 'OPTIONS'])
+def export_images():
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    event = {'queryStringParameters': request.args.to_dict(), 'headers': _profile_headers()}
+    response = handlers.export_images_handler(event, None)
+    if 'stream' in response:
+        # Chunked transfer: the archive is never held in memory
+        return Response(response['stream'], response.get('statusCode', 200), headers=response['headers'])
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         _json_headers(response))
+
+@app.route('/images/changes', methods=['GET', 'OPTIONS'])
+def changes_stream():
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    response = handlers.change_feed_handler(request_to_event(request), None)
+    if 'stream' in response:
+        # Server-sent events: the connection stays open and each delta is flushed as it happens
+        return Response(response['stream'], response.get('statusCode', 200), headers=response['headers'])
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         _json_headers(response))
+
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/images/changes/ws')
+    def change_feed_ws(ws):
+        # Same deltas as /images/changes, one JSON message {"events": [...]} per batch
+        user_id = request.args.get('user_id')
+        if not user_id:
+            ws.close(reason=1008, message='Missing user_id')
+            return
+        try:
+            subscription = change_feed.subscribe(user_id, request.args.get('last_event_id'))
+        except change_feed.TooManySubscribers:
+            ws.close(reason=1013, message='Try again later')
+            return
+        for message in change_feed.iter_json_messages(subscription):
+            ws.send(message)
+
+@app.route('/images/search', methods=['GET', 'OPTIONS'])
+def search_images():
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    event = {'queryStringParameters': request.args.to_dict(), 'headers': _profile_headers()}
+    response = handlers.search_images_handler(event, None)
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         _json_headers(response))
+
+@app.route('/images/<id>/similar', methods=['GET', 'OPTIONS'])
+def similar_images(id):
+    if request.method == 'OPTIONS':
+        return '', 204
+
+    params = request.args.to_dict()
+    params['id'] = id
+    response = handlers.similar_images_handler({'queryStringParameters': params, 'headers': _profile_headers()}, None)
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         _json_headers(response))
 
 @app.route('/images/<id>/download', methods=['GET', 'OPTIONS'])
 def download_image(id):
@@ -91,7 +232,7 @@ def download_image(id):
         return '', 204
     
     # Map path param to query param for handler
-    event = {'queryStringParameters': {'id': id}}
+    event = {'queryStringParameters': {'id': id}, 'headers': _profile_headers()}
     response = handlers.generate_download_url_handler(event, None)
     
     import json
@@ -109,7 +250,7 @@ def delete_image(id):
     # Map path param to query param, preserve other query params like user_id
     params = request.args.to_dict()
     params['id'] = id
-    event = {'queryStringParameters': params}
+    event = {'queryStringParameters': params, 'headers': _profile_headers()}
     
     response = handlers.delete_image_handler(event, None)
     
@@ -140,7 +281,13 @@ def local_usage():
     body = response.get('body', '{}')
     if isinstance(body, str):
         body = json.loads(body)
-    return add_cors(make_response(jsonify(body), response.get('statusCode', 200)))
+    return add_cors(make_response(jsonify(body), response.get('statusCode', 200), _json_headers(response)))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    response = handlers.metrics_handler({}, None)
+    return make_response(response.get('body', '{}'), response.get('statusCode', 200),
+                         {'Content-Type': 'application/json'})
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -1,9 +1,9 @@
 import json
 import logging
 import os
-import uuid
 import datetime
-from src.utils import s3_utils, dynamo_utils, common
+import itertools
+from src.utils import s3_utils, dynamo_utils, common, tiering, search_index, similarity, ids, singleflight, export, resilience, change_feed, profiling, idempotency
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -11,6 +11,23 @@ logger.setLevel(logging.INFO)
 BUCKET_NAME = os.environ.get('BUCKET_NAME')
 TABLE_NAME = os.environ.get('TABLE_NAME')
 
+# Page size for paginated (multi-tag) listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def _unavailable_response(error):
+    """503 + Retry-After for a throttled or unreachable backend (see resilience)."""
+    response = common.create_error_response(503, "Service temporarily unavailable", str(error))
+    response["headers"]["Retry-After"] = str(error.retry_after)
+    return response
+
+def _resign_upload_url(body):
+    # A replayed upload response gets a fresh URL for the same object: the stored one may have expired
+    upload_url = s3_utils.generate_presigned_upload_url(BUCKET_NAME, body['object_name'])
+    return dict(body, upload_url=upload_url) if upload_url else body
+
+@profiling.profiled('POST /images/upload')
+@idempotency.idempotent('POST /images/upload', replay=_resign_upload_url)
 def generate_upload_url_handler(event, context):
     """
     POST /images/upload (formerly /generate-upload-url)
@@ -25,10 +42,11 @@ def generate_upload_url_handler(event, context):
             return common.create_error_response(400, "Missing filename")
         
         # Metadata logic integrated here for Unified Upload
-        # Requirement: "image_id (ISO timestamp based)" so it is sortable for range queries.
-        iso_timestamp = datetime.datetime.utcnow().isoformat() + 'Z'
-        safe_timestamp = iso_timestamp.replace(':', '-')
-        object_name = f"{safe_timestamp}_{uuid.uuid4()}-{filename}"
+        # image_id is time-sortable (img_<ULID>.ext) so date filters are sort-key range queries;
+        # the user's filename is kept in original_filename rather than in every key
+        now = datetime.datetime.utcnow()
+        iso_timestamp = now.isoformat() + 'Z'
+        object_name = ids.new_image_id(filename, now=now.replace(tzinfo=datetime.timezone.utc))
         
         # S3 Presigned URL
         presigned_url = s3_utils.generate_presigned_upload_url(BUCKET_NAME, object_name)
@@ -63,6 +81,8 @@ def generate_upload_url_handler(event, context):
                 # We could return 500, but the URL was generated. 
                 # Ideally, we save metadata first? No, doesn't matter much for presigned.
                 return common.create_error_response(500, "Failed to save metadata")
+            search_index.index_item(item)
+            change_feed.publish_saved(item)
 
         return common.create_response(200, {
             "upload_url": presigned_url,
@@ -72,6 +92,8 @@ def generate_upload_url_handler(event, context):
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
 
+@profiling.profiled('POST /save-metadata')
+@idempotency.idempotent('POST /save-metadata')
 def save_metadata_handler(event, context):
     """
     POST /save-metadata
@@ -109,6 +131,8 @@ def save_metadata_handler(event, context):
         # item.update(body) # Explicit fields preferred for strict compliance
 
         if dynamo_utils.save_metadata(TABLE_NAME, item):
+            search_index.index_item(item)
+            change_feed.publish_saved(item)
             return common.create_response(201, {"status": "success", "data": item})
         else:
             return common.create_error_response(500, "Failed to save metadata")
@@ -117,9 +141,16 @@ def save_metadata_handler(event, context):
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
 
+@profiling.profiled('GET /images')
 def list_images_handler(event, context):
     """
-    GET /images?user_id=&tag=&start_date=&end_date=
+    GET /images?user_id=&tag=&start_date=&end_date=&fields=
+    GET /images?user_id=&tags=a,b&mode=all|any&limit=&cursor=
+    fields: optional comma separated projection, e.g. fields=image_id,tags,upload_time
+    tags: multi-tag query (mode=all: every tag, mode=any: at least one), paginated
+          by image_id; pass next_cursor back as cursor to get the following page
+    stream=true: the (unpaginated) listing is returned as a "stream" of JSON chunks,
+          written as pages arrive from the backend (api_server only, see create_stream_response)
     """
     try:
         query_params = event.get('queryStringParameters', {}) or {}
@@ -127,15 +158,204 @@ def list_images_handler(event, context):
         tag = query_params.get('tag')
         start_date = query_params.get('start_date')
         end_date = query_params.get('end_date')
+        fields = common.parse_csv_param(query_params.get('fields'))
+        tags = common.parse_csv_param(query_params.get('tags'))
+        accept_encoding = common.get_header(event, 'Accept-Encoding')
+
+        try:
+            ids.key_ranges(start_date, end_date)
+        except ValueError:
+            return common.create_error_response(400, "start_date and end_date must be ISO 8601 dates")
+
+        if tags:
+            mode = query_params.get('mode', 'all')
+            if mode not in ('all', 'any'):
+                return common.create_error_response(400, "mode must be 'all' or 'any'")
+            if not user_id:
+                return common.create_error_response(400, "Missing user_id for multi-tag query")
+            try:
+                limit = min(int(query_params.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            except ValueError:
+                return common.create_error_response(400, "limit must be an integer")
+            items, next_cursor = dynamo_utils.query_images_by_tags(
+                TABLE_NAME, user_id, tags, mode, start_date, end_date,
+                limit=max(limit, 1), cursor=query_params.get('cursor'), fields=fields)
+            return common.create_response(200, {"images": items, "next_cursor": next_cursor},
+                                          accept_encoding=accept_encoding)
 
-        items = dynamo_utils.query_images(TABLE_NAME, user_id, tag, start_date, end_date)
+        if query_params.get('stream', '').lower() in ('1', 'true'):
+            pages = dynamo_utils.iter_image_pages(TABLE_NAME, user_id, tag, start_date, end_date, fields=fields)
+            # The first page is fetched here, so a backend outage is still a 503 and not a broken stream
+            first_page = next(pages, [])
+            chunks = common.iter_json_listing('images', itertools.chain([first_page], pages))
+            return common.create_stream_response(200, chunks, 'application/json')
+
+        items = dynamo_utils.query_images(TABLE_NAME, user_id, tag, start_date, end_date, fields=fields)
         
-        return common.create_response(200, {"images": items})
+        # Large galleries compress ~10x; API Gateway needs the base64 body that create_response emits
+        return common.create_response(200, {"images": items}, accept_encoding=accept_encoding)
+
+    except resilience.BackendUnavailable as e:
+        logger.error(e)
+        return _unavailable_response(e)
+    except Exception as e:
+        logger.error(e)
+        return common.create_error_response(500, "Internal Server Error", str(e))
+
+@profiling.profiled('GET /images/search')
+def search_images_handler(event, context):
+    """
+    GET /images/search?user_id=&q=&limit=&fields=
+    Full-text search over description and original filename, best matches first.
+    The last word may be partial ("beac" matches "beach").
+    """
+    try:
+        query_params = event.get('queryStringParameters', {}) or {}
+        user_id = query_params.get('user_id')
+        q = (query_params.get('q') or '').strip()
+        fields = common.parse_csv_param(query_params.get('fields'))
+
+        if not user_id or not q:
+            return common.create_error_response(400, "Missing user_id or q")
+        if not search_index.is_enabled():
+            return common.create_error_response(501, "Search index is not configured")
+        try:
+            limit = min(int(query_params.get('limit', 20)), MAX_PAGE_SIZE)
+        except ValueError:
+            return common.create_error_response(400, "limit must be an integer")
+
+        hits = search_index.search(user_id, q, max(limit, 1))
+        scores = dict(hits)
+        items = dynamo_utils.get_many(TABLE_NAME, user_id, [image_id for image_id, _ in hits],
+                                      fields=fields + ['image_id'] if fields and 'image_id' not in fields else fields)
+        for item in items:
+            item['score'] = round(scores[item['image_id']], 4)
+            if fields and 'image_id' not in fields:
+                del item['image_id']
+        return common.create_response(200, {"images": items, "query": q},
+                                      accept_encoding=common.get_header(event, 'Accept-Encoding'))
+
+    except resilience.BackendUnavailable as e:
+        logger.error(e)
+        return _unavailable_response(e)
+    except Exception as e:
+        logger.error(e)
+        return common.create_error_response(500, "Internal Server Error", str(e))
+
+@profiling.profiled('GET /images/similar')
+def similar_images_handler(event, context):
+    """
+    GET /images/<id>/similar?user_id=&max_distance=&limit=&fields=
+    The user's images whose perceptual hash is within max_distance bits (of 64)
+    of this one, closest first. Hashes the image on demand if it has none yet.
+    """
+    try:
+        query_params = event.get('queryStringParameters', {}) or {}
+        image_id = query_params.get('id')
+        user_id = query_params.get('user_id')
+        fields = common.parse_csv_param(query_params.get('fields'))
+
+        if not image_id or not user_id:
+            return common.create_error_response(400, "Missing id or user_id")
+        try:
+            max_distance = int(query_params.get('max_distance', similarity.DEFAULT_MAX_DISTANCE))
+            limit = min(int(query_params.get('limit', 20)), MAX_PAGE_SIZE)
+        except ValueError:
+            return common.create_error_response(400, "max_distance and limit must be integers")
+
+        matches = similarity.find_similar(TABLE_NAME, BUCKET_NAME, user_id, image_id,
+                                          max(0, min(max_distance, 64)), max(limit, 1))
+        if matches is None:
+            if not dynamo_utils.get_metadata(TABLE_NAME, user_id, image_id):
+                return common.create_error_response(404, "Image not found")
+            if not similarity.is_available():
+                return common.create_error_response(501, "Image hashing is not available (Pillow not installed)")
+            return common.create_error_response(422, "Image could not be hashed")
+
+        distances = dict(matches)
+        items = dynamo_utils.get_many(TABLE_NAME, user_id, [key for key, _ in matches],
+                                      fields=fields + ['image_id'] if fields and 'image_id' not in fields else fields)
+        for item in items:
+            item['distance'] = distances[item['image_id']]
+            if fields and 'image_id' not in fields:
+                del item['image_id']
+        return common.create_response(200, {"images": items, "image_id": image_id},
+                                      accept_encoding=common.get_header(event, 'Accept-Encoding'))
+
+    except resilience.BackendUnavailable as e:
+        logger.error(e)
+        return _unavailable_response(e)
+    except Exception as e:
+        logger.error(e)
+        return common.create_error_response(500, "Internal Server Error", str(e))
 
+@profiling.profiled('GET /images/export')
+def export_images_handler(event, context):
+    """
+    GET /images/export?user_id=&tag=&start_date=&end_date=
+    Streams a ZIP of the matching images. The response carries a "stream"
+    iterator instead of a body, so it is served by api_server (API Gateway
+    buffers Lambda responses and caps them at 6 MB).
+    """
+    try:
+        query_params = event.get('queryStringParameters', {}) or {}
+        user_id = query_params.get('user_id')
+        tag = query_params.get('tag')
+        start_date = query_params.get('start_date')
+        end_date = query_params.get('end_date')
+
+        if not user_id:
+            return common.create_error_response(400, "Missing user_id")
+        try:
+            ids.key_ranges(start_date, end_date)
+        except ValueError:
+            return common.create_error_response(400, "start_date and end_date must be ISO 8601 dates")
+
+        items = dynamo_utils.query_images(TABLE_NAME, user_id, tag, start_date, end_date, fields=export.EXPORT_FIELDS)
+        if not items:
+            return common.create_error_response(404, "No images match")
+
+        filename = f"images-{tag}.zip" if tag else "images.zip"
+        return common.create_stream_response(200, export.iter_zip(BUCKET_NAME, items), 'application/zip', filename)
+
+    except resilience.BackendUnavailable as e:
+        logger.error(e)
+        return _unavailable_response(e)
     except Exception as e:
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
 
+def change_feed_handler(event, context):
+    """
+    GET /images/changes?user_id=   (Last-Event-ID header or last_event_id= to resume)
+    Server-sent events with the user's gallery deltas: add, remove, and reset
+    (re-fetch the listing). See change_feed. Like the export, the response is a
+    "stream" and is served by api_server.
+    """
+    try:
+        query_params = event.get('queryStringParameters', {}) or {}
+        user_id = query_params.get('user_id')
+        if not user_id:
+            return common.create_error_response(400, "Missing user_id")
+
+        last_event_id = common.get_header(event, 'Last-Event-ID') or query_params.get('last_event_id')
+        try:
+            subscription = change_feed.subscribe(user_id, last_event_id)
+        except change_feed.TooManySubscribers as e:
+            response = common.create_error_response(503, "Too many open change feeds", str(e))
+            response["headers"]["Retry-After"] = "5"
+            return response
+
+        response = common.create_stream_response(200, change_feed.iter_sse(subscription), 'text/event-stream')
+        response["headers"]["Cache-Control"] = "no-cache"
+        response["headers"]["X-Accel-Buffering"] = "no"  # nginx: pass each event through unbuffered
+        return response
+
+    except Exception as e:
+        logger.error(e)
+        return common.create_error_response(500, "Internal Server Error", str(e))
+
+@profiling.profiled('GET /images/download')
 def generate_download_url_handler(event, context):
     """
     GET /generate-download-url?id=<image_id>
@@ -147,6 +367,17 @@ def generate_download_url_handler(event, context):
         if not object_name:
             return common.create_error_response(400, "Missing image id")
 
+        # Cold objects are rehydrated (or an archive restore is started) on request,
+        # and the access is recorded for the hot/cold tiering job (src.jobs.tier_objects)
+        state = tiering.ensure_hot(BUCKET_NAME, object_name)
+        tiering.record_access(BUCKET_NAME, object_name)
+        if state == 'restoring':
+            return common.create_response(202, {
+                "status": "restoring",
+                "id": object_name,
+                "message": "Image is archived and being restored, retry later"
+            })
+
         url = s3_utils.generate_presigned_download_url(BUCKET_NAME, object_name)
         
         if url:
@@ -158,6 +389,7 @@ def generate_download_url_handler(event, context):
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
 
+@profiling.profiled('DELETE /images')
 def delete_image_handler(event, context):
     """
     DELETE /delete?id=<image_id>&user_id=<user_id>
@@ -175,6 +407,9 @@ def delete_image_handler(event, context):
         
         # 2. Delete from DynamoDB
         dynamo_deleted = dynamo_utils.delete_metadata_item(TABLE_NAME, user_id, image_id)
+        if dynamo_deleted:
+            search_index.remove_item(user_id, image_id)
+            change_feed.publish_removed(user_id, image_id)
         
         if s3_deleted and dynamo_deleted:
             return common.create_response(200, {"status": "deleted", "id": image_id})
@@ -192,6 +427,7 @@ def delete_image_handler(event, context):
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
 
+@profiling.profiled('GET /usage')
 def get_storage_usage_handler(event, context):
     """
     GET /usage?user_id=<user_id>
@@ -208,7 +444,8 @@ def get_storage_usage_handler(event, context):
         # Note: In a production system with millions of images, this aggregation should be 
         # maintained in a separate 'UserStats' table and updated via DynamoDB Streams.
         # For this scale, a query is acceptable.
-        items = dynamo_utils.query_images(TABLE_NAME, user_id)
+        # Only file_size is needed; concurrent dashboard refreshes share this one query
+        items = dynamo_utils.query_images(TABLE_NAME, user_id, fields=['file_size'])
         
         total_bytes = 0
         file_count = 0
@@ -233,6 +470,20 @@ def get_storage_usage_handler(event, context):
             "file_count": file_count
         })
 
+    except resilience.BackendUnavailable as e:
+        logger.error(e)
+        return _unavailable_response(e)
     except Exception as e:
         logger.error(e)
         return common.create_error_response(500, "Internal Server Error", str(e))
+
+def metrics_handler(event, context):
+    """
+    GET /metrics
+    Per-process counters, e.g. how many identical reads were coalesced, the
+    state of the backend circuit breakers, the change feed subscribers, profiler
+    captures and idempotent replays.
+    """
+    return common.create_response(200, {"singleflight": singleflight.stats(), "resilience": resilience.stats(),
+                                         "change_feed": change_feed.stats(), "profiling": profiling.stats(),
+                                         "idempotency": idempotency.stats()})
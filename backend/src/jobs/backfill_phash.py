@@ -0,0 +1,86 @@
+"""
+Compute perceptual hashes (phash) for images that do not have one yet.
+
+Usage (from backend/):
+    python -m src.jobs.backfill_phash --workers 8
+
+Decoding and hashing is CPU bound, so objects are read and hashed in a process
+pool; the parent writes each phash back with a narrow update. Only items without
+phash are visited, so the job can be re-run (or scheduled) to hash new uploads.
+--workers 0 hashes in-process (e.g. on Lambda, which has no /dev/shm for pools).
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from src.utils import dynamo_utils, s3_utils, similarity
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def _candidates(table_name):
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        for item in dynamo_utils._local_backend().iter_all_metadata():
+            if not item.get('phash'):
+                yield item
+        return
+
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+    kwargs = dict(dynamo_utils._projection_kwargs(['user_id', 'image_id', 's3_key']),
+                  FilterExpression='attribute_not_exists(phash)')
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _hash_object(task):
+    """Runs in a worker process: (bucket, key) -> phash or None."""
+    bucket_name, key = task
+    data = s3_utils.read_object(bucket_name, key)
+    return similarity.dhash(data) if data else None
+
+def backfill(table_name, bucket_name, workers=4, batch_size=256):
+    """Hash every item missing phash. Returns (scanned, hashed, failed)."""
+    if not similarity.is_available():
+        raise RuntimeError("Pillow is required to compute perceptual hashes (pip install Pillow)")
+
+    scanned = hashed = failed = 0
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    mapper = (lambda fn, tasks: pool.map(fn, tasks, chunksize=8)) if pool else map
+    candidates = _candidates(table_name)
+    try:
+        # Bounded batches keep memory flat however many items are missing a hash
+        while True:
+            batch = list(islice(candidates, batch_size))
+            if not batch:
+                break
+            tasks = [(bucket_name, item.get('s3_key') or item['image_id']) for item in batch]
+            for item, phash in zip(batch, mapper(_hash_object, tasks)):
+                scanned += 1
+                if phash and dynamo_utils.update_attributes(table_name, item['user_id'], item['image_id'],
+                                                            {'phash': phash}):
+                    hashed += 1
+                else:
+                    failed += 1
+    finally:
+        if pool:
+            pool.shutdown()
+    return scanned, hashed, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute perceptual hashes for existing images")
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--bucket', default=os.environ.get('BUCKET_NAME'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Hashing processes (0 = in-process)")
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    scanned, hashed, failed = backfill(args.table, args.bucket, args.workers, args.batch_size)
+    print(f"Scanned {scanned} items: hashed {hashed}, failed {failed} (missing or undecodable objects)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Memory per metadata item in the local index: parsed dicts vs compact records.
+
+Usage (from backend/):
+    python -m src.jobs.bench_local_memory --items 200000
+    python -m src.jobs.bench_local_memory --items 1000000 --users 100 --tags 50
+
+Serializes synthetic items shaped like the upload handler's, then parses the
+same JSON both ways (plain json.loads, and with records.object_hook as
+_load_index does) and reports the bytes tracemalloc sees retained per item.
+"""
+import argparse
+import datetime
+import gc
+import json
+import random
+import tracemalloc
+
+from src.utils import ids, records
+
+CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'image/heic')
+
+def synthetic_items(count, users=100, tags=50, seed=1):
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+    for n in range(count):
+        filename = f'IMG_{n:07d}.jpg'
+        image_id = ids.new_image_id(filename)
+        item_tags = [f'tag{rng.randrange(tags)}' for _ in range(rng.randint(1, 3))]
+        yield {
+            'user_id': f'user_{rng.randrange(users)}',
+            'image_id': image_id,
+            'tag': item_tags[0],
+            'tags': item_tags,
+            'description': '',
+            'content_type': rng.choice(CONTENT_TYPES),
+            'file_size': rng.randint(50_000, 5_000_000),
+            's3_key': image_id,
+            'upload_time': (start + datetime.timedelta(seconds=n, microseconds=rng.randrange(10**6))).isoformat() + 'Z',
+            'original_filename': filename,
+        }
+
+def _retained(text, object_hook=None):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        parsed = json.loads(text, object_hook=object_hook)
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del parsed
+    return size
+
+def run(items, users=100, tags=50):
+    text = json.dumps(list(synthetic_items(items, users, tags)))
+    dict_bytes = _retained(text)
+    record_bytes = _retained(text, records.object_hook)
+    return {
+        'items': items,
+        'dict_bytes_per_item': round(dict_bytes / items),
+        'record_bytes_per_item': round(record_bytes / items),
+        'saving': f"{1 - record_bytes / dict_bytes:.0%}",
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark memory per item of the local metadata index")
+    parser.add_argument('--items', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=50, help="Distinct tags across the data set")
+    args = parser.parse_args(argv)
+
+    result = run(args.items, args.users, args.tags)
+    print(f"items={result['items']} dict={result['dict_bytes_per_item']} B/item "
+          f"record={result['record_bytes_per_item']} B/item saving={result['saving']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Create/lookup latency of the local image store for flat vs fan-out layouts.
+
+Usage (from backend/):
+    python -m src.jobs.bench_local_store --files 1000000 --levels 0,2
+    python -m src.jobs.bench_local_store --files 10000000 --levels 0,2,3 --dir /mnt/data/bench
+
+Fills a scratch directory with empty files named like real image ids, timing a
+sample of creates, then times exists() for present and missing names. Results
+depend heavily on the filesystem and on how much of the dentry cache is warm;
+run with the production filesystem (and ideally after dropping caches) to decide.
+"""
+import argparse
+import os
+import random
+import shutil
+import time
+
+from src.utils import ids, local_adapter
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6
+    return {'p50_us': round(pick(0.50), 1), 'p99_us': round(pick(0.99), 1), 'max_us': round(samples[-1] * 1e6, 1)}
+
+def run(root, files, levels, samples=10000, seed=1):
+    rng = random.Random(seed)
+    names = [ids.new_image_id('photo.jpg') for _ in range(files)]
+    every = max(1, files // samples)
+    create_times = []
+
+    start = time.perf_counter()
+    made_dirs = set()
+    for n, name in enumerate(names):
+        path = local_adapter.object_path(name, root, levels)
+        parent = os.path.dirname(path)
+        t0 = time.perf_counter()
+        if parent not in made_dirs:
+            os.makedirs(parent, exist_ok=True)
+            made_dirs.add(parent)
+        with open(path, 'wb'):
+            pass
+        if n % every == 0:
+            create_times.append(time.perf_counter() - t0)
+    create_total = time.perf_counter() - start
+
+    hit_times, miss_times = [], []
+    for name in rng.sample(names, min(samples, files)):
+        t0 = time.perf_counter()
+        os.path.exists(local_adapter.object_path(name, root, levels))
+        hit_times.append(time.perf_counter() - t0)
+        missing = ids.new_image_id('missing.jpg')
+        t0 = time.perf_counter()
+        os.path.exists(local_adapter.object_path(missing, root, levels))
+        miss_times.append(time.perf_counter() - t0)
+
+    return {
+        'levels': levels,
+        'files': files,
+        'creates_per_s': round(files / create_total),
+        'create': _percentiles(create_times),
+        'lookup_hit': _percentiles(hit_times),
+        'lookup_miss': _percentiles(miss_times),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark flat vs fan-out local storage layouts")
+    parser.add_argument('--files', type=int, default=1000000)
+    parser.add_argument('--levels', default='0,2', help="Comma separated layouts to compare")
+    parser.add_argument('--dir', default=os.path.join(local_adapter.STORAGE_DIR, 'bench'), help="Scratch directory")
+    parser.add_argument('--samples', type=int, default=10000, help="Timed operations per measurement")
+    parser.add_argument('--keep', action='store_true', help="Leave the files behind")
+    args = parser.parse_args(argv)
+
+    for levels in [int(part) for part in args.levels.split(',')]:
+        root = os.path.join(args.dir, f'levels-{levels}')
+        shutil.rmtree(root, ignore_errors=True)
+        try:
+            result = run(root, args.files, levels, args.samples)
+        finally:
+            if not args.keep:
+                shutil.rmtree(root, ignore_errors=True)
+        print(f"levels={levels} files={result['files']} creates/s={result['creates_per_s']} "
+              f"create={result['create']} hit={result['lookup_hit']} miss={result['lookup_miss']}")
+
+if __name__ == '__main__':
+    main()
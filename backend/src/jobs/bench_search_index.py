@@ -0,0 +1,93 @@
+"""
+Query latency of the full-text search index on one large tenant.
+
+Usage (from backend/):
+    python -m src.jobs.bench_search_index --items 1000000
+    python -m src.jobs.bench_search_index --items 200000 --vocabulary 20000 --queries 500
+
+Builds one user's UserIndex in memory from synthetic items: camera-style
+filenames (so "img" and "jpg" are in every item) and descriptions drawn from a
+Zipf-distributed vocabulary (a few words in half the items, most words rare).
+Then times a mix of query kinds, drawn from the same distribution, and reports
+p50/p99/max milliseconds per kind.
+"""
+import argparse
+import itertools
+import random
+import time
+
+from src.utils import search_index
+
+SYLLABLES = ('ba', 'ce', 'di', 'fo', 'gu', 'ka', 'le', 'mi', 'no', 'pu', 'ra', 'se', 'ti', 'vo', 'zu')
+QUERY_KINDS = ('word', 'two_words', 'prefix', 'filename', 'common')
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)  # Zipf rank is unrelated to spelling
+    return words
+
+def build_index(items, words, skew=1.0, seed=1):
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(len(words))))
+    docs = {}
+    for n in range(items):
+        item = {'description': ' '.join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 12))),
+                'original_filename': f'IMG_{n:07d}.jpg'}
+        docs[f'img_{n:08d}'] = search_index.item_terms(item)
+    index = search_index.UserIndex()
+    index.load(docs)
+    return index, cum_weights
+
+def queries(kind, count, items, words, cum_weights, rng):
+    draw = lambda k=1: rng.choices(words, cum_weights=cum_weights, k=k)
+    for _ in range(count):
+        if kind == 'word':
+            yield draw()[0]
+        elif kind == 'two_words':
+            yield ' '.join(draw(2))
+        elif kind == 'prefix':
+            first, second = draw(2)
+            yield f'{first} {second[:3]}'
+        elif kind == 'filename':
+            yield f'IMG_{rng.randrange(items):07d}'
+        else:
+            yield 'img jpg'
+
+def run(items, vocabulary_size=50000, skew=1.0, count=200, limit=20, seed=1):
+    rng = random.Random(seed)
+    words = vocabulary(vocabulary_size, rng)
+    started = time.perf_counter()
+    index, cum_weights = build_index(items, words, skew, seed)
+    result = {'items': items, 'terms': len(index.postings), 'build_s': round(time.perf_counter() - started, 1)}
+    for kind in QUERY_KINDS:
+        timings = []
+        for query in queries(kind, count, items, words, cum_weights, rng):
+            started = time.perf_counter()
+            index.search(query, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        result[kind] = {'p50_ms': round(timings[len(timings) // 2], 2),
+                        'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 2),
+                        'max_ms': round(timings[-1], 2)}
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark full-text search latency on one large tenant")
+    parser.add_argument('--items', type=int, default=1000000)
+    parser.add_argument('--vocabulary', type=int, default=50000, help="Distinct description words")
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of description words")
+    parser.add_argument('--queries', type=int, default=200, help="Queries per kind")
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    result = run(args.items, args.vocabulary, args.skew, args.queries, args.limit)
+    print(f"items={result['items']} terms={result['terms']} build={result['build_s']}s")
+    for kind in QUERY_KINDS:
+        s = result[kind]
+        print(f"{kind:<10} p50={s['p50_ms']}ms p99={s['p99_ms']}ms max={s['max_ms']}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+Bulk import of an existing photo archive (replaces looping over /images/upload).
+
+Usage (from backend/):
+    python -m src.jobs.bulk_import --user-id user_123 --dir ~/Pictures/2019 [--tag vacation | --tag-from-dir]
+    python -m src.jobs.bulk_import --user-id user_123 --manifest photos.jsonl --checkpoint photos.ckpt
+
+Files are uploaded by a bounded thread pool. Each one is read once: it is
+hashed (sha256, stored on the item) while it streams to storage, and anything
+over --multipart-mb goes to S3 as a multipart upload with parts in parallel.
+Metadata is written in batches of --batch-size: BatchWriteItem in AWS mode, and
+one shard rewrite per batch locally (use LOCAL_DB_ENGINE=sqlite for archives of
+100k+ files; a JSON shard is rewritten whole on every batch).
+
+--checkpoint is an append-only log of uploaded files and committed batches.
+Re-running with the same checkpoint skips finished files and commits the
+metadata of files that were uploaded but not yet saved, so an interrupted
+import neither duplicates items nor uploads anything twice.
+
+A manifest is JSON Lines, one {"path": "...", "tags": [...], "description": "..."}
+per file; relative paths are resolved against the manifest's directory.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from boto3.s3.transfer import TransferConfig
+
+from src.utils import change_feed, dynamo_utils, ids, s3_utils, search_index
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.tif', '.tiff', '.bmp')
+MiB = 1024 * 1024
+MULTIPART_CHUNK_MB = 16
+# Parallel parts per multipart upload (on top of --workers files in flight)
+MULTIPART_CONCURRENCY = 4
+
+class _HashingReader:
+    """read()-only view of a file that hashes and counts what passes through."""
+
+    def __init__(self, f):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.files} files ({self.bytes / MiB:.1f} MiB) in {elapsed:.1f}s: "
+                f"{self.files / elapsed:.1f} files/s, {self.bytes / MiB / elapsed:.1f} MiB/s; "
+                f"{self.skipped} skipped, {self.failed} failed")
+
+class Checkpoint:
+    """
+    JSON Lines log: {"path", "item"} once a file is uploaded, {"done": [paths]} once its
+    metadata batch is committed. Commits are fsynced; a torn last line is ignored.
+    """
+
+    def __init__(self, path=None):
+        self.done = set()
+        self.uploaded = {}
+        self._f = None
+        if not path:
+            return
+        torn = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'done' in record:
+                        for done in record['done']:
+                            self.done.add(done)
+                            self.uploaded.pop(done, None)
+                    else:
+                        self.uploaded[record['path']] = record['item']
+        self._f = open(path, 'a')
+        if torn:
+            # Terminate the torn line so the next record starts on a line of its own
+            self._f.write('\n')
+
+    def seen(self, path):
+        return path in self.done or path in self.uploaded
+
+    def record_upload(self, path, item):
+        if self._f:
+            self._f.write(json.dumps({'path': path, 'item': item}) + '\n')
+            self._f.flush()
+
+    def record_commit(self, paths):
+        if self._f:
+            self._f.write(json.dumps({'done': paths}) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+    def close(self):
+        if self._f:
+            self._f.close()
+
+def walk_directory(root, tag=None, tag_from_dir=False, extensions=IMAGE_EXTENSIONS):
+    """An entry for every image under root, in a stable order so runs can be compared and resumed."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.error(f"Cannot list {directory}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                tags = [tag] if tag else []
+                if tag_from_dir and directory != root:
+                    tags.append(os.path.basename(directory))
+                yield {'path': entry.path, 'tags': tags}
+        stack.extend(reversed(subdirs))
+
+def read_manifest(manifest_path):
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                entry['path'] = os.path.join(base, entry['path'])
+                yield entry
+
+def _upload(entry, user_id, bucket_name, s3_client, transfer_config):
+    """Runs in a worker thread: stream one file to storage. Returns its metadata item, or None."""
+    path = entry['path']
+    filename = os.path.basename(path)
+    image_id = ids.new_image_id(filename)
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    try:
+        with open(path, 'rb') as f:
+            reader = _HashingReader(f)
+            if not s3_utils.upload_stream(bucket_name, image_id, reader, content_type, s3_client, transfer_config):
+                return None
+    except OSError as e:
+        logger.error(f"Failed to read {path}: {e}")
+        return None
+
+    tags = list(entry.get('tags') or [])
+    if entry.get('tag') and entry['tag'] not in tags:
+        tags.append(entry['tag'])
+    # Same shape as items created by POST /images/upload, plus the content hash
+    return {
+        'user_id': user_id,
+        'image_id': image_id,
+        'tag': tags[0] if tags else 'uncategorized',
+        'tags': tags,
+        'description': entry.get('description', ''),
+        'content_type': content_type,
+        'file_size': reader.size,
+        's3_key': image_id,
+        'upload_time': datetime.datetime.utcnow().isoformat() + 'Z',
+        'original_filename': filename,
+        'sha256': reader.sha256.hexdigest(),
+    }
+
+def run(entries, user_id, table_name=None, bucket_name=None, workers=16, batch_size=500,
+        checkpoint_path=None, multipart_mb=64, report_every=10.0):
+    """Import every entry ({"path", "tags", "tag", "description"}). Returns ImportStats."""
+    stats = ImportStats()
+    checkpoint = Checkpoint(checkpoint_path)
+    s3_client = transfer_config = None
+    if not os.environ.get('USE_LOCAL_STORAGE'):
+        # One client for all threads, with a connection for every part that can be in flight
+        s3_client = s3_utils.get_s3_client(max_pool_connections=workers * MULTIPART_CONCURRENCY)
+        transfer_config = TransferConfig(multipart_threshold=multipart_mb * MiB,
+                                         multipart_chunksize=MULTIPART_CHUNK_MB * MiB,
+                                         max_concurrency=MULTIPART_CONCURRENCY)
+
+    # Uploaded by an earlier run whose metadata batch never committed
+    batch = list(checkpoint.uploaded.items())
+    in_flight = {}
+    last_report = [time.monotonic()]
+
+    def flush():
+        if not batch:
+            return
+        items = [item for _, item in batch]
+        if not dynamo_utils.save_many(table_name, items):
+            raise RuntimeError("Failed to save a metadata batch; re-run with the same --checkpoint to resume")
+        for item in items:
+            search_index.index_item(item)
+        # One "re-fetch" for open galleries per batch, not a delta per file
+        change_feed.publish_reset(user_id)
+        checkpoint.record_commit([path for path, _ in batch])
+        batch.clear()
+
+    def collect(futures):
+        for future in futures:
+            entry = in_flight.pop(future)
+            item = future.result()
+            if item is None:
+                stats.failed += 1
+                continue
+            checkpoint.record_upload(entry['path'], item)
+            batch.append((entry['path'], item))
+            stats.files += 1
+            stats.bytes += item['file_size']
+            if len(batch) >= batch_size:
+                flush()
+        if time.monotonic() - last_report[0] >= report_every:
+            last_report[0] = time.monotonic()
+            logger.info(stats.summary())
+
+    def settle():
+        # Log uploads that are already in storage, so a resume commits them instead of uploading again
+        for future, entry in list(in_flight.items()):
+            if future.cancel():
+                continue
+            try:
+                item = future.result()
+            except Exception:
+                continue
+            if item is not None:
+                checkpoint.record_upload(entry['path'], item)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for entry in entries:
+            if checkpoint.seen(entry['path']):
+                stats.skipped += 1
+                continue
+            # Bounded queue: walking a 1M-file tree must not turn into 1M pending futures
+            while len(in_flight) >= workers * 2:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            in_flight[pool.submit(_upload, entry, user_id, bucket_name, s3_client, transfer_config)] = entry
+        collect(list(in_flight))
+        flush()
+    except BaseException:
+        settle()
+        raise
+    finally:
+        pool.shutdown()
+        checkpoint.close()
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import a directory tree or manifest of images")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help="Import every image under this directory")
+    source.add_argument('--manifest', help="JSON Lines file of {path, tags, description}")
+    parser.add_argument('--user-id', required=True)
+    parser.add_argument('--tag', help="Tag every imported image")
+    parser.add_argument('--tag-from-dir', action='store_true', help="Also tag each image with its folder name")
+    parser.add_argument('--checkpoint', help="Progress log; re-run with the same file to resume")
+    parser.add_argument('--workers', type=int, default=16, help="Files uploaded in parallel")
+    parser.add_argument('--batch-size', type=int, default=500, help="Metadata items per batch write")
+    parser.add_argument('--multipart-mb', type=int, default=64, help="S3 multipart threshold")
+    parser.add_argument('--report-every', type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--bucket', default=os.environ.get('BUCKET_NAME'))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    if not os.environ.get('USE_LOCAL_STORAGE') and not (args.table and args.bucket):
+        parser.error("--table/TABLE_NAME and --bucket/BUCKET_NAME are required")
+
+    if args.dir:
+        entries = walk_directory(args.dir, args.tag, args.tag_from_dir)
+    else:
+        entries = ({**entry, 'tag': entry.get('tag') or args.tag} for entry in read_manifest(args.manifest))
+    stats = run(entries, args.user_id, args.table, args.bucket, args.workers, args.batch_size,
+                args.checkpoint, args.multipart_mb, args.report_every)
+    print(f"Imported {stats.summary()}")
+
+if __name__ == '__main__':
+    main()
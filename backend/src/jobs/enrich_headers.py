@@ -0,0 +1,121 @@
+"""
+Fill in width, height, taken_at, camera and the true file_size of uploaded images
+from their headers, without downloading them.
+
+Usage (from backend/):
+    python -m src.jobs.enrich_headers --workers 32
+
+Each object is read with ranged GETs: the first 64 KiB, which holds the headers
+of nearly every JPEG, PNG, WebP and GIF, and a few more KiB only when a header
+lies further in. No object costs more than image_headers.MAX_BYTES. file_size
+comes from the object itself (Content-Range), not from what the client claimed
+at upload. The work is network bound, so objects are read in a thread pool,
+one bounded batch at a time, and each item gets a narrow update.
+
+Every visited item gets enriched_at, parseable or not, and only items without it
+are visited. Re-run (or schedule) the job to enrich new uploads; --force redoes all.
+"""
+import argparse
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from src.utils import dynamo_utils, image_headers, s3_utils
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def _candidates(table_name, force=False):
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        for item in dynamo_utils._local_backend().iter_all_metadata():
+            if force or not item.get('enriched_at'):
+                yield item
+        return
+
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+    kwargs = dynamo_utils._projection_kwargs(['user_id', 'image_id', 's3_key'])
+    if not force:
+        kwargs['FilterExpression'] = 'attribute_not_exists(enriched_at)'
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def read_headers(bucket_name, key, s3_client=None):
+    """
+    (attributes, bytes read) for one object; attributes is None if it is missing.
+    Unrecognised or unparseable images still yield file_size.
+    """
+    missing = []
+
+    def fetch(offset, length):
+        result = s3_utils.read_range(bucket_name, key, offset, length, s3_client=s3_client)
+        if result is None:
+            missing.append(key)
+            return b'', 0
+        return result
+
+    reader = image_headers.RangeReader(fetch)
+    try:
+        info = image_headers.parse(reader)
+    except image_headers.ReadBudgetExceeded:
+        info = None
+    except Exception as e:  # a malformed header must not stop the batch
+        logger.warning(f"Could not parse headers of {key}: {e}")
+        info = None
+    if missing:
+        return None, reader.fetched
+    attributes = {'file_size': reader.size}
+    if info:
+        attributes.update((k, v) for k, v in info.items() if k != 'format')
+    return attributes, reader.fetched
+
+def enrich(table_name, bucket_name, workers=16, batch_size=256, force=False):
+    """Enrich every item missing enriched_at. Returns (scanned, enriched, failed, bytes_read)."""
+    scanned = enriched = failed = bytes_read = 0
+    s3_client = None
+    if not os.environ.get('USE_LOCAL_STORAGE'):
+        # One client shared by the pool, with a connection per worker
+        s3_client = s3_utils.get_s3_client(max_pool_connections=max(workers, 10))
+    candidates = _candidates(table_name, force)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        # Bounded batches keep memory flat however many items are waiting
+        while True:
+            batch = list(islice(candidates, batch_size))
+            if not batch:
+                break
+            keys = [item.get('s3_key') or item['image_id'] for item in batch]
+            results = pool.map(lambda key: read_headers(bucket_name, key, s3_client), keys)
+            for item, (attributes, fetched) in zip(batch, results):
+                scanned += 1
+                bytes_read += fetched
+                if attributes is None:
+                    failed += 1
+                    continue
+                attributes['enriched_at'] = datetime.datetime.utcnow().isoformat() + 'Z'
+                if dynamo_utils.update_attributes(table_name, item['user_id'], item['image_id'], attributes):
+                    enriched += 1
+                else:
+                    failed += 1
+    return scanned, enriched, failed, bytes_read
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read image dimensions and EXIF from object headers")
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--bucket', default=os.environ.get('BUCKET_NAME'))
+    parser.add_argument('--workers', type=int, default=16, help="Concurrent ranged reads")
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--force', action='store_true', help="Re-read items that were already enriched")
+    args = parser.parse_args(argv)
+
+    scanned, enriched, failed, bytes_read = enrich(args.table, args.bucket, args.workers, args.batch_size, args.force)
+    average = bytes_read // scanned if scanned else 0
+    print(f"Scanned {scanned} items: enriched {enriched}, failed {failed} (missing objects or deleted items); "
+          f"read {bytes_read} bytes ({average} per object)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+"""
+Open-loop load generator (and access-log replayer) for a running api_server.
+
+Usage (from backend/):
+    python -m src.jobs.loadgen --base-url http://localhost:8000 --rate 500 --duration 60
+    python -m src.jobs.loadgen --rate 2000 --users 10000 --user-skew 1.1 --mix list=60,upload=10,download=20,usage=8,delete=2
+    python -m src.jobs.loadgen --replay access.log --speed 4 --json report.json
+
+Synthetic mode draws arrivals from a Poisson process at --rate requests/s and
+starts each one on schedule whether or not earlier ones have finished (open
+loop: a slow server builds up in-flight requests, it does not slow the
+generator down). Latency is measured from the scheduled arrival, so client-side
+delays count against the server instead of hiding it (coordinated omission).
+Beyond --max-in-flight, arrivals are dropped and reported rather than queued.
+
+Each arrival is one operation for a user drawn from a Zipf distribution
+(--user-skew; 0 is uniform), with tags drawn the same way:
+- upload:   POST /images/upload, then PUT the returned URL (/local-store)
+- list:     GET /images?user_id= (half of them with &tag=, some with a date range)
+- download: GET /images/<id>/download, then GET the returned URL
+- delete:   DELETE /images/<id>?user_id=
+- usage:    GET /usage?user_id=
+download and delete pick among images this run uploaded for that user, and
+become an upload when there are none yet. Each HTTP step is reported separately.
+
+Replay mode reads Common/Combined Log Format lines (nginx, gunicorn) or the
+Flask dev server's log, and re-issues each GET at its original offset divided by
+--speed. --replay-writes also re-issues DELETEs. Uploads and signed /local-store
+URLs cannot be replayed (no bodies, expired signatures), so they are skipped.
+
+Requests use a small asyncio HTTP/1.1 client with keep-alive connections
+(stdlib only). Thousands of in-flight requests need as many sockets, so raise
+`ulimit -n` first, and run the server with enough workers/threads to match.
+The Flask dev server closes every connection; gunicorn (gthread) keeps them open.
+"""
+import argparse
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import os
+import random
+import re
+import ssl
+import time
+from collections import Counter, defaultdict
+from urllib.parse import urlencode, urlsplit
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+OPERATIONS = ('upload', 'list', 'download', 'delete', 'usage')
+DEFAULT_MIX = 'list=50,upload=15,download=20,usage=10,delete=5'
+KNOWN_IMAGES_PER_USER = 100
+
+# --- Workload ---
+
+class Zipf:
+    """Ranks 0..n-1 with P(k) proportional to 1 / (k + 1) ** s."""
+
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for k in range(n):
+            total += 1.0 / (k + 1) ** s
+            self.cumulative.append(total)
+
+    def sample(self):
+        return bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+def parse_mix(spec):
+    """'list=50,upload=10' -> (operations, cumulative weights)."""
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"unknown operation {name!r} (expected one of {', '.join(OPERATIONS)})")
+        weights[name] = float(weight or 1)
+    names = [name for name in weights if weights[name] > 0]
+    if not names:
+        raise ValueError("the mix has no operation with a positive weight")
+    cumulative, total = [], 0.0
+    for name in names:
+        total += weights[name]
+        cumulative.append(total)
+    return names, cumulative
+
+def synthetic_schedule(rate, duration, rng):
+    """Poisson arrival offsets (seconds) for `duration` seconds at `rate` per second."""
+    offset = 0.0
+    while True:
+        offset += rng.expovariate(rate)
+        if offset >= duration:
+            return
+        yield offset
+
+# --- Access log replay ---
+
+_LOG_LINE = re.compile(r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<target>\S+) HTTP/[\d.]+"')
+_LOG_TIME_FORMATS = ('%d/%b/%Y:%H:%M:%S %z', '%d/%b/%Y %H:%M:%S')  # CLF (nginx, gunicorn); werkzeug
+
+def parse_log_line(line):
+    """(datetime, method, target) for an access log line, or None."""
+    match = _LOG_LINE.search(line)
+    if not match:
+        return None
+    for fmt in _LOG_TIME_FORMATS:
+        try:
+            when = datetime.datetime.strptime(match.group('time'), fmt)
+        except ValueError:
+            continue
+        return when.replace(tzinfo=None) - (when.utcoffset() or datetime.timedelta()), \
+            match.group('method'), match.group('target')
+    return None
+
+def replay_schedule(lines, speed=1.0, writes=False, skipped=None):
+    """(offset, method, target) per replayable log line, read lazily; skipped lines are counted by reason."""
+    skipped = Counter() if skipped is None else skipped
+    methods = ('GET', 'HEAD', 'DELETE') if writes else ('GET', 'HEAD')
+    first = None
+    for line in lines:
+        parsed = parse_log_line(line)
+        if parsed is None:
+            skipped['unparsed'] += 1
+            continue
+        when, method, target = parsed
+        if method == 'OPTIONS':
+            continue  # CORS preflight, not a request of its own
+        if method not in methods:
+            skipped[method] += 1
+            continue
+        if target.startswith('/local-store/'):
+            skipped['signed_url'] += 1
+            continue
+        first = when if first is None else first
+        yield max((when - first).total_seconds(), 0.0) / speed, method, target
+
+def route_label(method, path):
+    """'GET /images/img_01J.../download' -> 'GET /images/{id}/download', so a report has one row per route."""
+    parts = [part for part in path.split('/') if part]
+    if len(parts) >= 2 and parts[0] == 'images' and parts[1] not in ('search', 'export', 'changes', 'upload'):
+        parts[1] = '{id}'
+    return f"{method} /{'/'.join(parts)}"
+
+# --- HTTP ---
+
+class HttpError(Exception):
+    pass
+
+class HttpClient:
+    """Minimal HTTP/1.1 client: keep-alive connections reused per origin, one request per connection at a time."""
+
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+        self._idle = defaultdict(list)  # (scheme, host, port) -> [(reader, writer)]
+        self.connections_opened = 0
+
+    async def _connect(self, origin):
+        scheme, host, port = origin
+        self.connections_opened += 1
+        return await asyncio.open_connection(host, port, ssl=ssl.create_default_context() if scheme == 'https' else None)
+
+    async def request(self, method, url, body=b'', headers=None):
+        """(status, body bytes)."""
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        head = [f'{method} {target} HTTP/1.1', f'Host: {parts.netloc}', f'Content-Length: {len(body)}']
+        head.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+        return await asyncio.wait_for(self._send(origin, message, method), self.timeout)
+
+    async def _send(self, origin, message, method):
+        idle = self._idle[origin]
+        while True:
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await self._connect(origin)
+            try:
+                writer.write(message)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("connection closed before the response")
+                status, headers = await self._read_head(status_line, reader)
+                body = await self._read_body(reader, headers, method, status)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # the server closed an idle keep-alive connection: retry on a fresh one
+                raise
+            except BaseException:
+                writer.close()  # e.g. cancelled by the timeout mid-response: the connection is unusable
+                raise
+            if headers.get('connection', '').lower() == 'close' or status_line.startswith(b'HTTP/1.0'):
+                writer.close()
+            else:
+                idle.append((reader, writer))
+            return status, body
+
+    @staticmethod
+    async def _read_head(status_line, reader):
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise HttpError(f"bad status line {status_line[:80]!r}")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return status, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    @staticmethod
+    async def _read_body(reader, headers, method, status):
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return b''
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    return b''.join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length']))
+        headers['connection'] = 'close'  # delimited by EOF
+        return await reader.read()
+
+    def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+# --- Measurement ---
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # step -> seconds
+        self.errors = Counter()             # step -> failed requests
+        self.statuses = Counter()           # "step status" -> count
+        self.dropped = 0
+        self.skipped = Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def record(self, step, seconds, status=None, error=None):
+        self.latencies[step].append(seconds)
+        if error is not None or status is None or status >= 400:
+            self.errors[step] += 1
+        self.statuses[f'{step} {status if status is not None else type(error).__name__}'] += 1
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+def summarize(stats, elapsed):
+    steps = {}
+    for step in sorted(stats.latencies):
+        samples = sorted(stats.latencies[step])
+        steps[step] = {
+            'requests': len(samples),
+            'errors': stats.errors[step],
+            'error_rate': round(stats.errors[step] / len(samples), 4),
+            'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+            **{f'p{label}_ms': round(percentile(samples, q) * 1000, 2)
+               for label, q in (('50', 0.50), ('90', 0.90), ('99', 0.99), ('999', 0.999))},
+            'max_ms': round(samples[-1] * 1000, 2),
+        }
+    total = sum(s['requests'] for s in steps.values())
+    errors = sum(s['errors'] for s in steps.values())
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'requests': total,
+        'errors': errors,
+        'error_rate': round(errors / total, 4) if total else 0.0,
+        'rps': round(total / elapsed, 1) if elapsed else 0.0,
+        'dropped': stats.dropped,
+        'peak_in_flight': stats.peak_in_flight,
+        'skipped': dict(stats.skipped),
+        'statuses': dict(sorted(stats.statuses.items())),
+        'steps': steps,
+    }
+
+def format_report(report):
+    width = max([14] + [len(step) + 2 for step in report['steps']])
+    lines = [f"{'step':<{width}}{'requests':>10}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p90 ms':>10}"
+             f"{'p99 ms':>10}{'p99.9 ms':>10}{'max ms':>10}"]
+    for step, s in report['steps'].items():
+        lines.append(f"{step:<{width}}{s['requests']:>10}{s['errors']:>8}{s['rps']:>9}{s['p50_ms']:>10}{s['p90_ms']:>10}"
+                     f"{s['p99_ms']:>10}{s['p999_ms']:>10}{s['max_ms']:>10}")
+    lines.append(f"{report['requests']} requests in {report['elapsed_s']}s ({report['rps']}/s), "
+                 f"{report['errors']} errors ({report['error_rate']:.2%}), {report['dropped']} arrivals dropped "
+                 f"at the in-flight limit, peak {report['peak_in_flight']} in flight")
+    if report['skipped']:
+        lines.append(f"Skipped log lines: {report['skipped']}")
+    return '\n'.join(lines)
+
+# --- Driver ---
+
+class LoadGenerator:
+    def __init__(self, base_url, users=1000, user_skew=1.0, tags=50, tag_skew=1.0, mix=DEFAULT_MIX,
+                 payload_bytes=64 * 1024, max_in_flight=2000, timeout=30.0, seed=None, rewrite_local_urls=True):
+        self.base_url = base_url.rstrip('/')
+        self.rng = random.Random(seed)
+        self.users = Zipf(users, user_skew, self.rng)
+        self.tags = Zipf(tags, tag_skew, self.rng)
+        self.mix = parse_mix(mix)
+        self.payload = os.urandom(payload_bytes)
+        self.max_in_flight = max_in_flight
+        self.rewrite_local_urls = rewrite_local_urls
+        self.client = HttpClient(timeout)
+        self.stats = Stats()
+        self.known_images = defaultdict(list)  # user_id -> image ids uploaded by this run
+        self.downloading = Counter()            # image id -> downloads in flight
+
+    def _signed_url(self, url):
+        # Local signed URLs carry the server's idea of its host (API_BASE_URL); the
+        # signature covers only method, object and expiry, so send them where the rest goes
+        parts = urlsplit(url)
+        if self.rewrite_local_urls and parts.path.startswith('/local-store/'):
+            return f"{self.base_url}{parts.path}?{parts.query}"
+        return url
+
+    async def _step(self, step, method, url, started, body=b'', headers=None):
+        """One HTTP request, recorded from `started`; returns (status, body) or (None, None) on failure."""
+        try:
+            status, data = await self.client.request(method, url, body, headers)
+        except Exception as e:
+            self.stats.record(step, time.perf_counter() - started, error=e)
+            return None, None
+        self.stats.record(step, time.perf_counter() - started, status)
+        return status, data
+
+    async def _json_step(self, step, method, url, started, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        headers = {'Content-Type': 'application/json'} if payload is not None else None
+        status, data = await self._step(step, method, url, started, body, headers)
+        if status != 200:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+    async def upload(self, user_id, started):
+        tag = f'tag_{self.tags.sample()}'
+        response = await self._json_step('upload_url', 'POST', f'{self.base_url}/images/upload', started, {
+            'filename': 'load.jpg', 'content_type': 'image/jpeg', 'user_id': user_id,
+            'tags': [tag], 'file_size': len(self.payload)})
+        if not response or 'upload_url' not in response:
+            return
+        status, _ = await self._step('put', 'PUT', self._signed_url(response['upload_url']), time.perf_counter(),
+                                     self.payload, {'Content-Type': 'image/jpeg'})
+        if status == 200:
+            known = self.known_images[user_id]
+            known.append(response['object_name'])
+            if len(known) > KNOWN_IMAGES_PER_USER:
+                del known[0]
+
+    async def list_images(self, user_id, started):
+        params = {'user_id': user_id}
+        if self.rng.random() < 0.5:
+            params['tag'] = f'tag_{self.tags.sample()}'
+        if self.rng.random() < 0.2:
+            params['start_date'] = (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+        await self._step('list', 'GET', f'{self.base_url}/images?{urlencode(params)}', started,
+                         headers={'Accept-Encoding': 'gzip'})
+
+    async def download(self, user_id, image_id, started):
+        self.downloading[image_id] += 1
+        try:
+            response = await self._json_step('download_url', 'GET', f'{self.base_url}/images/{image_id}/download',
+                                             started)
+            if response and 'download_url' in response:
+                await self._step('get', 'GET', self._signed_url(response['download_url']), time.perf_counter())
+        finally:
+            self.downloading[image_id] -= 1
+            if not self.downloading[image_id]:
+                del self.downloading[image_id]
+
+    async def delete(self, user_id, image_id, started):
+        await self._step('delete', 'DELETE', f'{self.base_url}/images/{image_id}?{urlencode({"user_id": user_id})}',
+                         started)
+
+    async def usage(self, user_id, started):
+        await self._step('usage', 'GET', f'{self.base_url}/usage?{urlencode({"user_id": user_id})}', started)
+
+    async def operation(self, name, started):
+        user_id = f'load_user_{self.users.sample()}'
+        known = self.known_images[user_id]
+        if name in ('download', 'delete') and not known:
+            name = 'upload'
+        if name == 'upload':
+            await self.upload(user_id, started)
+        elif name == 'list':
+            await self.list_images(user_id, started)
+        elif name == 'download':
+            await self.download(user_id, self.rng.choice(known), started)
+        elif name == 'delete':
+            # Not an image a download in flight still fetches: its 404 would be our own race, not a server error
+            idle = [n for n, image_id in enumerate(known) if image_id not in self.downloading]
+            if idle:
+                await self.delete(user_id, known.pop(self.rng.choice(idle)), started)
+            else:
+                await self.upload(user_id, started)
+        else:
+            await self.usage(user_id, started)
+
+    async def replayed(self, method, target, started):
+        await self._step(route_label(method, urlsplit(target).path), method, f'{self.base_url}{target}', started)
+
+    async def _run(self, arrivals, start_op):
+        """Start start_op(*args, started) at each (offset, *args) arrival, open loop."""
+        loop_start = time.perf_counter()
+        tasks = set()
+        last_progress = loop_start
+        stats = self.stats
+
+        async def tracked(args, scheduled):
+            stats.in_flight += 1
+            stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+            try:
+                await start_op(*args, scheduled)
+            finally:
+                stats.in_flight -= 1
+
+        for offset, *args in arrivals:
+            scheduled = loop_start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if stats.in_flight >= self.max_in_flight:
+                stats.dropped += 1
+                continue
+            task = asyncio.ensure_future(tracked(args, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            now = time.perf_counter()
+            if now - last_progress >= 5:
+                last_progress = now
+                done = sum(len(samples) for samples in stats.latencies.values())
+                logger.info(f"{now - loop_start:.0f}s: {done} requests, {sum(stats.errors.values())} errors, "
+                            f"{stats.in_flight} in flight, {stats.dropped} dropped")
+        if tasks:
+            await asyncio.gather(*tasks)
+        self.client.close()
+        return summarize(stats, time.perf_counter() - loop_start)
+
+    async def run_synthetic(self, rate, duration):
+        names, cumulative = self.mix
+
+        def arrivals():
+            for offset in synthetic_schedule(rate, duration, self.rng):
+                yield offset, names[bisect.bisect_left(cumulative, self.rng.random() * cumulative[-1])]
+
+        return await self._run(arrivals(), self.operation)
+
+    async def run_replay(self, lines, speed=1.0, writes=False):
+        return await self._run(replay_schedule(lines, speed, writes, self.stats.skipped), self.replayed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Open-loop load generator and access-log replayer for api_server")
+    parser.add_argument('--base-url', default=os.environ.get('API_BASE_URL', 'http://localhost:8000'))
+    parser.add_argument('--rate', type=float, default=100, help="Arrivals per second (synthetic mode)")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of arrivals (synthetic mode)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Operation weights, default {DEFAULT_MIX}")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--user-skew', type=float, default=1.0, help="Zipf exponent over users (0 = uniform)")
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--tag-skew', type=float, default=1.0, help="Zipf exponent over tags (0 = uniform)")
+    parser.add_argument('--payload-kb', type=int, default=64, help="Size of each uploaded object")
+    parser.add_argument('--max-in-flight', type=int, default=2000, help="Concurrent requests; arrivals beyond are dropped")
+    parser.add_argument('--timeout', type=float, default=30, help="Per-request timeout in seconds")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--keep-url-host', action='store_true',
+                        help="Use signed /local-store URLs as returned instead of sending them to --base-url")
+    parser.add_argument('--replay', metavar='LOG', help="Replay an access log instead of generating load")
+    parser.add_argument('--speed', type=float, default=1.0, help="Replay speed-up factor")
+    parser.add_argument('--replay-writes', action='store_true', help="Also replay DELETE requests")
+    parser.add_argument('--json', metavar='FILE', help="Also write the report as JSON")
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(message)s')
+
+    generator = LoadGenerator(args.base_url, args.users, args.user_skew, args.tags, args.tag_skew, args.mix,
+                              args.payload_kb * 1024, args.max_in_flight, args.timeout, args.seed,
+                              rewrite_local_urls=not args.keep_url_host)
+    if args.replay:
+        with open(args.replay, errors='replace') as f:
+            report = asyncio.run(generator.run_replay(f, args.speed, args.replay_writes))
+    else:
+        report = asyncio.run(generator.run_synthetic(args.rate, args.duration))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(format_report(report))
+
+if __name__ == '__main__':
+    main()
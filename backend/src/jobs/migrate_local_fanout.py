@@ -0,0 +1,84 @@
+"""
+Move local objects (hot and archived) into a LOCAL_FANOUT_LEVELS directory layout.
+
+Usage (from backend/):
+    LOCAL_FANOUT_LEVELS=2 python api_server.py        # 1. serve with the new layout
+    python -m src.jobs.migrate_local_fanout --levels 2 # 2. move existing files
+
+Safe while the server runs: lookups fall back to the other layouts, each file is
+moved with a single link+unlink (never overwriting a newer copy that was
+re-uploaded into the new layout), and readers re-check the new location after a
+miss. Re-running is a no-op once everything is in place; --levels 0 goes back to
+the flat layout.
+"""
+import argparse
+import os
+
+from src.utils import local_adapter
+
+def _move(source, target):
+    """Move without clobbering: False if target already exists."""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        return False
+    except OSError:
+        # No hard links on this filesystem; rename is still atomic, just not no-clobber
+        if os.path.exists(target):
+            return False
+        os.rename(source, target)
+        return True
+    os.remove(source)
+    return True
+
+def _remove_empty_dirs(root):
+    for directory, _, _ in os.walk(root, topdown=False):
+        if directory != root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # not empty
+
+def migrate(levels, dry_run=False):
+    """Returns (moved, already_in_place, duplicates_removed)."""
+    if not 0 <= levels <= local_adapter.MAX_FANOUT_LEVELS:
+        raise ValueError(f"levels must be between 0 and {local_adapter.MAX_FANOUT_LEVELS}")
+    moved = in_place = duplicates = 0
+    for root, suffix in ((local_adapter.IMAGES_DIR, ''), (local_adapter.ARCHIVE_DIR, '.gz')):
+        for entry in local_adapter.iter_object_files(root):
+            if suffix and not entry.name.endswith(suffix):
+                continue
+            name = entry.name[:-len(suffix)] if suffix else entry.name
+            target = local_adapter.object_path(name, root, levels) + suffix
+            if entry.path == target:
+                in_place += 1
+                continue
+            if dry_run:
+                moved += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if _move(entry.path, target):
+                moved += 1
+            else:
+                # Uploaded again into the new layout while this old copy waited; the new one wins
+                os.remove(entry.path)
+                duplicates += 1
+        if not dry_run:
+            _remove_empty_dirs(root)
+    return moved, in_place, duplicates
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move local objects into a fan-out directory layout")
+    parser.add_argument('--levels', type=int, required=True, help="Directory levels (0 = flat, max 3)")
+    parser.add_argument('--dry-run', action='store_true', help="Only count the files that would move")
+    args = parser.parse_args(argv)
+
+    if args.levels != local_adapter.FANOUT_LEVELS:
+        print(f"Note: this process has LOCAL_FANOUT_LEVELS={local_adapter.FANOUT_LEVELS}; "
+              f"run the server with LOCAL_FANOUT_LEVELS={args.levels} so new uploads use the same layout.")
+    moved, in_place, duplicates = migrate(args.levels, args.dry_run)
+    verb = "Would move" if args.dry_run else "Moved"
+    print(f"{verb} {moved} files; {in_place} already in place; {duplicates} stale duplicates removed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Migrate local metadata from the single metadata.json file into sharded files.
+
+Usage (from backend/):
+    python -m src.jobs.migrate_local_shards --shards 16
+
+Afterwards start the server with LOCAL_DB_SHARDS=16. The legacy file is kept as
+metadata.json.migrated so the migration can be rolled back by renaming it.
+Running it again merges into existing shards (upsert), so it is safe to retry.
+"""
+import argparse
+import logging
+import os
+
+from src.utils import local_adapter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def migrate(num_shards, source=None, shards_dir=None, keep_source=True):
+    """Copy every item of the legacy file into its shard. Returns the number of items migrated."""
+    source = source or local_adapter.DB_FILE
+    shards_dir = shards_dir or local_adapter.SHARDS_DIR
+    items = local_adapter._load_db(source)
+
+    # Group by destination shard first, so each shard file is written exactly once
+    buckets = {}
+    for item in items:
+        shard_id = local_adapter.shard_for_user(item['user_id'], num_shards)
+        buckets.setdefault(shard_id, []).append(item)
+
+    for shard_id, shard_items in buckets.items():
+        path = local_adapter.shard_path(shard_id, num_shards, shards_dir)
+        merged = {(i['user_id'], i['image_id']): i for i in local_adapter._load_db(path)}
+        for item in shard_items:
+            merged[(item['user_id'], item['image_id'])] = item
+        local_adapter._save_db(list(merged.values()), path)
+        logger.info(f"shard {shard_id}: {len(shard_items)} items -> {path}")
+
+    if os.path.exists(source):
+        if keep_source:
+            os.replace(source, source + '.migrated')
+        else:
+            os.remove(source)
+    return len(items)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shard local metadata.json by user_id")
+    parser.add_argument('--shards', type=int, required=True, help="Number of shard files (LOCAL_DB_SHARDS)")
+    parser.add_argument('--source', help="Legacy metadata file (default: local_storage/metadata.json)")
+    parser.add_argument('--shards-dir', help="Destination directory (default: local_storage/metadata)")
+    parser.add_argument('--delete-source', action='store_true', help="Remove the legacy file instead of renaming it")
+    args = parser.parse_args(argv)
+
+    if args.shards <= 0:
+        parser.error("--shards must be positive")
+
+    logging.basicConfig(format='%(message)s')
+    count = migrate(args.shards, args.source, args.shards_dir, keep_source=not args.delete_source)
+    print(f"Migrated {count} items into {args.shards} shards. Set LOCAL_DB_SHARDS={args.shards}.")
+
+if __name__ == '__main__':
+    main()
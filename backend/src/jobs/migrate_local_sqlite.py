@@ -0,0 +1,36 @@
+"""
+Copy local JSON metadata (single file or shards) into the SQLite engine.
+
+Usage (from backend/):
+    python -m src.jobs.migrate_local_sqlite
+
+Reads with the current LOCAL_DB_SHARDS layout, then start the server with
+LOCAL_DB_ENGINE=sqlite. The JSON files are left untouched; re-running upserts.
+"""
+import argparse
+
+from src.utils import local_adapter, local_sqlite
+
+def migrate(batch_size=5000):
+    """Upsert every JSON item into SQLite in batches. Returns the number of items copied."""
+    total = 0
+    batch = []
+    for item in local_adapter.iter_all_metadata():
+        batch.append(item)
+        if len(batch) >= batch_size:
+            total += local_sqlite.save_many(batch)
+            batch = []
+    if batch:
+        total += local_sqlite.save_many(batch)
+    return total
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy local JSON metadata into SQLite")
+    parser.add_argument('--batch-size', type=int, default=5000, help="Items per transaction")
+    args = parser.parse_args(argv)
+
+    count = migrate(args.batch_size)
+    print(f"Copied {count} items into {local_sqlite.DB_FILE}. Set LOCAL_DB_ENGINE=sqlite.")
+
+if __name__ == '__main__':
+    main()
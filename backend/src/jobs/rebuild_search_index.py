@@ -0,0 +1,57 @@
+"""
+Rebuild the full-text search index (src/utils/search_index.py) from metadata.
+
+Usage (from backend/):
+    python -m src.jobs.rebuild_search_index                 # every user
+    python -m src.jobs.rebuild_search_index --user alice    # one user
+
+Run it after enabling SEARCH_INDEX_DIR on an existing deployment, or whenever an
+index write failed (the API logs "Failed to index ..."). Each user's snapshot is
+replaced atomically; searches keep working while it runs.
+"""
+import argparse
+import os
+from collections import defaultdict
+
+from src.utils import dynamo_utils, search_index
+
+FIELDS = ['user_id', 'image_id'] + list(search_index.INDEXED_FIELDS)
+
+def _scan_dynamodb(table_name):
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+    kwargs = dynamo_utils._projection_kwargs(FIELDS)
+    while True:
+        response = table.scan(**kwargs)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _iter_all(table_name):
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return dynamo_utils._local_backend().iter_all_metadata()
+    return _scan_dynamodb(table_name)
+
+def rebuild(table_name, user_id=None):
+    """Rebuild one user's index, or every user's. Returns {user_id: documents indexed}."""
+    if user_id:
+        items = dynamo_utils.query_images(table_name, user_id, fields=FIELDS)
+        return {user_id: search_index.rebuild(user_id, items)}
+
+    # Only the indexed text is kept per user, so memory tracks the size of the index itself
+    by_user = defaultdict(list)
+    for item in _iter_all(table_name):
+        by_user[item['user_id']].append({k: item.get(k) for k in FIELDS})
+    return {uid: search_index.rebuild(uid, items) for uid, items in by_user.items()}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the full-text search index")
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'), help="Metadata table (AWS mode)")
+    parser.add_argument('--user', help="Only rebuild this user's index")
+    args = parser.parse_args(argv)
+
+    counts = rebuild(args.table, args.user)
+    print(f"Indexed {sum(counts.values())} items for {len(counts)} users into {search_index.SEARCH_INDEX_DIR}")
+
+if __name__ == '__main__':
+    main()
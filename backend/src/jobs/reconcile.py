@@ -0,0 +1,347 @@
+"""
+Reconcile object storage with metadata.
+
+Finds orphaned objects (no metadata item references them, e.g. a failed metadata
+save) and dangling metadata (the object is gone, e.g. a 207 partial delete). Both
+sides are streamed in key order and merge-joined, so memory stays bounded no
+matter how many keys there are:
+- S3 list_objects_v2 pages are already sorted by key
+- the DynamoDB scan (optionally parallel segments), the local metadata engine and
+  local directory listings are unsorted, so they go through an external merge sort
+  (sorted runs of --run-size records spilled to temp files, then heap-merged)
+
+Runs as a dry run by default. --apply deletes in batches (1000 keys per S3
+DeleteObjects call, 25 per DynamoDB batch write). Anything newer than --grace-hours
+is left alone, because uploads and metadata saves are not atomic.
+
+Usage (from backend/):
+    python -m src.jobs.reconcile --grace-hours 24 [--apply] [--only objects|metadata]
+"""
+import argparse
+import datetime
+import heapq
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from botocore.exceptions import ClientError
+
+from src.utils import s3_utils, dynamo_utils, local_adapter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+RUN_SIZE = 200000
+DELETE_BATCH = 1000
+
+def external_sort(records, key, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Yield records (JSON-serializable) sorted by key(record), holding at most
+    run_size records in memory. Input that fits in one run never touches disk.
+    """
+    runs = []
+    buffer = []
+    try:
+        for record in records:
+            buffer.append(record)
+            if len(buffer) >= run_size:
+                runs.append(_spill(sorted(buffer, key=key), tmp_dir))
+                buffer = []
+        buffer.sort(key=key)
+        if not runs:
+            yield from buffer
+            return
+        if buffer:
+            runs.append(_spill(buffer, tmp_dir))
+            buffer = []
+        readers = [_read_run(path) for path in runs]
+        yield from heapq.merge(*readers, key=key)
+    finally:
+        for path in runs:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def _spill(sorted_records, tmp_dir):
+    fd, path = tempfile.mkstemp(prefix='reconcile-run-', suffix='.jsonl', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for record in sorted_records:
+            f.write(json.dumps(record, separators=(',', ':')))
+            f.write('\n')
+    return path
+
+def _read_run(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+def _parse_time(value):
+    """Epoch seconds from an ISO timestamp such as upload_time ('2025-01-01T12:00:00.123Z')."""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+# --- Object streams: (key, size, modified_epoch), sorted by key ---
+
+def iter_s3_objects(bucket_name):
+    paginator = s3_utils.get_s3_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, PaginationConfig={'PageSize': 1000}):
+        for obj in page.get('Contents', []):
+            yield [obj['Key'], obj['Size'], obj['LastModified'].timestamp()]
+
+def _scan_local_objects():
+    for directory, suffix in ((local_adapter.IMAGES_DIR, ''), (local_adapter.ARCHIVE_DIR, '.gz')):
+        # Walks the fan-out subdirectories too (LOCAL_FANOUT_LEVELS)
+        for entry in local_adapter.iter_object_files(directory):
+            if not entry.name.endswith(suffix):
+                continue
+            st = entry.stat()
+            name = entry.name[:-len(suffix)] if suffix else entry.name
+            yield [name, st.st_size, st.st_mtime]
+
+def iter_local_objects(run_size=RUN_SIZE):
+    return external_sort(_scan_local_objects(), key=lambda r: r[0], run_size=run_size)
+
+# --- Metadata streams: (s3_key, user_id, image_id, created_epoch), sorted by s3_key ---
+
+def _metadata_record(item):
+    created = _parse_time(item.get('upload_time') or item.get('created_at'))
+    return [item.get('s3_key') or item['image_id'], item['user_id'], item['image_id'], created]
+
+def _scan_dynamodb(table_name, segments):
+    """Parallel Scan; segment threads feed a bounded queue so memory stays flat."""
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+    pages = queue.Queue(maxsize=segments * 2)
+    done = object()
+
+    def scan_segment(segment):
+        kwargs = {'ProjectionExpression': '#u, #i, #k, #t, #c',
+                  'ExpressionAttributeNames': {'#u': 'user_id', '#i': 'image_id', '#k': 's3_key',
+                                               '#t': 'upload_time', '#c': 'created_at'}}
+        if segments > 1:
+            kwargs.update(Segment=segment, TotalSegments=segments)
+        try:
+            while True:
+                response = table.scan(**kwargs)
+                pages.put(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except BaseException as e:  # throttling, timeouts, an open breaker: any gap is fatal
+            pages.put(e)
+        finally:
+            pages.put(done)
+
+    for segment in range(segments):
+        threading.Thread(target=scan_segment, args=(segment,), daemon=True).start()
+    finished = 0
+    while finished < segments:
+        page = pages.get()
+        if page is done:
+            finished += 1
+        elif isinstance(page, BaseException):
+            # A partial scan would make every unseen object look orphaned
+            raise page
+        else:
+            for item in page:
+                yield _metadata_record(item)
+
+def iter_dynamodb_metadata(table_name, segments=4, run_size=RUN_SIZE):
+    return external_sort(_scan_dynamodb(table_name, segments), key=lambda r: r[0], run_size=run_size)
+
+def iter_local_metadata(run_size=RUN_SIZE):
+    records = (_metadata_record(item) for item in dynamo_utils._local_backend().iter_all_metadata())
+    return external_sort(records, key=lambda r: r[0], run_size=run_size)
+
+# --- Merge join ---
+
+def _unique_objects(objects):
+    """
+    Collapse consecutive records with the same key into one (sizes added, newest
+    modified time). Locally one key can be listed twice, e.g. a hot copy and an
+    archived copy, or two fan-out layouts while migrate_local_fanout runs.
+    Deleting a key removes every copy, so it must be matched or reported once.
+    """
+    current = None
+    for record in objects:
+        if current is not None and record[0] == current[0]:
+            modified = None if None in (current[2], record[2]) else max(current[2], record[2])
+            current = [current[0], current[1] + record[1], modified]
+            continue
+        if current is not None:
+            yield current
+        current = record
+    if current is not None:
+        yield current
+
+def merge_join(objects, metadata):
+    """
+    Walk both key-sorted streams once. Yields ('orphan_object', object_record) for
+    objects without metadata and ('dangling_metadata', metadata_record) for
+    metadata whose object does not exist.
+    """
+    objects = _unique_objects(objects)
+    obj = next(objects, None)
+    meta = next(metadata, None)
+    while obj is not None or meta is not None:
+        if meta is None or (obj is not None and obj[0] < meta[0]):
+            yield 'orphan_object', obj
+            obj = next(objects, None)
+        elif obj is None or meta[0] < obj[0]:
+            yield 'dangling_metadata', meta
+            meta = next(metadata, None)
+        else:
+            # Matched; several metadata rows may share one object, so only advance metadata
+            meta = next(metadata, None)
+            if meta is None or meta[0] != obj[0]:
+                obj = next(objects, None)
+
+class ReconcileReport:
+    def __init__(self):
+        self.orphan_objects = 0
+        self.orphan_bytes = 0
+        self.dangling_metadata = 0
+        self.skipped_recent = 0
+        self.deleted_objects = 0
+        self.deleted_metadata = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def reconcile(objects, metadata, grace_seconds, apply=False, only=None,
+              delete_objects=None, delete_metadata=None, report_file=None, now=None):
+    """
+    Merge-join the two streams and (optionally) delete what is out of sync.
+    delete_objects(keys) / delete_metadata([(user_id, image_id)]) receive batches.
+    """
+    now = now or time.time()
+    cutoff = now - grace_seconds
+    report = ReconcileReport()
+    object_batch, metadata_batch = [], []
+
+    def flush_objects():
+        if object_batch:
+            report.deleted_objects += delete_objects(list(object_batch))
+            object_batch.clear()
+
+    def flush_metadata():
+        if metadata_batch:
+            report.deleted_metadata += delete_metadata(list(metadata_batch))
+            metadata_batch.clear()
+
+    for kind, record in merge_join(objects, metadata):
+        if kind == 'orphan_object':
+            key, size, modified = record
+            if modified is not None and modified > cutoff:
+                report.skipped_recent += 1
+                continue
+            report.orphan_objects += 1
+            report.orphan_bytes += size
+            if apply and only in (None, 'objects'):
+                object_batch.append(key)
+                if len(object_batch) >= DELETE_BATCH:
+                    flush_objects()
+        else:
+            key, user_id, image_id, created = record
+            # Unified uploads write metadata before the bytes arrive
+            if created is not None and created > cutoff:
+                report.skipped_recent += 1
+                continue
+            report.dangling_metadata += 1
+            if apply and only in (None, 'metadata'):
+                metadata_batch.append((user_id, image_id))
+                if len(metadata_batch) >= DELETE_BATCH:
+                    flush_metadata()
+        if report_file:
+            report_file.write(json.dumps({'type': kind, 'record': record}) + '\n')
+
+    flush_objects()
+    flush_metadata()
+    return report
+
+# --- Batch deleters ---
+
+def _delete_s3_objects(bucket_name):
+    s3_client = s3_utils.get_s3_client()
+
+    def delete(keys):
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        except ClientError as e:
+            logger.error(f"Failed to delete {len(keys)} objects: {e}")
+            return 0
+        errors = response.get('Errors', [])
+        for error in errors:
+            logger.error(f"Failed to delete {error.get('Key')}: {error.get('Message')}")
+        return len(keys) - len(errors)
+    return delete
+
+def _delete_dynamodb_items(table_name):
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+
+    def delete(keys):
+        try:
+            # batch_writer chunks into 25-item BatchWriteItem calls and retries unprocessed items
+            with table.batch_writer() as batch:
+                for user_id, image_id in keys:
+                    batch.delete_item(Key={'user_id': user_id, 'image_id': image_id})
+        except ClientError as e:
+            logger.error(f"Failed to delete {len(keys)} metadata items: {e}")
+            return 0
+        return len(keys)
+    return delete
+
+def _delete_local_objects(keys):
+    return sum(1 for key in keys if local_adapter.delete_file(key))
+
+def _delete_local_metadata(keys):
+    backend = dynamo_utils._local_backend()
+    return sum(1 for user_id, image_id in keys if backend.delete_metadata(user_id, image_id))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find and clean up orphaned objects and dangling metadata")
+    parser.add_argument('--grace-hours', type=float, default=24, help="Ignore anything newer than this")
+    parser.add_argument('--apply', action='store_true', help="Delete instead of only reporting (default: dry run)")
+    parser.add_argument('--only', choices=['objects', 'metadata'], help="Restrict --apply to one side")
+    parser.add_argument('--segments', type=int, default=4, help="Parallel DynamoDB scan segments")
+    parser.add_argument('--run-size', type=int, default=RUN_SIZE, help="Records per in-memory sort run")
+    parser.add_argument('--report-file', help="Write every finding as JSON lines to this file")
+    parser.add_argument('--bucket', default=os.environ.get('BUCKET_NAME'))
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        objects = iter_local_objects(args.run_size)
+        metadata = iter_local_metadata(args.run_size)
+        delete_objects, delete_metadata = _delete_local_objects, _delete_local_metadata
+    else:
+        if not args.bucket or not args.table:
+            parser.error("--bucket/--table (or BUCKET_NAME/TABLE_NAME) are required")
+        objects = iter_s3_objects(args.bucket)
+        metadata = iter_dynamodb_metadata(args.table, args.segments, args.run_size)
+        delete_objects, delete_metadata = _delete_s3_objects(args.bucket), _delete_dynamodb_items(args.table)
+
+    report_file = open(args.report_file, 'w') if args.report_file else None
+    try:
+        report = reconcile(objects, metadata, args.grace_hours * 3600, args.apply, args.only,
+                           delete_objects, delete_metadata, report_file)
+    finally:
+        if report_file:
+            report_file.close()
+
+    mode = "" if args.apply else " (dry run)"
+    print(f"Orphaned objects: {report.orphan_objects} ({report.orphan_bytes} bytes), deleted {report.deleted_objects}{mode}")
+    print(f"Dangling metadata: {report.dangling_metadata}, deleted {report.deleted_metadata}{mode}")
+    print(f"Skipped (inside grace period): {report.skipped_recent}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Backfill tag_shard on existing items for the sharded tag GSI (TAG_INDEX_SHARDS).
+
+Usage (from backend/):
+    python -m src.jobs.shard_tag_index --shards 8
+    python -m src.jobs.shard_tag_index --shards 8 --drop-tag-index
+
+Migration:
+1. Add the 'tag-shard-index' GSI (PK tag_shard, SK image_id) to the table.
+2. Run this job once before setting TAG_INDEX_SHARDS=8 on the API (so reads find
+   old items) and once more right after with --drop-tag-index. That run catches
+   items written in between, then deletes the old 'tag-index' GSI. Every write
+   keeps updating tag-index, on the one hot 'uncategorized' partition, until the
+   GSI is gone, so the migration is not finished before this step.
+Only items whose tag_shard is missing or computed for a different shard count
+are updated. The index is only dropped after a run without failures, and only
+while tag-shard-index is ACTIVE.
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from src.utils import dynamo_utils
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+def _scan_pages(table):
+    kwargs = {'ProjectionExpression': '#u, #i, #t, #s',
+              'ExpressionAttributeNames': {'#u': 'user_id', '#i': 'image_id', '#t': 'tag', '#s': 'tag_shard'}}
+    while True:
+        response = table.scan(**kwargs)
+        yield response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def backfill(table_name, num_shards, workers=8, dry_run=False):
+    """Set tag_shard where it is missing or stale. Returns (scanned, updated, failed)."""
+    table = dynamo_utils.get_dynamodb_resource().Table(table_name)
+    scanned = updated = failed = 0
+
+    def update(item):
+        try:
+            table.update_item(
+                Key={'user_id': item['user_id'], 'image_id': item['image_id']},
+                UpdateExpression='SET tag_shard = :s',
+                # Skip items deleted or re-tagged since the scan read them
+                ConditionExpression='attribute_exists(image_id) AND tag = :t',
+                ExpressionAttributeValues={':s': item['expected'], ':t': item['tag']}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                logger.error(f"Failed to update {item['user_id']}/{item['image_id']}: {e}")
+                return False
+            return True
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in _scan_pages(table):
+            pending = []
+            for item in page:
+                scanned += 1
+                if not item.get('tag'):
+                    continue
+                expected = dynamo_utils.tag_shard_key(item['tag'], item['image_id'], num_shards)
+                if item.get('tag_shard') != expected:
+                    pending.append(dict(item, expected=expected))
+            if dry_run:
+                updated += len(pending)
+                continue
+            for ok in pool.map(update, pending):
+                if ok:
+                    updated += 1
+                else:
+                    failed += 1
+    return scanned, updated, failed
+
+def drop_tag_index(table_name):
+    """Delete the unsharded 'tag-index' GSI once 'tag-shard-index' serves tag queries. Returns True if deleted."""
+    client = dynamo_utils.get_dynamodb_resource().meta.client
+    indexes = {index['IndexName']: index.get('IndexStatus')
+               for index in client.describe_table(TableName=table_name)['Table'].get('GlobalSecondaryIndexes', [])}
+    if indexes.get(dynamo_utils.TAG_SHARD_INDEX_NAME) != 'ACTIVE':
+        logger.error(f"{dynamo_utils.TAG_SHARD_INDEX_NAME} is not ACTIVE on {table_name}; keeping tag-index")
+        return False
+    if 'tag-index' not in indexes:
+        return False
+    client.update_table(TableName=table_name, GlobalSecondaryIndexUpdates=[{'Delete': {'IndexName': 'tag-index'}}])
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill tag_shard for the sharded tag GSI")
+    parser.add_argument('--shards', type=int, required=True, help="Value of TAG_INDEX_SHARDS")
+    parser.add_argument('--table', default=os.environ.get('TABLE_NAME'))
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--drop-tag-index', action='store_true',
+                        help="After a clean backfill, delete the unsharded tag-index GSI (TAG_INDEX_SHARDS is live)")
+    args = parser.parse_args(argv)
+    if not args.table:
+        parser.error("--table or TABLE_NAME is required")
+    if args.shards <= 0:
+        parser.error("--shards must be positive")
+
+    logging.basicConfig(format='%(message)s')
+    scanned, updated, failed = backfill(args.table, args.shards, args.workers, args.dry_run)
+    verb = "would update" if args.dry_run else "updated"
+    print(f"Scanned {scanned} items, {verb} {updated}, {failed} failed.")
+    if args.drop_tag_index and not args.dry_run:
+        if failed:
+            print("Kept tag-index: rerun once the failed items are updated.")
+        elif drop_tag_index(args.table):
+            print("Deleting tag-index: writes now update tag-shard-index only.")
+        else:
+            print("tag-index was not deleted (already gone, or tag-shard-index is not ACTIVE).")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+Incremental, point-in-time snapshots of the local storage backend, and parallel restore.
+
+Usage (from backend/):
+    python -m src.jobs.snapshot_local create --repo /backup/cloudbox
+    python -m src.jobs.snapshot_local list --repo /backup/cloudbox
+    python -m src.jobs.snapshot_local restore latest --repo /backup/cloudbox [--target DIR]
+    python -m src.jobs.snapshot_local prune --repo /backup/cloudbox --keep 7
+
+The repository is content-addressed:
+    blobs/ab/cd/<sha256>              every distinct file, stored once
+    snapshots/<id>/manifest.json.gz   metadata files + [path, size, mtime_ns, sha256] per object
+
+Metadata is checkpointed first, consistently across shards: the job takes the
+shared lock of every metadata file at once, so writers (which hold the exclusive
+lock while they rewrite) are paused, and hard-links each file into a staging
+directory. Writers rename a new file into place rather than modifying the old
+one, so a linked inode is an immutable copy; the locks are held for
+microseconds, not for the copy. The SQLite engine (metadata.db) is copied with
+SQLite's online backup API. Objects are scanned afterwards, so every object the
+checkpoint refers to is in the snapshot (objects uploaded meanwhile may be too).
+
+Objects are incremental: a file whose path, size and mtime match the previous
+snapshot reuses its hash without being read, so snapshotting an unchanged store
+costs one stat per file. New or changed files are hashed and copied in one pass
+(in parallel), and only if no blob has that content yet. Each manifest is
+complete, so any snapshot restores on its own.
+
+Restore writes objects first, then metadata, so metadata never points at
+objects that are not there yet. Files already in the target with the manifest's
+size and mtime are skipped (restoring onto an unchanged store copies nothing),
+and objects not in the snapshot are removed unless --keep-extra. Stop the
+server while restoring, then rebuild the search index
+(python -m src.jobs.rebuild_search_index), which is derived data and not snapshotted.
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+
+from src.utils import local_adapter, local_sqlite
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CHUNK_BYTES = 1024 * 1024
+BATCH_SIZE = 1024
+
+# --- Repository ---
+
+def _blob_path(repo, digest):
+    return os.path.join(repo, 'blobs', digest[:2], digest[2:4], digest)
+
+def _snapshot_dir(repo, snapshot_id):
+    return os.path.join(repo, 'snapshots', snapshot_id)
+
+def list_snapshots(repo):
+    """Snapshot ids, oldest first (ids are UTC timestamps)."""
+    try:
+        return sorted(name for name in os.listdir(os.path.join(repo, 'snapshots'))
+                      if os.path.exists(os.path.join(_snapshot_dir(repo, name), 'manifest.json.gz')))
+    except FileNotFoundError:
+        return []
+
+def load_manifest(repo, snapshot_id):
+    if snapshot_id == 'latest':
+        snapshots = list_snapshots(repo)
+        if not snapshots:
+            raise FileNotFoundError(f"No snapshots in {repo}")
+        snapshot_id = snapshots[-1]
+    with gzip.open(os.path.join(_snapshot_dir(repo, snapshot_id), 'manifest.json.gz'), 'rt') as f:
+        return json.load(f)
+
+def _write_manifest(repo, manifest):
+    directory = _snapshot_dir(repo, manifest['id'])
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'manifest.json.gz')
+    with gzip.open(path + '.tmp', 'wt', compresslevel=6) as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    # The manifest appears last and atomically: a crashed run leaves no half snapshot
+    os.replace(path + '.tmp', path)
+
+def store_blob(repo, path):
+    """Hash and copy a file into the repository in one pass. Returns (sha256, size, bytes copied)."""
+    tmp_dir = os.path.join(repo, 'blobs', 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{os.getpid()}.{id(path)}.{time.monotonic_ns()}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            while True:
+                chunk = src.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        sha256 = digest.hexdigest()
+        blob = _blob_path(repo, sha256)
+        if os.path.exists(blob):
+            return sha256, size, 0  # same content already stored (e.g. a file that only moved)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(tmp_path, blob)
+        return sha256, size, size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _copy_blob(repo, sha256, dest, mtime_ns=None):
+    """Atomically write a blob to dest, with the recorded mtime so the next restore can skip it."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp_path = f"{dest}.tmp.{os.getpid()}.{time.monotonic_ns()}"
+    try:
+        shutil.copyfile(_blob_path(repo, sha256), tmp_path)
+        if mtime_ns is not None:
+            # atime stays "now": a restore is not evidence of how long an object has been idle
+            os.utime(tmp_path, ns=(time.time_ns(), mtime_ns))
+        os.replace(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _batched(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+# --- Snapshot ---
+
+def _metadata_files():
+    """Metadata JSON files that exist now: the single file and/or shard files, whatever the config."""
+    paths = [local_adapter.DB_FILE] if os.path.exists(local_adapter.DB_FILE) else []
+    try:
+        paths.extend(sorted(os.path.join(local_adapter.SHARDS_DIR, name) for name in os.listdir(local_adapter.SHARDS_DIR)
+                            if name.startswith('shard-') and name.endswith('.json')))
+    except FileNotFoundError:
+        pass
+    return paths
+
+def _relative(path):
+    relative = os.path.relpath(path, local_adapter.STORAGE_DIR)
+    return os.path.basename(path) if relative.startswith('..') else relative
+
+def checkpoint_metadata(staging):
+    """Consistent copies of every metadata file in staging. Returns [(relative path, staged path)]."""
+    os.makedirs(staging, exist_ok=True)
+    staged = []
+    paths = _metadata_files()
+    with ExitStack() as stack:
+        # Sorted, like any multi-lock acquisition, so two snapshots cannot deadlock
+        for path in sorted(paths):
+            stack.enter_context(local_adapter._file_lock(path, exclusive=False))
+        for n, path in enumerate(paths):
+            target = os.path.join(staging, f"{n}.json")
+            try:
+                os.link(path, target)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                shutil.copyfile(path, target)  # no hard links here (other filesystem, Windows): copy under the lock
+            staged.append((_relative(path), target))
+
+    if os.path.exists(local_sqlite.DB_FILE):
+        target = os.path.join(staging, 'metadata.db')
+        source = sqlite3.connect(local_sqlite.DB_FILE)
+        dest = sqlite3.connect(target)
+        try:
+            source.backup(dest)  # a consistent copy while writers continue
+        finally:
+            dest.close()
+            source.close()
+        staged.append((_relative(local_sqlite.DB_FILE), target))
+    return staged
+
+def _object_roots():
+    # Access markers (mtime = last download) come along so tiering decisions survive a restore
+    return (local_adapter.IMAGES_DIR, local_adapter.ARCHIVE_DIR, local_adapter.ACCESS_DIR)
+
+def _scan_objects():
+    """(relative path, stat) for every stored object, hot and cold, and every access marker."""
+    for root in _object_roots():
+        for entry in local_adapter.iter_object_files(root):
+            try:
+                yield _relative(entry.path), entry.stat()
+            except FileNotFoundError:
+                continue  # deleted while scanning
+
+def _store_object(repo, relative):
+    """store_blob for an object being written to meanwhile: retried until size and mtime hold still."""
+    path = os.path.join(local_adapter.STORAGE_DIR, relative)
+    for _ in range(3):
+        try:
+            before = os.stat(path)
+            sha256, size, copied = store_blob(repo, path)
+            after = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if (before.st_size, before.st_mtime_ns) == (after.st_size, after.st_mtime_ns) and size == after.st_size:
+            return [relative, size, after.st_mtime_ns, sha256], copied
+    logger.warning(f"{relative} kept changing while it was copied; snapshotting its last copy")
+    return [relative, size, after.st_mtime_ns, sha256], copied
+
+def create_snapshot(repo, workers=8):
+    """Snapshot STORAGE_DIR into repo. Returns the manifest (with stats)."""
+    started = time.perf_counter()
+    snapshots = list_snapshots(repo)
+    parent = load_manifest(repo, snapshots[-1]) if snapshots else None
+    known = {entry[0]: entry for entry in parent['objects']} if parent else {}
+
+    snapshot_id = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+    stats = {'objects': 0, 'reused': 0, 'hashed': 0, 'bytes_copied': 0, 'bytes_total': 0}
+    staging = os.path.join(local_adapter.STORAGE_DIR, f'.snapshot-{snapshot_id}')
+    try:
+        metadata = []
+        for relative, staged in checkpoint_metadata(staging):
+            sha256, size, copied = store_blob(repo, staged)
+            metadata.append({'path': relative, 'size': size, 'sha256': sha256})
+            stats['bytes_copied'] += copied
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    checkpointed = time.perf_counter()
+
+    objects = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for batch in _batched(_scan_objects()):
+            changed = []
+            for relative, st in batch:
+                previous = known.get(relative)
+                if previous and previous[1] == st.st_size and previous[2] == st.st_mtime_ns:
+                    objects.append(previous)
+                    stats['reused'] += 1
+                else:
+                    changed.append(relative)
+            for result in pool.map(lambda relative: _store_object(repo, relative), changed):
+                if result is None:
+                    continue
+                entry, copied = result
+                objects.append(entry)
+                stats['hashed'] += 1
+                stats['bytes_copied'] += copied
+    stats['objects'] = len(objects)
+    stats['bytes_total'] = sum(entry[1] for entry in objects) + sum(m['size'] for m in metadata)
+    stats['metadata_seconds'] = round(checkpointed - started, 3)
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+
+    manifest = {
+        'id': snapshot_id,
+        'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'parent': parent['id'] if parent else None,
+        'metadata': metadata,
+        'objects': sorted(objects),
+        'stats': stats,
+    }
+    _write_manifest(repo, manifest)
+    return manifest
+
+# --- Restore ---
+
+def _restore_object(repo, target, entry):
+    relative, size, mtime_ns, sha256 = entry
+    dest = os.path.join(target, relative)
+    try:
+        st = os.stat(dest)
+        if st.st_size == size and st.st_mtime_ns == mtime_ns:
+            return None
+    except FileNotFoundError:
+        pass
+    _copy_blob(repo, sha256, dest, mtime_ns)
+    return size
+
+def restore_snapshot(repo, snapshot_id='latest', target=None, workers=8, keep_extra=False):
+    """Restore a snapshot into target (STORAGE_DIR by default). Returns stats."""
+    started = time.perf_counter()
+    manifest = load_manifest(repo, snapshot_id)
+    target = target or local_adapter.STORAGE_DIR
+    stats = {'snapshot': manifest['id'], 'objects': len(manifest['objects']), 'copied': 0, 'bytes_copied': 0,
+             'removed': 0}
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        for batch in _batched(manifest['objects']):
+            for copied in pool.map(lambda entry: _restore_object(repo, target, entry), batch):
+                if copied is not None:
+                    stats['copied'] += 1
+                    stats['bytes_copied'] += copied
+
+    if not keep_extra:
+        wanted = {entry[0] for entry in manifest['objects']}
+        for root in _object_roots():
+            directory = os.path.join(target, os.path.relpath(root, local_adapter.STORAGE_DIR))
+            for entry in local_adapter.iter_object_files(directory):
+                if os.path.relpath(entry.path, target) not in wanted:
+                    os.remove(entry.path)
+                    stats['removed'] += 1
+
+    # Metadata last; files from another layout (e.g. shards when the snapshot has one file) are removed
+    restored = set()
+    for item in manifest['metadata']:
+        dest = os.path.join(target, item['path'])
+        if item['path'].endswith('.db'):
+            for suffix in ('-wal', '-shm'):  # a stale WAL would be replayed over the restored database
+                if os.path.exists(dest + suffix):
+                    os.remove(dest + suffix)
+        _copy_blob(repo, item['sha256'], dest)
+        restored.add(os.path.normpath(dest))
+    shards_dir = os.path.join(target, os.path.relpath(local_adapter.SHARDS_DIR, local_adapter.STORAGE_DIR))
+    stale = [os.path.join(target, os.path.relpath(local_adapter.DB_FILE, local_adapter.STORAGE_DIR))]
+    if os.path.isdir(shards_dir):
+        stale.extend(os.path.join(shards_dir, name) for name in os.listdir(shards_dir)
+                     if name.startswith('shard-') and name.endswith('.json'))
+    for path in stale:
+        if os.path.normpath(path) not in restored and os.path.exists(path):
+            os.remove(path)
+    stats['seconds'] = round(time.perf_counter() - started, 3)
+    return stats
+
+# --- Retention ---
+
+def prune(repo, keep):
+    """Keep the newest `keep` snapshots and delete blobs no remaining snapshot uses. Returns (snapshots, blobs) removed."""
+    snapshots = list_snapshots(repo)
+    doomed = snapshots[:max(len(snapshots) - keep, 0)]
+    for snapshot_id in doomed:
+        shutil.rmtree(_snapshot_dir(repo, snapshot_id))
+    referenced = set()
+    for snapshot_id in snapshots[len(doomed):]:
+        manifest = load_manifest(repo, snapshot_id)
+        referenced.update(entry[3] for entry in manifest['objects'])
+        referenced.update(item['sha256'] for item in manifest['metadata'])
+    removed = 0
+    for entry in local_adapter.iter_object_files(os.path.join(repo, 'blobs')):
+        if entry.name not in referenced and os.path.basename(os.path.dirname(entry.path)) != 'tmp':
+            os.remove(entry.path)
+            removed += 1
+    return len(doomed), removed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incremental snapshots of local storage")
+    parser.add_argument('--repo', required=True, help="Snapshot repository directory")
+    parser.add_argument('--workers', type=int, default=8, help="Files hashed/copied in parallel")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('create', help="Take a snapshot of STORAGE_DIR")
+    commands.add_parser('list', help="List snapshots")
+    restore = commands.add_parser('restore', help="Restore a snapshot (stop the server first)")
+    restore.add_argument('snapshot', nargs='?', default='latest')
+    restore.add_argument('--target', help="Directory to restore into (default: STORAGE_DIR)")
+    restore.add_argument('--keep-extra', action='store_true', help="Keep objects that are not in the snapshot")
+    retention = commands.add_parser('prune', help="Delete old snapshots and unreferenced blobs")
+    retention.add_argument('--keep', type=int, required=True)
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(message)s')
+
+    if args.command == 'create':
+        manifest = create_snapshot(args.repo, args.workers)
+        stats = manifest['stats']
+        print(f"Snapshot {manifest['id']}: {stats['objects']} objects ({stats['reused']} unchanged, "
+              f"{stats['hashed']} hashed), copied {stats['bytes_copied']} of {stats['bytes_total']} bytes "
+              f"in {stats['seconds']}s (metadata checkpoint {stats['metadata_seconds']}s)")
+    elif args.command == 'list':
+        for snapshot_id in list_snapshots(args.repo):
+            stats = load_manifest(args.repo, snapshot_id)['stats']
+            print(f"{snapshot_id}  {stats['objects']} objects  {stats['bytes_total']} bytes  "
+                  f"(+{stats['bytes_copied']} new)")
+    elif args.command == 'restore':
+        stats = restore_snapshot(args.repo, args.snapshot, args.target, args.workers, args.keep_extra)
+        print(f"Restored {stats['snapshot']}: {stats['objects']} objects, copied {stats['copied']} "
+              f"({stats['bytes_copied']} bytes), removed {stats['removed']} in {stats['seconds']}s. "
+              f"Rebuild the search index with python -m src.jobs.rebuild_search_index")
+    else:
+        snapshots, blobs = prune(args.repo, args.keep)
+        print(f"Removed {snapshots} snapshots and {blobs} unreferenced blobs")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Hot/cold tiering job.
+
+S3: pages through list_objects_v2 (1000 keys per page), looks up last download
+times from ACCESS_TABLE_NAME in batches of 100, moves objects idle for longer
+than --cold-after-days to TIER_COLD_STORAGE_CLASS (in-place copy) and promotes
+recently downloaded cold objects back to STANDARD. Only one page is held in
+memory, so it runs over millions of keys; --start-after resumes a stopped run
+from the last key it logged.
+
+Local (USE_LOCAL_STORAGE): files in local_storage/images whose last download
+is older than the cutoff are gzipped into local_storage/archive. Downloads are
+recorded in local_storage/access (at most once an hour per object), and objects
+never downloaded count from their upload (mtime), like LastModified on S3.
+Filesystem atime is not used, because jobs that read every object (phash,
+header enrichment, exports, snapshots) would keep it fresh. Archived objects
+are rehydrated automatically the next time they are downloaded.
+
+Usage (from backend/):
+    python -m src.jobs.tier_objects --report
+    python -m src.jobs.tier_objects --cold-after-days 30 --dry-run
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+from src.utils import s3_utils, local_adapter, tiering
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+PAGE_SIZE = 1000
+
+class TierStats:
+    """Objects and bytes per tier, plus what this run moved."""
+
+    def __init__(self):
+        self.tiers = {}
+        self.moved = 0
+        self.moved_bytes = 0
+        self.failed = 0
+
+    def add(self, tier, size):
+        entry = self.tiers.setdefault(tier, {'objects': 0, 'bytes': 0})
+        entry['objects'] += 1
+        entry['bytes'] += size
+
+    def as_dict(self):
+        return {'tiers': self.tiers, 'moved': self.moved, 'moved_bytes': self.moved_bytes, 'failed': self.failed}
+
+def _target_class(storage_class, last_used, has_access_record, cutoff):
+    if storage_class == 'STANDARD' and last_used < cutoff:
+        return tiering.COLD_STORAGE_CLASS
+    # Promotion needs evidence of a recent download; archive classes are restored on demand instead
+    if (storage_class == tiering.COLD_STORAGE_CLASS and storage_class not in tiering.ARCHIVE_CLASSES
+            and has_access_record and last_used >= cutoff):
+        return 'STANDARD'
+    return None
+
+def _transition(s3_client, bucket_name, key, target):
+    try:
+        # Managed copy switches to multipart for objects over 5 GB
+        s3_client.copy({'Bucket': bucket_name, 'Key': key}, bucket_name, key,
+                       ExtraArgs={'StorageClass': target, 'MetadataDirective': 'COPY'})
+        return True
+    except ClientError as e:
+        logger.error(f"Failed to move {key} to {target}: {e}")
+        return False
+
+def run_s3(bucket_name, cold_after_days, dry_run=False, report_only=False, workers=16, start_after=None):
+    s3_client = s3_utils.get_s3_client()
+    cutoff = time.time() - cold_after_days * 86400
+    stats = TierStats()
+
+    paginate_kwargs = {'Bucket': bucket_name, 'PaginationConfig': {'PageSize': PAGE_SIZE}}
+    if start_after:
+        paginate_kwargs['StartAfter'] = start_after
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for page in s3_client.get_paginator('list_objects_v2').paginate(**paginate_kwargs):
+            objects = page.get('Contents', [])
+            if not objects:
+                continue
+            if report_only:
+                for obj in objects:
+                    stats.add(obj.get('StorageClass', 'STANDARD'), obj['Size'])
+                continue
+
+            access = tiering.get_last_access([obj['Key'] for obj in objects])
+            moves = []
+            for obj in objects:
+                storage_class = obj.get('StorageClass', 'STANDARD')
+                key = obj['Key']
+                last_used = access.get(key, obj['LastModified'].timestamp())
+                target = _target_class(storage_class, last_used, key in access, cutoff)
+                if target and not dry_run:
+                    moves.append((obj, storage_class, target))
+                else:
+                    stats.add(target or storage_class, obj['Size'])
+                    if target:
+                        stats.moved += 1
+                        stats.moved_bytes += obj['Size']
+
+            results = pool.map(lambda move: _transition(s3_client, bucket_name, move[0]['Key'], move[2]), moves)
+            for (obj, storage_class, target), ok in zip(moves, results):
+                if ok:
+                    stats.add(target, obj['Size'])
+                    stats.moved += 1
+                    stats.moved_bytes += obj['Size']
+                else:
+                    stats.add(storage_class, obj['Size'])
+                    stats.failed += 1
+            logger.info(f"Processed through {objects[-1]['Key']} (resume with --start-after)")
+    return stats
+
+def _archive(entry):
+    return local_adapter.archive_file(entry.name)
+
+def run_local(cold_after_days, dry_run=False, report_only=False, workers=8):
+    cutoff = time.time() - cold_after_days * 86400
+    stats = TierStats()
+
+    # Count the existing cold tier first, so files archived below are not counted twice
+    for entry in local_adapter.iter_object_files(local_adapter.ARCHIVE_DIR):
+        stats.add('cold', entry.stat().st_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+
+        def flush():
+            for sizes in pool.map(_archive, batch):
+                if sizes:
+                    stats.add('cold', sizes[1])
+                    stats.moved += 1
+                    stats.moved_bytes += sizes[0]
+                else:
+                    stats.failed += 1
+            batch.clear()
+
+        for entry in local_adapter.iter_object_files(local_adapter.IMAGES_DIR):
+            st = entry.stat()
+            accessed = local_adapter.last_access(entry.name)
+            if report_only or (st.st_mtime if accessed is None else accessed) >= cutoff:
+                stats.add('hot', st.st_size)
+            elif dry_run:
+                stats.add('cold', st.st_size)
+                stats.moved += 1
+                stats.moved_bytes += st.st_size
+            else:
+                batch.append(entry)
+                if len(batch) >= PAGE_SIZE:
+                    flush()
+        flush()
+    return stats
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if n < 1024 or unit == 'TB':
+            return f"{n:.1f} {unit}" if unit != 'B' else f"{n} B"
+        n /= 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Move idle images to cheaper storage tiers")
+    parser.add_argument('--cold-after-days', type=int, default=tiering.COLD_AFTER_DAYS)
+    parser.add_argument('--report', action='store_true', help="Only report bytes per tier")
+    parser.add_argument('--dry-run', action='store_true', help="Show what would move without moving it")
+    parser.add_argument('--workers', type=int, default=16, help="Parallel transitions")
+    parser.add_argument('--start-after', help="S3 only: resume after this key")
+    parser.add_argument('--bucket', default=os.environ.get('BUCKET_NAME'))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        stats = run_local(args.cold_after_days, args.dry_run, args.report, args.workers)
+    else:
+        if not args.bucket:
+            parser.error("--bucket or BUCKET_NAME is required")
+        stats = run_s3(args.bucket, args.cold_after_days, args.dry_run, args.report, args.workers, args.start_after)
+
+    for tier, entry in sorted(stats.tiers.items()):
+        print(f"{tier:<16} {entry['objects']:>10} objects {_format_bytes(entry['bytes']):>12}")
+    if not args.report:
+        verb = "Would move" if args.dry_run else "Moved"
+        print(f"{verb} {stats.moved} objects ({_format_bytes(stats.moved_bytes)}), {stats.failed} failed")
+
+if __name__ == '__main__':
+    main()
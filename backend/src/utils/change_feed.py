@@ -0,0 +1,333 @@
+"""
+Per-user gallery change feed (GET /images/changes, SSE; /images/changes/ws, WebSocket).
+
+Metadata saves and deletes publish small deltas instead of clients re-running
+GET /images after every change:
+- {"type": "add", "image_id", "item"}   item saved (new or overwritten)
+- {"type": "remove", "image_id"}         item deleted
+- {"type": "reset"}                      deltas were lost; fetch the listing again
+
+Every subscriber has a bounded queue of pending deltas, keyed by image_id. A
+newer delta for an image replaces the one still waiting, so a burst of edits
+costs one message. A subscriber that falls more than QUEUE_SIZE images behind
+has its queue replaced by a single "reset". Publishers never block on a slow
+client, and a stalled connection holds at most QUEUE_SIZE deltas.
+
+Delivery is in-process. With several workers (gunicorn -w N), set
+CHANGE_FEED_BROKER=file: every publish is also appended to a shared log under
+CHANGE_FEED_DIR, and each worker with subscribers tails it. This stands in for
+a real broker (e.g. Redis pub/sub) on a single host; events logged while a
+worker was not tailing are not replayed, and clients recover through "reset".
+Event ids are "<stream token>-<seq>", numbered per user and process. A
+reconnect with Last-Event-ID to the same process replays what it missed, up to
+REPLAY_EVENTS deltas. Anything older, or a reconnect to another process, gets a "reset".
+"""
+import os
+import json
+import uuid
+import logging
+import threading
+from collections import OrderedDict, deque
+
+from src.utils import local_adapter
+
+logger = logging.getLogger()
+
+QUEUE_SIZE = int(os.environ.get('CHANGE_FEED_QUEUE_SIZE', '256'))
+REPLAY_EVENTS = int(os.environ.get('CHANGE_FEED_REPLAY_EVENTS', '128'))
+MAX_SUBSCRIBERS = int(os.environ.get('CHANGE_FEED_MAX_SUBSCRIBERS', '1000'))
+HEARTBEAT_SECONDS = float(os.environ.get('CHANGE_FEED_HEARTBEAT_SECONDS', '15'))
+BROKER = os.environ.get('CHANGE_FEED_BROKER', '').lower()
+FEED_DIR = os.environ.get('CHANGE_FEED_DIR') or os.path.join(local_adapter.STORAGE_DIR, 'feed')
+# The shared log is rotated to <log>.1 at this size
+LOG_MAX_BYTES = 4 * 1024 * 1024
+POLL_SECONDS = 0.1
+
+class TooManySubscribers(Exception):
+    pass
+
+class Subscription:
+    """One client's bounded, coalescing queue of pending deltas."""
+
+    def __init__(self, feed, user_id):
+        self.feed = feed
+        self.user_id = user_id
+        self.closed = False
+        self.overflows = 0
+        self._pending = OrderedDict()  # image_id (or None for reset) -> event
+        self._cond = threading.Condition()
+
+    def offer(self, event):
+        with self._cond:
+            if self.closed:
+                return
+            if event['type'] == 'reset':
+                self._pending = OrderedDict([(None, event)])
+            elif None in self._pending:
+                return  # a reset is pending: the client re-fetches anyway
+            else:
+                key = event['image_id']
+                self._pending.pop(key, None)
+                self._pending[key] = event
+                if len(self._pending) > QUEUE_SIZE:
+                    self.overflows += 1
+                    self.feed._count('overflows')
+                    self._pending = OrderedDict([(None, self.feed._reset_event(self.user_id))])
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Every pending delta, oldest first; [] if nothing arrived within timeout or once closed."""
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            events = list(self._pending.values())
+            self._pending.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        self.feed._unsubscribe(self)
+
+class _Stream:
+    """A user's event numbering and replay buffer. A new token means a new numbering."""
+    __slots__ = ('token', 'seq', 'recent')
+
+    def __init__(self):
+        self.token = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.recent = deque(maxlen=REPLAY_EVENTS)
+
+    def stamp(self, event):
+        self.seq += 1
+        event = dict(event, id=f'{self.token}-{self.seq}')
+        self.recent.append(event)
+        return event
+
+    def since(self, last_event_id):
+        """Events after last_event_id, or None if they cannot all be replayed."""
+        token, _, seq = last_event_id.partition('-')
+        if token != self.token or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        missed = self.seq - int(seq)
+        if missed > len(self.recent):
+            return None
+        return list(self.recent)[len(self.recent) - missed:]
+
+class ChangeFeed:
+    """In-process pub/sub keyed by user_id, with a short replay buffer per user."""
+
+    def __init__(self, broker=None, max_streams=4096):
+        self.token = uuid.uuid4().hex[:8]  # identifies this process on the shared log
+        self.broker = broker
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscribers = {}          # user_id -> set of Subscription
+        self._streams = OrderedDict()   # user_id -> _Stream, LRU; only users who subscribed
+        self._counters = {'published': 0, 'delivered': 0, 'overflows': 0, 'resets': 0, 'rejected': 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def _stream(self, user_id):
+        stream = self._streams.get(user_id)
+        if stream is None:
+            stream = self._streams[user_id] = _Stream()
+            if len(self._streams) > self.max_streams:
+                # Evict the least recently used stream nobody is subscribed to
+                for old_user in self._streams:
+                    if old_user not in self._subscribers:
+                        del self._streams[old_user]
+                        break
+        self._streams.move_to_end(user_id)
+        return stream
+
+    def _reset_event(self, user_id):
+        with self._lock:
+            self._counters['resets'] += 1
+            return self._stream(user_id).stamp({'type': 'reset'})
+
+    def publish(self, user_id, event, local_only=False):
+        if not local_only and self.broker is not None:
+            self.broker.append(self.token, user_id, event)
+        with self._lock:
+            self._counters['published'] += 1
+            stream = self._streams.get(user_id)
+            if stream is None:
+                return  # nobody has subscribed to this user recently: nothing to deliver or replay
+            event = stream.stamp(event)
+            subscribers = list(self._subscribers.get(user_id, ()))
+            self._counters['delivered'] += len(subscribers)
+        for subscription in subscribers:
+            subscription.offer(event)
+
+    def subscribe(self, user_id, last_event_id=None):
+        """A Subscription, primed with the deltas missed since last_event_id (or a reset)."""
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            total = sum(len(subscribers) for subscribers in self._subscribers.values())
+            if total >= MAX_SUBSCRIBERS:
+                self._counters['rejected'] += 1
+                raise TooManySubscribers(f"{total} change feed subscribers in this process")
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            stream = self._stream(user_id)
+            missed = stream.since(last_event_id) if last_event_id else []
+        if self.broker is not None:
+            self.broker.start(self)
+        if missed is None:
+            subscription.offer(self._reset_event(user_id))
+        for event in missed or ():
+            subscription.offer(event)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        # The stream (and its replay buffer) stays, so a reconnect can pick up where it left off
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.user_id]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters,
+                        subscribers=sum(len(subscribers) for subscribers in self._subscribers.values()),
+                        broker=self.broker.name if self.broker else None)
+
+class FileBroker:
+    """
+    Shared append-only log (JSON lines) that carries events between the worker
+    processes of one host. Each line is written with a single O_APPEND write, so
+    lines from different processes never interleave.
+    """
+    name = 'file'
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'changes.log')
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def append(self, token, user_id, event):
+        line = json.dumps({'origin': token, 'user_id': user_id, 'event': event}, separators=(',', ':')) + '\n'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.write(fd, line.encode('utf-8')) + os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size > LOG_MAX_BYTES:
+                self._rotate()
+        except OSError as e:
+            logger.error(f"Failed to append to change feed log {self.path}: {e}")
+
+    def _rotate(self):
+        with local_adapter._file_lock(self.path, exclusive=True):
+            try:
+                if os.path.getsize(self.path) > LOG_MAX_BYTES:
+                    os.replace(self.path, self.path + '.1')
+            except FileNotFoundError:
+                pass
+
+    def start(self, feed):
+        """Start tailing the log (once per process, on the first subscriber)."""
+        with self._start_lock:
+            if self._thread is None:
+                # Opened here rather than in the thread, so nothing published after subscribe() is missed
+                self._thread = threading.Thread(target=self._tail, args=(feed, self._open_at_end()),
+                                                name='change-feed-tail', daemon=True)
+                self._thread.start()
+
+    def _open_at_end(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(self.path, 'a+b')
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def _tail(self, feed, f):
+        partial = b''
+        while not self._stop.wait(POLL_SECONDS):
+            try:
+                partial = self._deliver(feed, partial + f.read())
+                # Rotated: finish the old file (done above), then follow the new one from its start
+                if os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino:
+                    partial = self._deliver(feed, partial + f.read())
+                    f.close()
+                    f = open(self.path, 'rb')
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.error(f"Change feed tail failed: {e}")
+        f.close()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @staticmethod
+    def _deliver(feed, data):
+        """Publish every complete line; return the unterminated remainder."""
+        *lines, partial = data.split(b'\n')
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('origin') != feed.token:
+                feed.publish(record['user_id'], record['event'], local_only=True)
+        return partial
+
+feed = ChangeFeed(FileBroker(FEED_DIR) if BROKER == 'file' else None)
+
+def publish_saved(item):
+    feed.publish(item['user_id'], {'type': 'add', 'image_id': item['image_id'], 'item': item})
+
+def publish_removed(user_id, image_id):
+    feed.publish(user_id, {'type': 'remove', 'image_id': image_id})
+
+def publish_reset(user_id):
+    """Many changes at once (e.g. a bulk import batch): tell clients to re-fetch instead."""
+    feed.publish(user_id, {'type': 'reset'})
+
+def subscribe(user_id, last_event_id=None):
+    return feed.subscribe(user_id, last_event_id)
+
+def stats():
+    return feed.stats()
+
+def _format_sse(event):
+    payload = {k: v for k, v in event.items() if k != 'id'}
+    data = json.dumps(payload, separators=(',', ':'), default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n".encode('utf-8')
+
+def iter_sse(subscription, heartbeat=None):
+    """text/event-stream body for a subscription; closes it when the client goes away."""
+    heartbeat = HEARTBEAT_SECONDS if heartbeat is None else heartbeat
+    try:
+        yield b'retry: 3000\n\n'
+        while not subscription.closed:
+            events = subscription.get(timeout=heartbeat)
+            if not events:
+                # Comment line: keeps proxies from timing out and surfaces dead clients
+                yield b': keepalive\n\n'
+                continue
+            yield b''.join(_format_sse(event) for event in events)
+    finally:
+        subscription.close()
+
+def iter_json_messages(subscription, heartbeat=None):
+    """WebSocket messages for a subscription: {"events": [...]}, with [] as a keepalive."""
+    heartbeat = HEARTBEAT_SECONDS if heartbeat is None else heartbeat
+    try:
+        while not subscription.closed:
+            events = subscription.get(timeout=heartbeat)
+            yield json.dumps({'events': events}, separators=(',', ':'), default=str)
+    finally:
+        subscription.close()
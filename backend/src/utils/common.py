@@ -1,5 +1,16 @@
 import json
 import decimal
+import gzip
+import zlib
+import base64
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+# Bodies smaller than this are not worth the CPU (or the base64 overhead on API Gateway)
+COMPRESSION_MIN_BYTES = 1024
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -10,16 +21,119 @@ class DecimalEncoder(json.JSONEncoder):
                 return int(o)
         return super(DecimalEncoder, self).default(o)
 
-def create_response(status_code, body):
-    """Create a standard API Gateway response."""
-    return {
+def get_header(event, name):
+    """Case-insensitive header lookup on an API Gateway style event."""
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def parse_csv_param(value):
+    """Split a comma separated query parameter (e.g. fields=a,b) into a clean list."""
+    if not value:
+        return []
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+def negotiate_encoding(accept_encoding):
+    """Pick the best supported content coding from an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+
+    # Prefer brotli (smaller) when the module is installed, then gzip
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+def compress_body(data, encoding):
+    """Compress raw bytes with the negotiated content coding."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+def compress_stream(chunks, encoding):
+    """
+    Compress an iterator of byte chunks on the fly. Each chunk is flushed as it
+    is compressed, so a streamed response still reaches the client page by page.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def iter_json_listing(key, pages):
+    """
+    Serialize {key: [items...]} incrementally from an iterator of item lists:
+    one chunk per page, so only the current page is ever encoded in memory.
+    """
+    yield ('{' + json.dumps(key) + ':[').encode('utf-8')
+    first = True
+    for page in pages:
+        if not page:
+            continue
+        items = json.dumps(page, cls=DecimalEncoder, separators=(',', ':'))[1:-1]
+        yield (items if first else ',' + items).encode('utf-8')
+        first = False
+    yield b']}'
+
+def create_response(status_code, body, accept_encoding=None):
+    """Create a standard API Gateway response.
+
+    When accept_encoding is given and the payload is large enough, the body is
+    compressed and base64 encoded (isBase64Encoded) as API Gateway expects.
+    """
+    payload = json.dumps(body, cls=DecimalEncoder, separators=(',', ':'))
+    response = {
         "statusCode": status_code,
         "headers": {
             "Content-Type": "application/json",
             "Access-Control-Allow-Origin": "*"
         },
-        "body": json.dumps(body, cls=DecimalEncoder)
+        "body": payload
+    }
+
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding and len(payload) >= COMPRESSION_MIN_BYTES:
+        compressed = compress_body(payload.encode('utf-8'), encoding)
+        response["headers"]["Content-Encoding"] = encoding
+        response["headers"]["Vary"] = "Accept-Encoding"
+        response["body"] = base64.b64encode(compressed).decode('ascii')
+        response["isBase64Encoded"] = True
+    return response
+
+def create_stream_response(status_code, chunks, content_type, filename=None):
+    """
+    A response whose body is an iterator of bytes ("stream" instead of "body").
+    Only streaming hosts (api_server) can send it; API Gateway buffers Lambda output.
+    """
+    headers = {
+        "Content-Type": content_type,
+        "Access-Control-Allow-Origin": "*"
     }
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return {"statusCode": status_code, "headers": headers, "stream": chunks}
 
 def create_error_response(status_code, message, details=None):
     """Create a standard error response."""
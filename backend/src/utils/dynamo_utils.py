@@ -1,123 +1,460 @@
 import boto3
+import functools
+import heapq
+import itertools
 import logging
-from botocore.exceptions import ClientError
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, HTTPClientError
 from boto3.dynamodb.conditions import Key, Attr
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 def get_dynamodb_resource():
-    """Returns a boto3 DynamoDB resource."""
-    return boto3.resource('dynamodb')
+    """Returns a boto3 DynamoDB resource with timeouts, retries and circuit breaking (see resilience)."""
+    resource = boto3.resource('dynamodb', config=resilience.client_config('dynamodb'))
+    resilience.instrument(resource.meta.client, 'dynamodb')
+    return resource
 
 import os
-from src.utils import local_adapter
+from src.utils import ids, local_adapter, postings, resilience, singleflight
 
+def _local_backend():
+    """Local metadata engine for USE_LOCAL_STORAGE mode: JSON files (default) or SQLite."""
+    if os.environ.get('LOCAL_DB_ENGINE', 'json').lower() == 'sqlite':
+        from src.utils import local_sqlite
+        return local_sqlite
+    return local_adapter
+
+# Write sharding for the tag GSI. Most uploads carry the same primary tag
+# ('uncategorized'), which turns a single tag-index partition into a write hotspot.
+# With TAG_INDEX_SHARDS=N, items also get tag_shard = '<tag>#<0..N-1>' (derived from
+# image_id), indexed by 'tag-shard-index', and tag queries scatter-gather over the
+# N shards; nothing reads 'tag-index' any more. Writes only stop hitting the hot
+# partition once 'tag-index' is deleted, which `python -m src.jobs.shard_tag_index
+# --drop-tag-index` does after backfilling existing items.
+TAG_INDEX_SHARDS = int(os.environ.get('TAG_INDEX_SHARDS', '0'))
+TAG_SHARD_INDEX_NAME = 'tag-shard-index'
+
+# Items per page (DynamoDB Limit) when a listing is streamed (iter_image_pages)
+STREAM_PAGE_SIZE = int(os.environ.get('STREAM_PAGE_SIZE', '1000'))
+
+def tag_shard_key(tag, image_id, num_shards=None):
+    num_shards = TAG_INDEX_SHARDS if num_shards is None else num_shards
+    return f"{tag}#{zlib.crc32(image_id.encode('utf-8')) % num_shards}"
+
+# Optional tag-membership table for multi-tag queries (tags=a,b&mode=all|any).
+# Layout: PK user_tag = '<user_id>#<tag>', SK image_id, one row per (user, tag, image),
+# so each tag's posting list for a user is a single sorted Query.
+TAG_MEMBERSHIP_TABLE = os.environ.get('TAG_MEMBERSHIP_TABLE')
+
+def _item_tags(item):
+    tags = set((item or {}).get('tags') or [])
+    if (item or {}).get('tag'):
+        tags.add(item['tag'])
+    return tags
+
+def _forgets_queries(user_ids):
+    """
+    Decorator for metadata writes: once the call returns, in-flight query_images calls
+    for user_ids(*args) are no longer joined, so a read issued after a caller's own
+    save or delete starts a new query instead of sharing one that began before it.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(table_name, *args, **kwargs):
+            try:
+                return fn(table_name, *args, **kwargs)
+            finally:
+                users = set(user_ids(*args))
+                singleflight.forget('query_images', lambda key: key[1] in users)
+        return wrapper
+    return decorate
+
+def _update_tag_memberships(user_id, image_id, old_tags, new_tags):
+    if not TAG_MEMBERSHIP_TABLE or old_tags == new_tags:
+        return True
+    table = get_dynamodb_resource().Table(TAG_MEMBERSHIP_TABLE)
+    try:
+        with table.batch_writer() as batch:
+            for tag in new_tags - old_tags:
+                batch.put_item(Item={'user_tag': f"{user_id}#{tag}", 'image_id': image_id})
+            for tag in old_tags - new_tags:
+                batch.delete_item(Key={'user_tag': f"{user_id}#{tag}", 'image_id': image_id})
+        return True
+    except ClientError as e:
+        logger.error(f"Failed to update tag memberships for {image_id}: {e}")
+        return False
+
+@_forgets_queries(lambda item: [item['user_id']])
 def save_metadata(table_name, item):
     """Save metadata item to DynamoDB."""
     if os.environ.get('USE_LOCAL_STORAGE'):
-        return local_adapter.save_metadata(item)
+        return _local_backend().save_metadata(item)
+
+    stored = item
+    if TAG_INDEX_SHARDS > 0 and item.get('tag'):
+        stored = dict(item, tag_shard=tag_shard_key(item['tag'], item['image_id']))
 
     dynamodb = get_dynamodb_resource()
     table = dynamodb.Table(table_name)
     try:
-        table.put_item(Item=item)
-        return True
+        put_kwargs = {'ReturnValues': 'ALL_OLD'} if TAG_MEMBERSHIP_TABLE else {}
+        response = table.put_item(Item=stored, **put_kwargs)
     except ClientError as e:
         logger.error(f"Failed to save metadata: {e}")
         return False
+    # A retry after a failed membership write re-applies the diff, since put_item is idempotent
+    return _update_tag_memberships(item['user_id'], item['image_id'],
+                                   _item_tags(response.get('Attributes')), _item_tags(item))
+
+@_forgets_queries(lambda items: {item['user_id'] for item in items})
+def save_many(table_name, items):
+    """
+    Save a batch of new items (bulk import) with BatchWriteItem, 25 puts per request;
+    unprocessed items are retried by the batch writer. Unlike save_metadata, the
+    previous version of each item is not read, so tag memberships are only added.
+    """
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        _local_backend().save_many(items)
+        return True
+
+    table = get_dynamodb_resource().Table(table_name)
+    try:
+        with table.batch_writer(overwrite_by_pkeys=['user_id', 'image_id']) as batch:
+            for item in items:
+                if TAG_INDEX_SHARDS > 0 and item.get('tag'):
+                    item = dict(item, tag_shard=tag_shard_key(item['tag'], item['image_id']))
+                batch.put_item(Item=item)
+        if TAG_MEMBERSHIP_TABLE:
+            memberships = get_dynamodb_resource().Table(TAG_MEMBERSHIP_TABLE)
+            with memberships.batch_writer(overwrite_by_pkeys=['user_tag', 'image_id']) as batch:
+                for item in items:
+                    for tag in _item_tags(item):
+                        batch.put_item(Item={'user_tag': f"{item['user_id']}#{tag}", 'image_id': item['image_id']})
+        return True
+    except ClientError as e:
+        logger.error(f"Failed to save batch of {len(items)} items: {e}")
+        return False
+
+@_forgets_queries(lambda user_id, *_: [user_id])
+def update_attributes(table_name, user_id, image_id, attributes):
+    """
+    SET a few derived attributes (e.g. phash) on an existing item without
+    rewriting it, so a concurrent edit of tags or description is not lost.
+    Returns False if the item no longer exists.
+    """
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return _local_backend().update_attributes(user_id, image_id, attributes)
+
+    table = get_dynamodb_resource().Table(table_name)
+    names = {f'#a{i}': name for i, name in enumerate(attributes)}
+    values = {f':v{i}': value for i, value in enumerate(attributes.values())}
+    try:
+        table.update_item(
+            Key={'user_id': user_id, 'image_id': image_id},
+            UpdateExpression='SET ' + ', '.join(f'#a{i} = :v{i}' for i in range(len(attributes))),
+            ConditionExpression='attribute_exists(user_id)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f"Failed to update {image_id}: {e}")
+        return False
 
 def get_metadata(table_name, user_id, image_id):
     """Get metadata for a specific image."""
-    dynamodb = get_dynamodb_resource()
-    table = dynamodb.Table(table_name)
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return _local_backend().get_metadata(user_id, image_id)
+
+    return resilience.hedged('dynamodb.get_metadata', _get_item, table_name, user_id, image_id)
+
+def _get_item(table_name, user_id, image_id):
+    table = get_dynamodb_resource().Table(table_name)
     try:
         response = table.get_item(Key={'user_id': user_id, 'image_id': image_id})
         return response.get('Item')
-    except ClientError as e:
+    except (ClientError, HTTPClientError) as e:
+        # A throttled or unreachable table is not a missing image
+        resilience.raise_if_transient('dynamodb', e)
         logger.error(f"Failed to get metadata: {e}")
         return None
 
-def query_images(table_name, user_id=None, tag=None, start_date=None, end_date=None):
+def _projection_kwargs(fields):
+    """
+    Build ProjectionExpression kwargs for a list of attribute names.
+    Placeholders (#p0, #p1, ...) avoid clashes with reserved words and with the
+    #n* names boto3 generates for condition expressions.
+    """
+    if not fields:
+        return {}
+    names = {f'#p{i}': field for i, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ', '.join(names.keys()),
+        'ExpressionAttributeNames': names
+    }
+
+def _query_all_pages(table, **kwargs):
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _key_conditions(partition_condition, start_date=None, end_date=None):
+    """
+    One key condition per image_id range covering the dates (see ids.key_ranges), in
+    sort-key order, so concatenating the query results keeps them ordered.
+    """
+    ranges = ids.key_ranges(start_date, end_date)
+    if ranges is None:
+        return [partition_condition]
+    return [partition_condition & Key('image_id').between(lo, hi) for lo, hi in ranges]
+
+def _query_tag_shards(table, tag, start_date=None, end_date=None, fields=None):
+    """Scatter a tag query over every tag_shard in parallel and merge the results by image_id."""
+    # image_id is the merge key, so it is always fetched and dropped again if not requested
+    projection = list(fields) + ['image_id'] if fields and 'image_id' not in fields else fields
+
+    def query_shard(shard):
+        return [item
+                for key_condition in _key_conditions(Key('tag_shard').eq(f"{tag}#{shard}"), start_date, end_date)
+                for item in _query_all_pages(table, IndexName=TAG_SHARD_INDEX_NAME,
+                                             KeyConditionExpression=key_condition, **_projection_kwargs(projection))]
+
+    # Table.query only calls through to the (thread-safe) low-level client, so the table is shared
+    with ThreadPoolExecutor(max_workers=min(TAG_INDEX_SHARDS, 16)) as pool:
+        shard_results = list(pool.map(query_shard, range(TAG_INDEX_SHARDS)))
+    items = list(heapq.merge(*shard_results, key=lambda i: i['image_id']))
+    if projection is not fields:
+        for item in items:
+            item.pop('image_id', None)
+    return items
+
+def query_images(table_name, user_id=None, tag=None, start_date=None, end_date=None, fields=None):
     """
     Query images based on filters.
     Supports:
     - user_id (PK scan range)
     - tag (GSI query)
     - date range (SK condition or FilterExpression)
+    - fields (ProjectionExpression, only these attributes are returned)
+    Identical concurrent calls share one backend query (see singleflight), so the
+    returned items must be treated as read-only. A user's query never joins one that
+    started before that user's last completed write (see _forgets_queries).
     """
+    key = (table_name, user_id, tag, start_date, end_date, tuple(fields) if fields else None)
+    return singleflight.do('query_images', key, _query_images, table_name, user_id, tag, start_date, end_date, fields)
+
+def _query_images(table_name, user_id=None, tag=None, start_date=None, end_date=None, fields=None):
     if os.environ.get('USE_LOCAL_STORAGE'):
-        return local_adapter.query_images(user_id, tag)
+        return _local_backend().query_images(user_id, tag, start_date, end_date, fields=fields)
+    return resilience.hedged('dynamodb.query_images', _query_dynamodb, table_name, user_id, tag, start_date, end_date, fields)
 
+def _query_dynamodb(table_name, user_id=None, tag=None, start_date=None, end_date=None, fields=None):
     dynamodb = get_dynamodb_resource()
     table = dynamodb.Table(table_name)
-    
+
     try:
-        if user_id:
-            # Main Table Query
-            key_condition = Key('user_id').eq(user_id)
-            if start_date and end_date:
-                key_condition = key_condition & Key('image_id').between(start_date, end_date)
-            
-            filter_expression = None
-            if tag:
-                filter_expression = Attr('tags').contains(tag) # Assuming 'tags' is a list or 'tag' is a single field. Let's assume 'tag' single for simplicity as per GSI req.
-                # If GSI 'tag-index' exists, better to use it if user_id is NOT provided.
-                # But here user_id IS provided, so we query Partition and filter by attr.
-
-            query_kwargs = {'KeyConditionExpression': key_condition}
-            if filter_expression:
-                query_kwargs['FilterExpression'] = filter_expression
-                
-            response = table.query(**query_kwargs)
-            return response.get('Items', [])
-            
-        elif tag:
-            # GSI Query (Global Secondary Index)
-            # Assuming GSI name 'tag-index' where PK=tag
-            # And we need to support date range on this GSI if possible? 
-            # If GSI Sort Key is 'image_id', we can range query on it.
-            key_condition = Key('tag').eq(tag)
-            if start_date and end_date:
-                key_condition = key_condition & Key('image_id').between(start_date, end_date)
-                
-            response = table.query(
-                IndexName='tag-index',
-                KeyConditionExpression=key_condition
-            )
-            return response.get('Items', [])
-            
-        else:
-            # Scan if no query keys (Inefficient but necessary if no user_id or tag)
-            # Or return empty/error. Requirement says "Must support filters".
-            # Let's perform a Scan with filters if provided, but warn.
-            scan_kwargs = {}
-            filter_expressions = []
-            if start_date and end_date:
-                filter_expressions.append(Attr('image_id').between(start_date, end_date))
-            
-            if filter_expressions:
-                from functools import reduce
-                scan_kwargs['FilterExpression'] = reduce(lambda x, y: x & y, filter_expressions)
-                response = table.scan(**scan_kwargs)
-                return response.get('Items', [])
-            
-            return [] # Return empty if no filters at all to prevent full table dump
+        if tag and not user_id and TAG_INDEX_SHARDS > 0:
+            return _query_tag_shards(table, tag, start_date, end_date, fields)
+        return [item for page in _dynamodb_pages(table, user_id, tag, start_date, end_date, fields) for item in page]
 
-    except ClientError as e:
+    except (ClientError, HTTPClientError) as e:
+        # Throttling must not look like an empty gallery
+        resilience.raise_if_transient('dynamodb', e)
         logger.error(f"Failed to query images: {e}")
         return []
 
+def _dynamodb_pages(table, user_id=None, tag=None, start_date=None, end_date=None, fields=None, page_size=None):
+    """
+    Yield the matching items one DynamoDB response at a time, in image_id order:
+    - user_id: Query on the table (a tag is a FilterExpression on 'tag' or 'tags', see _item_tags)
+    - tag only: Query on the 'tag-index' GSI (PK tag, SK image_id)
+    - date range only: filtered Scan (inefficient, unordered); no filters at all yields nothing
+    page_size sets Limit; a filtered page can come back smaller, or empty (skipped).
+    """
+    query_kwargs = _projection_kwargs(fields)
+    if page_size:
+        query_kwargs['Limit'] = page_size
+
+    if user_id:
+        if tag:
+            query_kwargs['FilterExpression'] = Attr('tag').eq(tag) | Attr('tags').contains(tag)
+        requests = [dict(query_kwargs, KeyConditionExpression=key_condition)
+                    for key_condition in _key_conditions(Key('user_id').eq(user_id), start_date, end_date)]
+        operation = table.query
+    elif tag:
+        requests = [dict(query_kwargs, IndexName='tag-index', KeyConditionExpression=key_condition)
+                    for key_condition in _key_conditions(Key('tag').eq(tag), start_date, end_date)]
+        operation = table.query
+    else:
+        ranges = ids.key_ranges(start_date, end_date)
+        if not ranges:
+            return  # no filters at all: never dump the whole table
+        query_kwargs['FilterExpression'] = functools.reduce(
+            lambda x, y: x | y, [Attr('image_id').between(lo, hi) for lo, hi in ranges])
+        requests = [query_kwargs]
+        operation = table.scan
+
+    for kwargs in requests:
+        while True:
+            response = operation(**kwargs)
+            if response.get('Items'):
+                yield response['Items']
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def _tag_shard_pages(table, tag, start_date=None, end_date=None, fields=None, page_size=None):
+    """Lazy _query_tag_shards: merge the shards' paged results by image_id, page_size items at a time."""
+    projection = list(fields) + ['image_id'] if fields and 'image_id' not in fields else fields
+
+    def shard_items(shard):
+        for key_condition in _key_conditions(Key('tag_shard').eq(f"{tag}#{shard}"), start_date, end_date):
+            kwargs = dict(_projection_kwargs(projection), IndexName=TAG_SHARD_INDEX_NAME,
+                          KeyConditionExpression=key_condition, Limit=page_size or 1000)
+            while True:
+                response = table.query(**kwargs)
+                yield from response.get('Items', [])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    merged = heapq.merge(*[shard_items(shard) for shard in range(TAG_INDEX_SHARDS)], key=lambda i: i['image_id'])
+    while True:
+        page = list(itertools.islice(merged, page_size or 1000))
+        if not page:
+            return
+        if projection is not fields:
+            for item in page:
+                item.pop('image_id', None)
+        yield page
+
+def iter_image_pages(table_name, user_id=None, tag=None, start_date=None, end_date=None, fields=None,
+                     page_size=None):
+    """
+    query_images as a generator of pages (lists of items, in the same order), for
+    streaming responses: only one page is held at a time and the first one is
+    available after a single backend round trip. Not shared through singleflight.
+    Unlike query_images, an error after the first page is raised rather than
+    turned into a short result, so a truncated listing is never passed off as complete.
+    """
+    page_size = page_size or STREAM_PAGE_SIZE
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        yield from _local_backend().iter_image_pages(user_id, tag, start_date, end_date, fields, page_size)
+        return
+
+    table = get_dynamodb_resource().Table(table_name)
+    if tag and not user_id and TAG_INDEX_SHARDS > 0:
+        pages = _tag_shard_pages(table, tag, start_date, end_date, fields, page_size)
+    else:
+        pages = _dynamodb_pages(table, user_id, tag, start_date, end_date, fields, page_size)
+    try:
+        yield from pages
+    except (ClientError, HTTPClientError) as e:
+        resilience.raise_if_transient('dynamodb', e)
+        logger.error(f"Failed to query images: {e}")
+        raise
+
+@_forgets_queries(lambda user_id, *_: [user_id])
 def delete_metadata_item(table_name, user_id, image_id):
     """Delete metadata item from DynamoDB."""
     if os.environ.get('USE_LOCAL_STORAGE'):
-        return local_adapter.delete_metadata(user_id, image_id)
+        return _local_backend().delete_metadata(user_id, image_id)
 
     dynamodb = get_dynamodb_resource()
     table = dynamodb.Table(table_name)
     try:
-        table.delete_item(Key={'user_id': user_id, 'image_id': image_id})
-        return True
+        delete_kwargs = {'ReturnValues': 'ALL_OLD'} if TAG_MEMBERSHIP_TABLE else {}
+        response = table.delete_item(Key={'user_id': user_id, 'image_id': image_id}, **delete_kwargs)
     except ClientError as e:
         logger.error(f"Failed to delete metadata: {e}")
         return False
+    return _update_tag_memberships(user_id, image_id, _item_tags(response.get('Attributes')), set())
+
+def _dynamo_tag_postings(table, user_id, tags):
+    """{tag: sorted image_ids} from the membership table, or one partition query as fallback."""
+    if TAG_MEMBERSHIP_TABLE:
+        membership = get_dynamodb_resource().Table(TAG_MEMBERSHIP_TABLE)
+
+        def fetch(tag):
+            rows = _query_all_pages(membership, KeyConditionExpression=Key('user_tag').eq(f"{user_id}#{tag}"),
+                                    **_projection_kwargs(['image_id']))
+            return [row['image_id'] for row in rows]
+
+        with ThreadPoolExecutor(max_workers=min(len(tags), 8)) as pool:
+            return dict(zip(tags, pool.map(fetch, tags)))
+
+    # Without the membership table, derive the lists from the user's partition (ids + tags only)
+    result = {tag: [] for tag in tags}
+    rows = _query_all_pages(table, KeyConditionExpression=Key('user_id').eq(user_id),
+                            **_projection_kwargs(['image_id', 'tag', 'tags']))
+    for row in rows:
+        for tag in _item_tags(row) & result.keys():
+            result[tag].append(row['image_id'])
+    return result
+
+def _batch_get_items(table_name, user_id, image_ids, fields=None):
+    """BatchGetItem in chunks of 100, returned in image_ids order."""
+    dynamodb = get_dynamodb_resource()
+    projection = list(fields) + ['image_id'] if fields and 'image_id' not in fields else fields
+    found = {}
+    for i in range(0, len(image_ids), 100):
+        request = {table_name: dict(Keys=[{'user_id': user_id, 'image_id': image_id} for image_id in image_ids[i:i + 100]],
+                                    **_projection_kwargs(projection))}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table_name, []):
+                found[item['image_id']] = item
+            request = response.get('UnprocessedKeys') or None
+    items = [found[image_id] for image_id in image_ids if image_id in found]
+    if projection is not fields:
+        for item in items:
+            item.pop('image_id', None)
+    return items
+
+def get_many(table_name, user_id, image_ids, fields=None):
+    """Fetch several of one user's items by image_id, returned in image_ids order (missing ids skipped)."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        items = _local_backend().get_many(user_id, image_ids)
+        if fields:
+            items = [local_adapter._project(i, fields) for i in items]
+        return items
+
+    try:
+        return _batch_get_items(table_name, user_id, image_ids, fields)
+    except (ClientError, HTTPClientError) as e:
+        resilience.raise_if_transient('dynamodb', e)
+        logger.error(f"Failed to batch get items: {e}")
+        return []
+
+def query_images_by_tags(table_name, user_id, tags, mode='all', start_date=None, end_date=None,
+                         limit=None, cursor=None, fields=None):
+    """
+    Multi-tag query for one user: mode 'all' (AND) or 'any' (OR) over per-tag posting lists.
+    Returns (items, next_cursor); pass next_cursor back as cursor for the following page.
+    """
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        backend = _local_backend()
+        tag_lists = backend.get_tag_postings(user_id, tags)
+        image_ids, next_cursor = postings.evaluate([tag_lists[t] for t in tags], mode, after=cursor, limit=limit,
+                                                   ranges=ids.key_ranges(start_date, end_date))
+        return get_many(table_name, user_id, image_ids, fields), next_cursor
+
+    table = get_dynamodb_resource().Table(table_name)
+    try:
+        tag_lists = _dynamo_tag_postings(table, user_id, tags)
+        image_ids, next_cursor = postings.evaluate([tag_lists[t] for t in tags], mode, after=cursor, limit=limit,
+                                                   ranges=ids.key_ranges(start_date, end_date))
+        return _batch_get_items(table_name, user_id, image_ids, fields), next_cursor
+    except (ClientError, HTTPClientError) as e:
+        # Throttling must not look like an empty page
+        resilience.raise_if_transient('dynamodb', e)
+        logger.error(f"Failed to query images by tags: {e}")
+        return [], None
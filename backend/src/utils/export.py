@@ -0,0 +1,115 @@
+"""
+Streaming ZIP export (GET /images/export).
+
+The archive is produced on the fly. zipfile writes into an unseekable sink, so
+every entry gets a data descriptor and nothing has to be rewound. The generator
+hands each chunk on as soon as it is written. Images are already compressed, so
+entries are STORED and cost no CPU. Objects are opened a few at a time ahead of
+the writer (an S3 get_object pays its first-byte latency up front), but their
+bytes are only read as the client consumes the stream. Memory therefore stays at
+about PREFETCH open streams plus one CHUNK_SIZE buffer, whatever the album size.
+"""
+import os
+import time
+import logging
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from src.utils import ids, s3_utils
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 256 * 1024
+# Objects opened ahead of the one being written (kept below botocore's 10 pooled connections)
+PREFETCH = int(os.environ.get('EXPORT_PREFETCH', '4'))
+EXPORT_FIELDS = ['image_id', 's3_key', 'original_filename', 'upload_time']
+
+class _Sink:
+    """Write-only, unseekable file object; the generator drains what zipfile wrote."""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Yield (at most once) whatever was written since the last drain."""
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks.clear()
+            yield data
+
+def _prefetch(items, opener, depth):
+    """Yield (item, opener(item)) in order with up to `depth` opens in flight."""
+    pending = deque()
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max(depth, 1)) as pool:
+        try:
+            for item in items:
+                pending.append((item, pool.submit(opener, item)))
+                if len(pending) > depth:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # Client went away mid-stream: close whatever was opened ahead
+            for _, future in pending:
+                opened = future.result()
+                if opened:
+                    opened[0].close()
+
+def archive_name(item, used):
+    """Readable, unique, path-free name for an item inside the archive."""
+    name = os.path.basename((item.get('original_filename') or item['image_id']).replace('\\', '/')) or item['image_id']
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate.lower() in used:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    used.add(candidate.lower())
+    return candidate
+
+def _date_time(item):
+    created = ids.parse_timestamp(item['image_id'])
+    if created is None or created.year < 1980:
+        return time.gmtime()[:6]
+    return created.timetuple()[:6]
+
+def iter_zip(bucket_name, items, chunk_size=CHUNK_SIZE, prefetch=PREFETCH):
+    """Yield the ZIP archive of items' objects as byte chunks. Missing objects are skipped."""
+    s3_client = None if os.environ.get('USE_LOCAL_STORAGE') else s3_utils.get_s3_client()
+    opener = lambda item: s3_utils.open_object(bucket_name, item.get('s3_key') or item['image_id'], s3_client)
+    sink = _Sink()
+    used = set()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for item, opened in _prefetch(items, opener, prefetch):
+            if not opened:
+                logger.warning(f"Export: skipping missing object {item['image_id']}")
+                continue
+            stream, size = opened
+            info = zipfile.ZipInfo(archive_name(item, used), date_time=_date_time(item))
+            info.file_size = size
+            with closing(stream), zf.open(info, 'w') as dst:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    # Central directory, written when the ZipFile closes
+    yield from sink.drain()
@@ -0,0 +1,255 @@
+"""
+Idempotency-Key support for write endpoints (POST /images/upload, /save-metadata).
+
+A client that retries a request with the same Idempotency-Key header gets the
+first response replayed instead of a second upload slot or metadata row:
+
+1. Look the key up (one consistent read). A completed record is replayed as is,
+   with an Idempotent-Replayed: true header; a record still in progress is a 409
+   (the first attempt is running: retry shortly); a record made for a different
+   request body is a 422.
+2. Otherwise claim the key with a conditional create, holding a lease for
+   LOCK_SECONDS. Of two racing first attempts only one wins; the other is
+   answered as in step 1.
+3. Run the handler. Responses below 500 are stored for TTL_SECONDS (only by the
+   lease holder); a 5xx or an exception releases the key so a retry runs again.
+
+Records live in IDEMPOTENCY_TABLE_NAME (PK idempotency_key, with TTL enabled on
+expires_at), or under STORAGE_DIR/idempotency in local mode. Keys are scoped by
+route and user_id. Without a table in AWS mode the header is ignored, and if
+the store cannot be reached the request runs without protection (logged), as
+it would without the header.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import hashlib
+import logging
+import functools
+import threading
+from botocore.exceptions import ClientError
+
+from src.utils import common, dynamo_utils, local_adapter
+
+logger = logging.getLogger()
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENCY_TABLE_NAME = os.environ.get('IDEMPOTENCY_TABLE_NAME')
+TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+# How long a first attempt may run before a retry may take the key over
+LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_DIR = os.environ.get('IDEMPOTENCY_DIR') or os.path.join(local_adapter.STORAGE_DIR, 'idempotency')
+MAX_KEY_LENGTH = 255
+# Larger responses are not stored (DynamoDB items are limited to 400 KB)
+MAX_BODY_BYTES = 300 * 1024
+# Chance that a local record write also deletes expired records in its directory
+SWEEP_PROBABILITY = 0.01
+
+_stats = {'stored': 0, 'replayed': 0, 'in_progress': 0, 'mismatched': 0, 'released': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+class StoreUnavailable(Exception):
+    pass
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def enabled():
+    return bool(os.environ.get('USE_LOCAL_STORAGE') or IDEMPOTENCY_TABLE_NAME)
+
+def _fingerprint(event):
+    return hashlib.sha256((event.get('body') or '').encode('utf-8')).hexdigest()
+
+def _record_key(route, event, key):
+    try:
+        user_id = json.loads(event.get('body') or '{}').get('user_id') or ''
+    except (ValueError, AttributeError):
+        user_id = ''
+    return f"{route}#{user_id}#{key}"
+
+# --- Local store: one JSON file per key, created with O_EXCL, replaced under a per-directory lock ---
+
+def _local_path(record_key):
+    digest = hashlib.sha256(record_key.encode('utf-8')).hexdigest()
+    return os.path.join(IDEMPOTENCY_DIR, digest[:2], digest + '.json')
+
+def _local_read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _local_write(path, record):
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+
+def _sweep(directory, now):
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            record = _local_read(os.path.join(directory, name))
+            if record and record['expires_at'] < now:
+                os.remove(os.path.join(directory, name))
+
+def _local_get(record_key):
+    return _local_read(_local_path(record_key))
+
+def _local_claim(record_key, record, now):
+    path = _local_path(record_key)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Lock sidecars are never deleted, so there is one per directory rather than per key
+    with local_adapter._file_lock(directory, exclusive=True):
+        existing = _local_read(path)
+        if existing and existing['expires_at'] >= now:
+            return False
+        if random.random() < SWEEP_PROBABILITY:
+            _sweep(directory, now)
+        _local_write(path, record)
+        return True
+
+def _local_replace(record_key, lease, record):
+    path = _local_path(record_key)
+    with local_adapter._file_lock(os.path.dirname(path), exclusive=True):
+        existing = _local_read(path)
+        if not existing or existing['lease'] != lease:
+            return False
+        if record is None:
+            os.remove(path)
+        else:
+            _local_write(path, record)
+        return True
+
+# --- DynamoDB store ---
+
+def _table():
+    return dynamo_utils.get_dynamodb_resource().Table(IDEMPOTENCY_TABLE_NAME)
+
+def _get(record_key):
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return _local_get(record_key)
+    try:
+        item = _table().get_item(Key={'idempotency_key': record_key}, ConsistentRead=True).get('Item')
+    except ClientError as e:
+        raise StoreUnavailable(e)
+    if item:
+        item['expires_at'] = int(item['expires_at'])
+        if 'status_code' in item:
+            item['status_code'] = int(item['status_code'])
+    return item
+
+def _claim(record_key, record, now):
+    """Create the in-progress record unless a live one exists. Returns False when another attempt holds the key."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return _local_claim(record_key, record, now)
+    try:
+        # DynamoDB deletes expired items up to days late: an expired record counts as absent
+        _table().put_item(Item=record, ConditionExpression='attribute_not_exists(idempotency_key) OR expires_at < :now',
+                          ExpressionAttributeValues={':now': now})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise StoreUnavailable(e)
+
+def _replace(record_key, lease, record):
+    """Store the final record (or delete it, record=None) if the lease is still ours."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return _local_replace(record_key, lease, record)
+    condition = {'ConditionExpression': 'lease = :lease', 'ExpressionAttributeValues': {':lease': lease}}
+    try:
+        if record is None:
+            _table().delete_item(Key={'idempotency_key': record_key}, **condition)
+        else:
+            _table().put_item(Item=record, **condition)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f"Failed to finish idempotency record {record_key}: {e}")
+        return False
+
+# --- Handler wrapper ---
+
+def _answer(record, fingerprint, replay):
+    """The response for a retry that found an existing, unexpired record."""
+    if record['fingerprint'] != fingerprint:
+        _count('mismatched')
+        return common.create_error_response(422, f"{HEADER} was already used for a different request")
+    if record['status'] != 'completed':
+        _count('in_progress')
+        response = common.create_error_response(409, "A request with this Idempotency-Key is still in progress")
+        response['headers']['Retry-After'] = '1'
+        return response
+    _count('replayed')
+    body = record['body']
+    if replay and 200 <= record['status_code'] < 300:
+        body = json.dumps(replay(json.loads(body)), cls=common.DecimalEncoder, separators=(',', ':'))
+    return {
+        'statusCode': record['status_code'],
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', REPLAYED_HEADER: 'true'},
+        'body': body,
+    }
+
+def idempotent(route, replay=None):
+    """
+    Decorator for a write handler: requests carrying an Idempotency-Key run once
+    per key. replay(body) may refresh a stored 2xx body before it is resent
+    (e.g. re-sign an upload URL that has expired since).
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            key = common.get_header(event, HEADER)
+            if not key or not enabled():
+                return handler(event, context)
+            if len(key) > MAX_KEY_LENGTH:
+                return common.create_error_response(400, f"{HEADER} is longer than {MAX_KEY_LENGTH} characters")
+
+            record_key = _record_key(route, event, key)
+            fingerprint = _fingerprint(event)
+            now = int(time.time())
+            lease = uuid.uuid4().hex
+            try:
+                existing = _get(record_key)
+                if existing and existing['expires_at'] >= now:
+                    return _answer(existing, fingerprint, replay)
+                claim = {'idempotency_key': record_key, 'status': 'in_progress', 'fingerprint': fingerprint,
+                         'lease': lease, 'expires_at': now + LOCK_SECONDS}
+                if not _claim(record_key, claim, now):
+                    existing = _get(record_key)  # a concurrent first attempt won the race
+                    if existing:
+                        return _answer(existing, fingerprint, replay)
+                    return handler(event, context)
+            except StoreUnavailable as e:
+                _count('errors')
+                logger.error(f"Idempotency store unavailable, running {route} without it: {e}")
+                return handler(event, context)
+
+            try:
+                response = handler(event, context)
+            except Exception:
+                _replace(record_key, lease, None)
+                raise
+            body = response.get('body')
+            if (response.get('statusCode', 200) >= 500 or not isinstance(body, str)
+                    or response.get('isBase64Encoded') or len(body) > MAX_BODY_BYTES):
+                if _replace(record_key, lease, None):
+                    _count('released')
+                return response
+            record = dict(claim, status='completed', status_code=response.get('statusCode', 200), body=body,
+                          expires_at=int(time.time()) + TTL_SECONDS)
+            if _replace(record_key, lease, record):
+                _count('stored')
+            return response
+        return wrapper
+    return decorator
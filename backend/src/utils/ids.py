@@ -0,0 +1,131 @@
+"""
+Image ids and date-range key bounds.
+
+New ids are `img_<ULID>[.ext]`: 10 Crockford base32 chars of millisecond UTC
+timestamp + 16 chars of randomness, e.g. `img_01JAB3X7Q9M2D5K8T0W4R6Y1ZC.jpg`.
+They sort by creation time, and the `img_` prefix makes every new id sort after
+every legacy id (`2025-01-01T12-00-00.123456Z_<uuid4>-<filename>`), so a
+partition stays in upload order across the switch.
+
+A date range maps to at most two contiguous key ranges, one per id scheme
+(see key_ranges); each is a single sort-key BETWEEN condition.
+"""
+import os
+import re
+import datetime
+import threading
+
+from dateutil.parser import isoparse
+
+PREFIX = 'img_'
+_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford base32
+_TIME_CHARS = 10
+_RANDOM_CHARS = 16
+# Appended to an inclusive upper bound so every key sharing that prefix sorts below it
+_HIGH = '\uffff'
+
+_EXT_RE = re.compile(r'^\.[a-z0-9]{1,8}$')
+_DATE_ONLY_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+_LEGACY_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:T(\d{2})-(\d{2})-(\d{2})(?:\.(\d{1,6}))?Z?)?')
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MAX = datetime.datetime(9999, 12, 31, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc)
+
+_last = [0, 0]  # (ms, random) of the previous id, for monotonic ids within a millisecond
+_last_lock = threading.Lock()
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+def _decode(text):
+    value = 0
+    for char in text:
+        value = value * 32 + _ALPHABET.index(char)
+    return value
+
+def _to_ms(dt):
+    return (dt - _EPOCH) // datetime.timedelta(milliseconds=1)
+
+def new_image_id(filename=None, now=None):
+    """A new sortable id; keeps a short lowercase file extension so S3 keys stay recognisable."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    ms = _to_ms(now)
+    with _last_lock:
+        if ms == _last[0]:
+            # Same millisecond: bump the random part so ids from one process stay in creation order
+            random_part = _last[1] + 1
+        else:
+            random_part = int.from_bytes(os.urandom(10), 'big')
+        _last[0], _last[1] = ms, random_part
+    ext = os.path.splitext(filename or '')[1].lower()
+    return PREFIX + _encode(ms, _TIME_CHARS) + _encode(random_part, _RANDOM_CHARS) + (ext if _EXT_RE.match(ext) else '')
+
+def parse_timestamp(image_id):
+    """Creation time (UTC) encoded in a new or legacy id, or None for ids that carry no time."""
+    if image_id.startswith(PREFIX):
+        encoded = image_id[len(PREFIX):len(PREFIX) + _TIME_CHARS]
+        try:
+            return _EPOCH + datetime.timedelta(milliseconds=_decode(encoded))
+        except ValueError:
+            return None
+    match = _LEGACY_RE.match(image_id)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        return datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                                 int(second or 0), int((fraction or '0').ljust(6, '0')),
+                                 tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+def parse_date(value, end=False):
+    """
+    Parse a start_date/end_date parameter (ISO 8601, or the legacy id style with '-' in the time).
+    A bare date as end_date means the whole day. Naive times are UTC. Raises ValueError.
+    """
+    value = value.strip()
+    if _DATE_ONLY_RE.match(value):
+        day = datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+        return day + datetime.timedelta(days=1, microseconds=-1) if end else day
+    try:
+        dt = isoparse(value)
+    except ValueError:
+        dt = parse_timestamp(value)
+        if dt is None:
+            raise ValueError(f"Invalid date: {value!r}")
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+def _legacy_key(dt):
+    # Legacy ids are only exact to the second: ids without a fraction ("...00Z_")
+    # sort after ids with one ("...00.5Z_"), so bounds stop at whole seconds.
+    # Midnight becomes the bare date so date-only ids ("2023-01-02") are included.
+    if (dt.hour, dt.minute, dt.second) == (0, 0, 0):
+        return dt.strftime('%Y-%m-%d')
+    return dt.strftime('%Y-%m-%dT%H-%M-%S')
+
+def key_ranges(start_date=None, end_date=None):
+    """
+    Inclusive (low, high) image_id ranges covering [start_date, end_date], or None
+    when neither is given. Legacy ids come first, then new ids, so querying the
+    ranges in order keeps results sorted by image_id.
+    """
+    if not start_date and not end_date:
+        return None
+    start = parse_date(start_date) if start_date else _EPOCH
+    end = parse_date(end_date, end=True) if end_date else _MAX
+    if start > end:
+        return []
+    legacy = (_legacy_key(start), end.strftime('%Y-%m-%dT%H-%M-%S') + _HIGH)
+    compact = (PREFIX + _encode(_to_ms(start), _TIME_CHARS),
+               PREFIX + _encode(_to_ms(end), _TIME_CHARS) + _HIGH)
+    return [legacy, compact]
+
+def in_ranges(image_id, ranges):
+    return ranges is None or any(lo <= image_id <= hi for lo, hi in ranges)
@@ -0,0 +1,250 @@
+"""
+Dimensions, capture time and camera from image headers, reading as little as possible.
+
+Parsers never see a whole file: they ask a RangeReader for the bytes at an
+offset, and the reader fetches HEAD_BYTES (covering the headers of nearly every
+JPEG, PNG, WebP and GIF) plus, rarely, a few more blocks further in, e.g. a JPEG
+frame header that follows a large EXIF thumbnail, or a WebP EXIF chunk stored
+after the image data. A reader stops after MAX_BYTES whatever the file looks like.
+
+Pure Python on purpose: no Pillow, and no decoding. Width and height are the
+displayed size, swapped for EXIF orientations 5-8 (rotated by 90 degrees).
+taken_at is EXIF DateTimeOriginal as ISO 8601, with the offset when the camera
+recorded one (OffsetTimeOriginal) and without it otherwise, since EXIF times are local.
+"""
+import struct
+
+HEAD_BYTES = 64 * 1024
+BLOCK_BYTES = 16 * 1024
+MAX_BYTES = 256 * 1024
+
+class ReadBudgetExceeded(Exception):
+    pass
+
+class RangeReader:
+    """
+    read(offset, n) over fetch(offset, length) -> (bytes, total_size), caching the
+    blocks fetched so far. The first fetch is HEAD_BYTES, later ones at least BLOCK_BYTES.
+    """
+
+    def __init__(self, fetch, head_bytes=HEAD_BYTES, max_bytes=MAX_BYTES):
+        self._fetch = fetch
+        self._head_bytes = head_bytes
+        self._max_bytes = max_bytes
+        self._blocks = []  # (start, data)
+        self.size = None
+        self.fetched = 0
+        self.requests = 0
+
+    def read(self, offset, n):
+        if self.size is not None and offset >= self.size:
+            return b''
+        for start, data in self._blocks:
+            if start <= offset and offset + n <= start + len(data):
+                return data[offset - start:offset - start + n]
+        length = max(n, self._head_bytes if not self._blocks else BLOCK_BYTES)
+        if self.size is not None:
+            length = min(length, self.size - offset)
+        if self.fetched + length > self._max_bytes:
+            raise ReadBudgetExceeded(f"header parsing would read more than {self._max_bytes} bytes")
+        data, size = self._fetch(offset, length)
+        self.size = size
+        self.fetched += len(data)
+        self.requests += 1
+        self._blocks.append((offset, data))
+        return data[:n]
+
+def parse(reader):
+    """{'format', 'width', 'height', ...} for a recognised image, or None."""
+    head = reader.read(0, 32)
+    if head.startswith(b'\xff\xd8'):
+        return _parse_jpeg(reader)
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return _parse_png(reader)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return _parse_webp(reader)
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        width, height = struct.unpack('<HH', head[6:10])
+        return {'format': 'gif', 'width': width, 'height': height}
+    return None
+
+def _finish(info, exif):
+    if exif:
+        if exif.get('orientation') in (5, 6, 7, 8) and 'width' in info:
+            info['width'], info['height'] = info['height'], info['width']
+        for key in ('taken_at', 'camera'):
+            if exif.get(key):
+                info[key] = exif[key]
+    return info
+
+# --- JPEG ---
+
+# Start-of-frame markers carry the dimensions (C4 DHT, C8 JPG and CC DAC are not frames)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01}
+
+def _parse_jpeg(reader):
+    offset = 2
+    exif = None
+    while True:
+        header = reader.read(offset, 4)
+        if len(header) < 2 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker in _STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if len(header) < 4:
+            return None
+        length = struct.unpack('>H', header[2:4])[0]
+        if marker in _SOF_MARKERS:
+            frame = reader.read(offset + 4, 5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:5])
+            return _finish({'format': 'jpeg', 'width': width, 'height': height}, exif)
+        if marker == 0xDA or marker == 0xD9:  # image data or end of image without a frame header
+            return None
+        if marker == 0xE1 and exif is None:
+            segment = reader.read(offset + 4, length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                exif = parse_exif(segment[6:])
+        offset += 2 + length
+
+# --- PNG ---
+
+def _parse_png(reader):
+    ihdr = reader.read(8, 16)
+    if ihdr[4:8] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', ihdr[8:16])
+    info = {'format': 'png', 'width': width, 'height': height}
+    # eXIf must precede the image data; walk chunk headers only, up to the first IDAT
+    offset = 8
+    while True:
+        header = reader.read(offset, 8)
+        if len(header) < 8:
+            return info
+        length, kind = struct.unpack('>I4s', header)
+        if kind in (b'IDAT', b'IEND'):
+            return info
+        if kind == b'eXIf':
+            return _finish(info, parse_exif(reader.read(offset + 8, length)))
+        offset += 12 + length
+
+# --- WebP ---
+
+def _parse_webp(reader):
+    riff_size = struct.unpack('<I', reader.read(4, 4))[0]
+    info = None
+    vp8x_has_exif = False
+    offset = 12
+    while offset + 8 <= riff_size + 8:
+        header = reader.read(offset, 8)
+        if len(header) < 8:
+            break
+        kind, length = header[:4], struct.unpack('<I', header[4:])[0]
+        if kind == b'VP8X':
+            data = reader.read(offset + 8, 10)
+            vp8x_has_exif = bool(data[0] & 0x08)
+            width = 1 + int.from_bytes(data[4:7], 'little')
+            height = 1 + int.from_bytes(data[7:10], 'little')
+            info = {'format': 'webp', 'width': width, 'height': height}
+            if not vp8x_has_exif:
+                return info
+        elif kind == b'VP8 ' and info is None:
+            data = reader.read(offset + 8, 10)
+            if data[3:6] != b'\x9d\x01\x2a':
+                return None
+            width, height = struct.unpack('<HH', data[6:10])
+            return {'format': 'webp', 'width': width & 0x3FFF, 'height': height & 0x3FFF}
+        elif kind == b'VP8L' and info is None:
+            data = reader.read(offset + 8, 5)
+            if data[:1] != b'\x2f':
+                return None
+            bits = int.from_bytes(data[1:5], 'little')
+            return {'format': 'webp', 'width': 1 + (bits & 0x3FFF), 'height': 1 + ((bits >> 14) & 0x3FFF)}
+        elif kind == b'EXIF' and info is not None:
+            data = reader.read(offset + 8, length)
+            if data.startswith(b'Exif\x00\x00'):
+                data = data[6:]
+            return _finish(info, parse_exif(data))
+        offset += 8 + length + (length & 1)  # chunks are padded to an even size
+    return info
+
+# --- EXIF (TIFF structure) ---
+
+_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+_TAG_MAKE, _TAG_MODEL, _TAG_ORIENTATION, _TAG_EXIF_IFD = 0x010F, 0x0110, 0x0112, 0x8769
+_TAG_DATETIME_ORIGINAL, _TAG_DATETIME_DIGITIZED, _TAG_OFFSET_TIME_ORIGINAL = 0x9003, 0x9004, 0x9011
+
+def _read_ifd(data, offset, endian):
+    """{tag: value} for the ASCII and SHORT/LONG entries of one IFD."""
+    entries = {}
+    if offset + 2 > len(data):
+        return entries
+    count = struct.unpack(endian + 'H', data[offset:offset + 2])[0]
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        if entry + 12 > len(data):
+            break
+        tag, kind, n = struct.unpack(endian + 'HHI', data[entry:entry + 8])
+        size = _TYPE_SIZES.get(kind, 1) * n
+        if size <= 4:
+            raw = data[entry + 8:entry + 8 + size]
+        else:
+            pointer = struct.unpack(endian + 'I', data[entry + 8:entry + 12])[0]
+            raw = data[pointer:pointer + size]
+        if kind == 2:
+            entries[tag] = raw.split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+        elif kind == 3 and len(raw) >= 2:
+            entries[tag] = struct.unpack(endian + 'H', raw[:2])[0]
+        elif kind == 4 and len(raw) >= 4:
+            entries[tag] = struct.unpack(endian + 'I', raw[:4])[0]
+    return entries
+
+def _exif_datetime(value, offset=None):
+    # "2023:07:14 18:02:11" -> "2023-07-14T18:02:11"; blank or zeroed fields mean unknown
+    if not value or len(value) < 19 or value.startswith('0000'):
+        return None
+    iso = value[:10].replace(':', '-') + 'T' + value[11:19]
+    if offset and len(offset) == 6 and offset[0] in '+-':
+        iso += offset
+    return iso
+
+def parse_exif(data):
+    """orientation, taken_at and camera from a TIFF-structured EXIF block ({} if unreadable)."""
+    try:
+        if data[:2] == b'II':
+            endian = '<'
+        elif data[:2] == b'MM':
+            endian = '>'
+        else:
+            return {}
+        if struct.unpack(endian + 'H', data[2:4])[0] != 42:
+            return {}
+        ifd0 = _read_ifd(data, struct.unpack(endian + 'I', data[4:8])[0], endian)
+        exif_ifd = _read_ifd(data, ifd0[_TAG_EXIF_IFD], endian) if _TAG_EXIF_IFD in ifd0 else {}
+    except (struct.error, IndexError):
+        return {}
+
+    result = {}
+    if isinstance(ifd0.get(_TAG_ORIENTATION), int):
+        result['orientation'] = ifd0[_TAG_ORIENTATION]
+    taken_at = _exif_datetime(exif_ifd.get(_TAG_DATETIME_ORIGINAL) or exif_ifd.get(_TAG_DATETIME_DIGITIZED),
+                              exif_ifd.get(_TAG_OFFSET_TIME_ORIGINAL))
+    if taken_at:
+        result['taken_at'] = taken_at
+    make, model = ifd0.get(_TAG_MAKE) or '', ifd0.get(_TAG_MODEL) or ''
+    if not isinstance(make, str):
+        make = ''
+    if not isinstance(model, str):
+        model = ''
+    # Most models already start with the make ("Canon EOS R6"); don't say it twice
+    camera = model if make and model.lower().startswith(make.split()[0].lower()) else f"{make} {model}".strip()
+    if camera:
+        result['camera'] = camera
+    return result
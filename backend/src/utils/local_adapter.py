@@ -1,86 +1,694 @@
 import os
 import json
+import hmac
+import base64
+import hashlib
+import secrets
 import shutil
 import logging
+import threading
+import time
+import gzip
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, urlencode
+
+from src.utils import ids, records
+
+try:
+    import fcntl
+except ImportError:  # Windows (start_backend.bat): fall back to in-process locking only
+    fcntl = None
 
 logger = logging.getLogger()
 
 STORAGE_DIR = os.path.join(os.getcwd(), 'local_storage')
 IMAGES_DIR = os.path.join(STORAGE_DIR, 'images')
 DB_FILE = os.path.join(STORAGE_DIR, 'metadata.json')
+# Cold tier: objects not downloaded for a while are gzipped here by src.jobs.tier_objects
+ARCHIVE_DIR = os.path.join(STORAGE_DIR, 'archive')
+# Last download per object for tiering: an empty marker file whose mtime is the access time.
+# Filesystem atime is not used, since background jobs that read objects would refresh it.
+ACCESS_DIR = os.path.join(STORAGE_DIR, 'access')
+
+# Metadata sharding: LOCAL_DB_SHARDS=N spreads tenants over N files in SHARDS_DIR,
+# keyed by a hash of user_id. 0 (default) keeps the legacy single metadata.json.
+# Use `python -m src.jobs.migrate_local_shards` to move existing data.
+DB_SHARDS = int(os.environ.get('LOCAL_DB_SHARDS', '0'))
+SHARDS_DIR = os.path.join(STORAGE_DIR, 'metadata')
+
+# Group commit: concurrent writers to the same shard are batched into a single
+# rewrite + fsync. Worth enabling for upload-heavy installs.
+GROUP_COMMIT = os.environ.get('LOCAL_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+
+# Fan-out: LOCAL_FANOUT_LEVELS=N (1-3) stores objects under N levels of two hex
+# character directories taken from crc32(name), e.g. images/3f/a2/<name>, so no
+# directory holds more than ~total/256^N entries. 0 keeps the flat layout. Lookups
+# fall back to the other layouts, so `python -m src.jobs.migrate_local_fanout`
+# can reshuffle existing files while the server is running.
+FANOUT_LEVELS = int(os.environ.get('LOCAL_FANOUT_LEVELS', '0'))
+MAX_FANOUT_LEVELS = 3
+
+# Local URLs carry an HMAC signature over (method, object, expiry), like S3
+# presigned URLs. LOCAL_URL_SIGNING=off restores the old bare URLs.
+URL_SIGNING = os.environ.get('LOCAL_URL_SIGNING', 'on').lower() not in ('0', 'off', 'false')
+_url_secret_cache = None
+
+# How GET /local-store/<name> hands out bytes once the URL is verified:
+# '' streams through Flask (send_file); 'x-accel' (nginx) and 'x-sendfile'
+# (Apache/lighttpd) return only a header and let the front server send the file.
+SENDFILE_MODE = os.environ.get('LOCAL_SENDFILE_MODE', '').lower()
+# nginx `internal` location that maps onto IMAGES_DIR, for x-accel
+ACCEL_PREFIX = os.environ.get('LOCAL_ACCEL_PREFIX', '/protected-images/')
 
 # Ensure dirs exist
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
-def _load_db():
-    if not os.path.exists(DB_FILE):
-        return []
+# One lock per shard file, so writers for different tenants don't serialize
+_shard_locks = {}
+_shard_locks_guard = threading.Lock()
+
+# Parsed shard indexes ({user_id: {image_id: item}}), keyed by file path and
+# invalidated whenever the file on disk changes (e.g. written by another process)
+_index_cache = {}
+
+# Per-user tag posting lists ({tag: [image_id, ...] sorted}), LRU bounded. An entry is
+# valid while the user's items dict is the same object (writes are copy-on-write).
+_postings_cache = OrderedDict()
+_postings_lock = threading.Lock()
+POSTINGS_CACHE_USERS = 1024
+
+def shard_for_user(user_id, num_shards=None):
+    """Stable shard number for a user (crc32 is consistent across processes, unlike hash())."""
+    num_shards = DB_SHARDS if num_shards is None else num_shards
+    return zlib.crc32(user_id.encode('utf-8')) % num_shards
+
+def shard_path(shard_id, num_shards=None, shards_dir=None):
+    num_shards = DB_SHARDS if num_shards is None else num_shards
+    if num_shards <= 0:
+        return DB_FILE
+    return os.path.join(shards_dir or SHARDS_DIR, f'shard-{shard_id:04d}.json')
+
+def _path_for_user(user_id):
+    if DB_SHARDS <= 0:
+        return DB_FILE
+    return shard_path(shard_for_user(user_id))
+
+def _all_paths():
+    if DB_SHARDS <= 0:
+        return [DB_FILE]
+    return [shard_path(i) for i in range(DB_SHARDS)]
+
+def _lock_for(path):
+    with _shard_locks_guard:
+        lock = _shard_locks.get(path)
+        if lock is None:
+            lock = _shard_locks[path] = threading.Lock()
+        return lock
+
+@contextmanager
+def _file_lock(path, exclusive):
+    """
+    Cross-process reader/writer lock on a sidecar <path>.lock file (flock).
+    Shared for readers, exclusive for read-modify-write. The sidecar is never
+    deleted, since removing a lock file while others wait on it breaks exclusion.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        with open(DB_FILE, 'r') as f:
-            return json.load(f)
-    except:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)  # closing the descriptor releases the flock
+
+def _load_db(path=None, object_hook=None):
+    path = path or DB_FILE
+    if not os.path.exists(path):
         return []
+    try:
+        with open(path, 'r') as f:
+            return json.load(f, object_hook=object_hook)
+    except json.JSONDecodeError as e:
+        # Never treat a corrupt file as empty: the next write would wipe every tenant in it
+        logger.error(f"Corrupt metadata file {path}: {e}")
+        raise
 
-def _save_db(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+def _save_db(data, path=None):
+    """Atomically replace path: write a temp file, fsync it, rename over the original, fsync the dir."""
+    path = path or DB_FILE
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2, default=records.to_json)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def _file_signature(path):
+    # Every save renames a new file into place, so the inode alone changes on each write
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _load_index(path, locked=False):
+    """
+    Return the {user_id: {image_id: Record}} index for a shard, re-reading only if the file changed.
+    Items are held as compact records (see records) and only become dicts on the way out.
+    Pass locked=True when the caller already holds the exclusive file lock (flock
+    would otherwise deadlock against our own descriptor).
+    """
+    signature = _file_signature(path)
+    cached = _index_cache.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    if locked:
+        items = _load_db(path, records.object_hook)
+    else:
+        with _file_lock(path, exclusive=False):
+            signature = _file_signature(path)
+            items = _load_db(path, records.object_hook)
+    index = {}
+    for item in items:
+        index.setdefault(item.user_id, {})[item.image_id] = item
+    _index_cache[path] = (signature, index)
+    return index
+
+def _save_index(path, index):
+    _save_db([item for items in index.values() for item in items.values()], path)
+    _index_cache[path] = (_file_signature(path), index)
+
+class _PendingWrite:
+    __slots__ = ('apply', 'done', 'result', 'error', 'finished', 'is_leader')
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.is_leader = False
+
+class _CommitQueue:
+    __slots__ = ('lock', 'pending', 'leader_active')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.leader_active = False
+
+_commit_queues = {}
+
+def _commit_batch(path, batch):
+    """Apply a batch of mutations under the exclusive file lock with one rewrite/fsync."""
+    try:
+        with _file_lock(path, exclusive=True):
+            # Copy-on-write so concurrent readers of the cached index never see a half-applied change
+            index = dict(_load_index(path, locked=True))
+            changed = False
+            for write in batch:
+                try:
+                    write.result = write.apply(index)
+                    changed = changed or bool(write.result)
+                except Exception as e:
+                    write.error = e
+            if changed:
+                _save_index(path, index)
+    except Exception as e:
+        for write in batch:
+            write.error = write.error or e
+    for write in batch:
+        write.finished = True
+        write.done.set()
+
+def _group_commit(path, apply):
+    """
+    Leader/follower group commit. The first writer to arrive becomes leader and
+    commits everything queued so far; writers arriving meanwhile queue up behind
+    it and the next of them is promoted to commit the following batch.
+    """
+    with _shard_locks_guard:
+        queue = _commit_queues.get(path)
+        if queue is None:
+            queue = _commit_queues[path] = _CommitQueue()
+
+    write = _PendingWrite(apply)
+    with queue.lock:
+        queue.pending.append(write)
+        if not queue.leader_active:
+            queue.leader_active = True
+            write.is_leader = True
+
+    if not write.is_leader:
+        write.done.wait()
+
+    if not write.finished:
+        # We are the leader (initially or by promotion)
+        with queue.lock:
+            batch, queue.pending = queue.pending, []
+        _commit_batch(path, batch)
+        with queue.lock:
+            if queue.pending:
+                successor = queue.pending[0]
+                successor.is_leader = True
+                successor.done.set()
+            else:
+                queue.leader_active = False
+
+    if write.error:
+        raise write.error
+    return write.result
+
+def _mutate(path, apply):
+    """
+    Run apply(index) as an atomic read-modify-write of one shard. apply mutates the
+    (copied) index in place and returns a truthy value when it changed something;
+    the shard is only rewritten if at least one mutation did.
+    """
+    if GROUP_COMMIT:
+        return _group_commit(path, apply)
+    write = _PendingWrite(apply)
+    with _lock_for(path):
+        _commit_batch(path, [write])
+    if write.error:
+        raise write.error
+    return write.result
 
 # --- S3 Mimic ---
 
-def generate_local_upload_url(host_url, object_name):
-    # Returns a URL that the frontend can PUT to.
-    # We need a route in api_server: PUT /local-store/<object_name>
-    return f"{host_url}/local-store/{object_name}"
+def _url_secret():
+    """
+    HMAC key for local URLs: LOCAL_URL_SECRET, else a random key persisted in
+    STORAGE_DIR so every worker process (and restarts) signs with the same key.
+    """
+    global _url_secret_cache
+    if _url_secret_cache is None:
+        configured = os.environ.get('LOCAL_URL_SECRET')
+        if configured:
+            _url_secret_cache = configured.encode('utf-8')
+        else:
+            path = os.path.join(STORAGE_DIR, '.url_secret')
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(secrets.token_hex(32))
+            except FileExistsError:
+                pass
+            with open(path) as f:
+                _url_secret_cache = f.read().strip().encode('utf-8')
+    return _url_secret_cache
+
+def sign_local_url(method, object_name, expires):
+    message = f"{method.upper()}\n{object_name}\n{expires}".encode('utf-8')
+    digest = hmac.new(_url_secret(), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+def verify_local_url(method, object_name, expires, signature, now=None):
+    """True if the URL was signed for this method and object and has not expired."""
+    if not URL_SIGNING:
+        return True
+    try:
+        if int(expires) < (now or time.time()):
+            return False
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(sign_local_url(method, object_name, expires), signature or '')
+
+def _signed_local_url(host_url, object_name, method, expiration):
+    url = f"{host_url}/local-store/{quote(object_name)}"
+    if not URL_SIGNING:
+        return url
+    expires = int(time.time()) + expiration
+    return f"{url}?{urlencode({'expires': expires, 'sig': sign_local_url(method, object_name, expires)})}"
 
-def generate_local_download_url(host_url, object_name):
-    # Returns a URL that the frontend can GET.
-    # We need a route in api_server: GET /local-store/<object_name>
-    return f"{host_url}/local-store/{object_name}"
+def generate_local_upload_url(host_url, object_name, expiration=3600):
+    # Signed like an S3 presigned PUT: only valid for PUT of this object until it expires.
+    # Served by api_server: PUT /local-store/<object_name>
+    return _signed_local_url(host_url, object_name, 'PUT', expiration)
+
+def generate_local_download_url(host_url, object_name, expiration=3600):
+    # Served by api_server: GET /local-store/<object_name> (or by the front proxy, see SENDFILE_MODE)
+    return _signed_local_url(host_url, object_name, 'GET', expiration)
+
+def object_path(object_name, root=None, levels=None):
+    """Where an object lives under root (IMAGES_DIR by default) for a fan-out depth."""
+    root = IMAGES_DIR if root is None else root
+    levels = FANOUT_LEVELS if levels is None else levels
+    if not levels:
+        return os.path.join(root, object_name)
+    digest = f"{zlib.crc32(object_name.encode('utf-8')):08x}"
+    return os.path.join(root, *(digest[2 * i:2 * i + 2] for i in range(levels)), object_name)
+
+def _locate(object_name, root=None, suffix=''):
+    """Current path of an object in any fan-out layout, or None. One stat on the common path."""
+    primary = object_path(object_name, root) + suffix
+    if os.path.exists(primary):
+        return primary
+    for levels in range(MAX_FANOUT_LEVELS + 1):
+        if levels != FANOUT_LEVELS:
+            candidate = object_path(object_name, root, levels) + suffix
+            if os.path.exists(candidate):
+                return candidate
+    # The migration renames files into the primary layout; it may have done so
+    # between the first check and the fallbacks
+    return primary if os.path.exists(primary) else None
+
+def _ensure_parent(path):
+    if FANOUT_LEVELS:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+def iter_object_files(root=None):
+    """DirEntry for every stored file under root (IMAGES_DIR by default), in any layout."""
+    stack = [IMAGES_DIR if root is None else root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and '.tmp.' not in entry.name:
+                        yield entry
+        except FileNotFoundError:
+            continue
 
 def save_file_content(object_name, content_bytes):
-    path = os.path.join(IMAGES_DIR, object_name)
+    path = object_path(object_name)
+    _ensure_parent(path)
     with open(path, 'wb') as f:
         f.write(content_bytes)
     return True
 
+def save_file_stream(object_name, fileobj):
+    """
+    Copy a readable stream into the store without holding it in memory (bulk import).
+    Written to a temp file and renamed, so a crash never leaves a truncated object.
+    """
+    path = object_path(object_name)
+    _ensure_parent(path)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, 1024 * 1024)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
 def get_file_content(object_name):
-    path = os.path.join(IMAGES_DIR, object_name)
-    if os.path.exists(path):
+    path = _locate(object_name)
+    if path:
         return path # Return path for send_file
+    # Cold objects are transparently rehydrated on first access
+    if rehydrate_file(object_name):
+        return _locate(object_name)
     return None
 
+def read_range(object_name, start, length):
+    """
+    (bytes at [start, start + length), object size) or None if missing. Cold
+    objects are read in place (decompressing only up to the range), not rehydrated.
+    """
+    path = _locate(object_name)
+    if path:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return f.read(length), os.fstat(f.fileno()).st_size
+        except FileNotFoundError:
+            pass  # archived or deleted meanwhile
+    archived = _locate(object_name, ARCHIVE_DIR, '.gz')
+    if archived is None:
+        return None
+    try:
+        with open(archived, 'rb') as raw:
+            # The gzip trailer ends with the uncompressed size (mod 2**32)
+            raw.seek(-4, os.SEEK_END)
+            size = int.from_bytes(raw.read(4), 'little')
+            raw.seek(0)
+            with gzip.GzipFile(fileobj=raw) as f:
+                f.seek(start)
+                return f.read(length), size
+    except FileNotFoundError:
+        return None
+
 def delete_file(object_name):
-    path = os.path.join(IMAGES_DIR, object_name)
-    if os.path.exists(path):
-        os.remove(path)
+    deleted = False
+    for root, suffix in ((IMAGES_DIR, ''), (ARCHIVE_DIR, '.gz')):
+        # Loop: a copy may exist in more than one layout (e.g. re-uploaded mid-migration)
+        path = _locate(object_name, root, suffix)
+        while path:
+            try:
+                os.remove(path)
+                deleted = True
+            except FileNotFoundError:
+                pass
+            path = _locate(object_name, root, suffix)
+    marker = _locate(object_name, ACCESS_DIR)
+    while marker:
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+        marker = _locate(object_name, ACCESS_DIR)
+    return deleted
+
+# --- Tiering (hot: IMAGES_DIR, cold: gzip in ARCHIVE_DIR) ---
+
+def _archive_path(object_name):
+    return object_path(object_name, ARCHIVE_DIR) + '.gz'
+
+def touch_file(object_name, min_interval=0):
+    """
+    Record a download in the object's access marker, unless it was recorded less
+    than min_interval seconds ago. Returns True if the marker was written.
+    """
+    if _locate(object_name) is None and _locate(object_name, ARCHIVE_DIR, '.gz') is None:
+        return False
+    marker = _locate(object_name, ACCESS_DIR)
+    now = time.time()
+    try:
+        if marker is None:
+            marker = object_path(object_name, ACCESS_DIR)
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            open(marker, 'a').close()
+        elif os.stat(marker).st_mtime >= now - min_interval:
+            return False
+        os.utime(marker, (now, now))
         return True
-    return False
+    except FileNotFoundError:
+        return False  # the object was deleted meanwhile
+
+def last_access(object_name):
+    """Epoch seconds of the last recorded download, or None if there is none."""
+    marker = _locate(object_name, ACCESS_DIR)
+    try:
+        return os.stat(marker).st_mtime if marker else None
+    except FileNotFoundError:
+        return None
+
+def archive_file(object_name):
+    """Move a hot object into the compressed cold tier. Returns bytes (hot, cold) or None."""
+    path = _locate(object_name)
+    if path is None:
+        return None
+    archived = _archive_path(object_name)
+    os.makedirs(os.path.dirname(archived), exist_ok=True)
+    tmp_path = f"{archived}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        hot_size = os.path.getsize(path)
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, archived)
+    except FileNotFoundError:
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    os.remove(path)
+    return hot_size, os.path.getsize(archived)
+
+def rehydrate_file(object_name):
+    """Restore a cold object into the hot tier. Returns False if it is not archived."""
+    path = object_path(object_name)
+    archived = _locate(object_name, ARCHIVE_DIR, '.gz')
+    if archived is None:
+        return _locate(object_name) is not None  # lost a race with a concurrent rehydration
+    _ensure_parent(path)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with gzip.open(archived, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, path)
+    except FileNotFoundError:
+        return _locate(object_name) is not None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    try:
+        os.remove(archived)
+    except FileNotFoundError:
+        pass
+    return True
 
 # --- DynamoDB Mimic ---
 
 def save_metadata(item):
-    data = _load_db()
-    # Remove existing if any (upsert)
-    data = [i for i in data if not (i['user_id'] == item['user_id'] and i['image_id'] == item['image_id'])]
-    data.append(item)
-    _save_db(data)
-    return True
+    record = records.Record.from_dict(item)
+    def apply(index):
+        user_items = dict(index.get(record.user_id, {}))
+        user_items[record.image_id] = record  # upsert
+        index[record.user_id] = user_items
+        return True
+    return _mutate(_path_for_user(record.user_id), apply)
 
-def query_images(user_id=None, tag=None):
-    data = _load_db()
-    results = data
-    if not user_id:
-        return []
+def save_many(items):
+    """Bulk upsert (imports): one rewrite per shard instead of one per item. Returns the count."""
+    by_path = {}
+    for item in items:
+        record = records.Record.from_dict(item)
+        by_path.setdefault(_path_for_user(record.user_id), []).append(record)
+
+    def upsert(batch):
+        def apply(index):
+            copied = set()
+            for record in batch:
+                if record.user_id not in copied:
+                    index[record.user_id] = dict(index.get(record.user_id, {}))
+                    copied.add(record.user_id)
+                index[record.user_id][record.image_id] = record
+            return True
+        return apply
+
+    for path, batch in by_path.items():
+        _mutate(path, upsert(batch))
+    return sum(len(batch) for batch in by_path.values())
+
+def update_attributes(user_id, image_id, attributes):
+    """Merge attributes into an existing item; False if the item does not exist."""
+    def apply(index):
+        current = index.get(user_id, {}).get(image_id)
+        if current is None:
+            return False
+        user_items = dict(index[user_id])
+        user_items[image_id] = records.Record.from_dict(dict(current.to_dict(), **attributes))
+        index[user_id] = user_items
+        return True
+    return _mutate(_path_for_user(user_id), apply)
+
+def get_metadata(user_id, image_id):
+    record = _load_index(_path_for_user(user_id)).get(user_id, {}).get(image_id)
+    return record.to_dict() if record is not None else None
+
+def get_many(user_id, image_ids):
+    """Items for the given ids (in that order), skipping ids that no longer exist."""
+    user_items = _load_index(_path_for_user(user_id)).get(user_id, {})
+    return [user_items[i].to_dict() for i in image_ids if i in user_items]
+
+def get_tag_postings(user_id, tags):
+    """{tag: sorted image_ids} for one user; every tag in `tags` and the primary tag count."""
+    user_items = _load_index(_path_for_user(user_id)).get(user_id, {})
+    with _postings_lock:
+        cached = _postings_cache.get(user_id)
+        if cached and cached[0] is user_items:
+            _postings_cache.move_to_end(user_id)
+    if cached and cached[0] is user_items:
+        postings = cached[1]
+    else:
+        postings = {}
+        for image_id in sorted(user_items):
+            record = user_items[image_id]
+            item_tags = set(record.get('tags') or [])
+            if record.get('tag'):
+                item_tags.add(record.tag)
+            for tag in item_tags:
+                postings.setdefault(tag, []).append(image_id)
+        with _postings_lock:
+            _postings_cache[user_id] = (user_items, postings)
+            if len(_postings_cache) > POSTINGS_CACHE_USERS:
+                _postings_cache.popitem(last=False)
+    return {tag: postings.get(tag, []) for tag in tags}
+
+def _project(item, fields):
+    # Mirrors DynamoDB ProjectionExpression: missing attributes are simply omitted
+    return {k: item[k] for k in fields if k in item}
+
+def _matching_records(user_id=None, tag=None, start_date=None, end_date=None):
+    ranges = ids.key_ranges(start_date, end_date)
     if user_id:
-        results = [i for i in results if i.get('user_id') == user_id]
-    if tag:
-        results = [i for i in results if tag in i.get('tags', []) or i.get('tag') == tag]
+        user_items = _load_index(_path_for_user(user_id)).get(user_id, {})
+        results = [user_items[image_id] for image_id in sorted(user_items)]
+        if tag:
+            results = [r for r in results if r.has_tag(tag)]
+    elif tag:
+        results = sorted((r for r in _iter_records() if r.tag == tag), key=lambda r: r.image_id)
+    elif ranges is not None:
+        results = sorted(_iter_records(), key=lambda r: r.image_id)
+    else:
+        return []
+    if ranges is not None:
+        results = [r for r in results if ids.in_ranges(r.image_id, ranges)]
     return results
 
+def _materialize(matches, fields):
+    if fields:
+        return [r.project(fields) for r in matches]
+    return [r.to_dict() for r in matches]
+
+def query_images(user_id=None, tag=None, start_date=None, end_date=None, fields=None):
+    """
+    Same semantics as the DynamoDB path in dynamo_utils.query_images:
+    - user_id: the tenant's partition (a single shard), optionally filtered by tag
+    - tag only: like the tag-index GSI, matches the primary tag across tenants
+    - date range only: filtered scan; no filters at all returns []
+    Results are ordered by image_id, the sort key.
+    """
+    # Only the matching records are materialized as dicts
+    return _materialize(_matching_records(user_id, tag, start_date, end_date), fields)
+
+def iter_image_pages(user_id=None, tag=None, start_date=None, end_date=None, fields=None, page_size=1000):
+    """query_images in pages of page_size dicts, each built only when the consumer asks for it."""
+    results = _matching_records(user_id, tag, start_date, end_date)
+    for start in range(0, len(results), page_size):
+        yield _materialize(results[start:start + page_size], fields)
+
 def delete_metadata(user_id, image_id):
-    data = _load_db()
-    new_data = [i for i in data if not (i['user_id'] == user_id and i['image_id'] == image_id)]
-    if len(new_data) < len(data):
-        _save_db(new_data)
+    def apply(index):
+        if image_id not in index.get(user_id, {}):
+            return False
+        user_items = dict(index[user_id])
+        del user_items[image_id]
+        if user_items:
+            index[user_id] = user_items
+        else:
+            del index[user_id]
         return True
-    return False
+    return _mutate(_path_for_user(user_id), apply)
+
+def _iter_records():
+    for path in _all_paths():
+        for user_items in _load_index(path).values():
+            yield from user_items.values()
+
+def iter_all_metadata():
+    """Yield every metadata item across all shards (maintenance jobs only)."""
+    for record in _iter_records():
+        yield record.to_dict()
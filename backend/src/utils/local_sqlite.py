@@ -0,0 +1,201 @@
+"""
+SQLite metadata engine for USE_LOCAL_STORAGE installs (LOCAL_DB_ENGINE=sqlite).
+
+Drop-in alternative to the JSON files in local_adapter with the same function
+signatures. Items are stored as JSON documents next to their key columns:
+- images:      PRIMARY KEY (user_id, image_id), index on (tag, image_id) for the
+               tag-index GSI equivalent
+- image_tags:  one row per (tag, image_id, user_id) so multi-tag items are found
+               through an index instead of by decoding every row
+"""
+import os
+import json
+import sqlite3
+import threading
+import logging
+
+from src.utils import ids, local_adapter
+
+logger = logging.getLogger()
+
+DB_FILE = os.environ.get('LOCAL_SQLITE_PATH') or os.path.join(local_adapter.STORAGE_DIR, 'metadata.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    user_id  TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    tag      TEXT,
+    item     TEXT NOT NULL,
+    PRIMARY KEY (user_id, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_images_tag ON images (tag, image_id);
+
+CREATE TABLE IF NOT EXISTS image_tags (
+    tag      TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    user_id  TEXT NOT NULL,
+    PRIMARY KEY (tag, image_id, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_image_tags_owner ON image_tags (user_id, image_id);
+CREATE INDEX IF NOT EXISTS idx_image_tags_postings ON image_tags (user_id, tag, image_id);
+"""
+
+# Statements are module constants with ? placeholders: sqlite3 keeps a per-connection
+# cache of compiled statements keyed by SQL text, so these are prepared once per thread.
+_UPSERT_ITEM = "INSERT OR REPLACE INTO images (user_id, image_id, tag, item) VALUES (?, ?, ?, ?)"
+_DELETE_ITEM = "DELETE FROM images WHERE user_id = ? AND image_id = ?"
+_INSERT_TAG = "INSERT OR IGNORE INTO image_tags (tag, image_id, user_id) VALUES (?, ?, ?)"
+_DELETE_TAGS = "DELETE FROM image_tags WHERE user_id = ? AND image_id = ?"
+
+_GET_ITEM = "SELECT item FROM images WHERE user_id = ? AND image_id = ?"
+_POSTINGS = "SELECT image_id FROM image_tags WHERE user_id = ? AND tag = ? ORDER BY image_id"
+_BY_USER = "SELECT item FROM images WHERE user_id = ? ORDER BY image_id"
+_BY_USER_RANGE = "SELECT item FROM images WHERE user_id = ? AND image_id BETWEEN ? AND ? ORDER BY image_id"
+_BY_USER_TAG = (
+    "SELECT i.item FROM image_tags t JOIN images i ON i.user_id = t.user_id AND i.image_id = t.image_id "
+    "WHERE t.tag = ? AND t.user_id = ? ORDER BY t.image_id"
+)
+_BY_USER_TAG_RANGE = (
+    "SELECT i.item FROM image_tags t JOIN images i ON i.user_id = t.user_id AND i.image_id = t.image_id "
+    "WHERE t.tag = ? AND t.user_id = ? AND t.image_id BETWEEN ? AND ? ORDER BY t.image_id"
+)
+_BY_TAG = "SELECT item FROM images WHERE tag = ? ORDER BY image_id"
+_BY_TAG_RANGE = "SELECT item FROM images WHERE tag = ? AND image_id BETWEEN ? AND ? ORDER BY image_id"
+_BY_RANGE = "SELECT item FROM images WHERE image_id BETWEEN ? AND ? ORDER BY image_id"
+_ALL = "SELECT item FROM images"
+
+# Connection pool: one connection per (thread, database file)
+_local = threading.local()
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+def get_connection():
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(DB_FILE)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with _schema_lock:
+            if DB_FILE not in _schema_ready:
+                conn.executescript(_SCHEMA)
+                _schema_ready.add(DB_FILE)
+        connections[DB_FILE] = conn
+    return conn
+
+def _item_tags(item):
+    tags = set(item.get('tags') or [])
+    if item.get('tag'):
+        tags.add(item['tag'])
+    return tags
+
+def _write_item(conn, item):
+    user_id, image_id = item['user_id'], item['image_id']
+    conn.execute(_UPSERT_ITEM, (user_id, image_id, item.get('tag'), json.dumps(item)))
+    conn.execute(_DELETE_TAGS, (user_id, image_id))
+    conn.executemany(_INSERT_TAG, [(tag, image_id, user_id) for tag in _item_tags(item)])
+
+def save_metadata(item):
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        _write_item(conn, item)
+    return True
+
+def save_many(items):
+    """Bulk upsert in a single transaction (migrations and imports)."""
+    conn = get_connection()
+    count = 0
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for item in items:
+            _write_item(conn, item)
+            count += 1
+    return count
+
+def update_attributes(user_id, image_id, attributes):
+    """Merge attributes into an existing item; False if the item does not exist."""
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(_GET_ITEM, (user_id, image_id)).fetchone()
+        if not row:
+            return False
+        _write_item(conn, dict(json.loads(row[0]), **attributes))
+    return True
+
+def get_metadata(user_id, image_id):
+    row = get_connection().execute(_GET_ITEM, (user_id, image_id)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def get_many(user_id, image_ids):
+    """Items for the given ids (in that order); point lookups reuse one prepared statement."""
+    conn = get_connection()
+    results = []
+    for image_id in image_ids:
+        row = conn.execute(_GET_ITEM, (user_id, image_id)).fetchone()
+        if row:
+            results.append(json.loads(row[0]))
+    return results
+
+def get_tag_postings(user_id, tags):
+    """{tag: sorted image_ids} for one user, read from the (user_id, tag, image_id) index."""
+    conn = get_connection()
+    return {tag: [row[0] for row in conn.execute(_POSTINGS, (user_id, tag))] for tag in tags}
+
+def _query_cursors(user_id=None, tag=None, start_date=None, end_date=None):
+    ranges = ids.key_ranges(start_date, end_date)
+    if user_id and tag:
+        sql, params = (_BY_USER_TAG_RANGE, (tag, user_id)) if ranges is not None else (_BY_USER_TAG, (tag, user_id))
+    elif user_id:
+        sql, params = (_BY_USER_RANGE, (user_id,)) if ranges is not None else (_BY_USER, (user_id,))
+    elif tag:
+        sql, params = (_BY_TAG_RANGE, (tag,)) if ranges is not None else (_BY_TAG, (tag,))
+    elif ranges is not None:
+        sql, params = _BY_RANGE, ()
+    else:
+        return
+
+    conn = get_connection()
+    if ranges is None:
+        yield conn.execute(sql, params)
+    else:
+        # One indexed range scan per id scheme; the ranges are ordered, so results stay sorted
+        for lo, hi in ranges:
+            yield conn.execute(sql, params + (lo, hi))
+
+def _decode_rows(rows, fields):
+    results = [json.loads(row[0]) for row in rows]
+    if fields:
+        results = [local_adapter._project(i, fields) for i in results]
+    return results
+
+def query_images(user_id=None, tag=None, start_date=None, end_date=None, fields=None):
+    """Same semantics and ordering as local_adapter.query_images / the DynamoDB path."""
+    rows = [row for cursor in _query_cursors(user_id, tag, start_date, end_date) for row in cursor]
+    return _decode_rows(rows, fields)
+
+def iter_image_pages(user_id=None, tag=None, start_date=None, end_date=None, fields=None, page_size=1000):
+    """query_images in pages, read from the cursor with fetchmany so only one page is in memory."""
+    for cursor in _query_cursors(user_id, tag, start_date, end_date):
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield _decode_rows(rows, fields)
+
+def delete_metadata(user_id, image_id):
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        deleted = conn.execute(_DELETE_ITEM, (user_id, image_id)).rowcount
+        conn.execute(_DELETE_TAGS, (user_id, image_id))
+    return deleted > 0
+
+def iter_all_metadata():
+    """Yield every metadata item (maintenance jobs only)."""
+    for row in get_connection().execute(_ALL):
+        yield json.loads(row[0])
@@ -0,0 +1,87 @@
+"""
+Sorted posting lists (image_ids per tag) and the set operations over them.
+
+Posting lists are ascending by image_id, which is time-ordered, so results come out
+in the same order as a DynamoDB query and can be paginated with an image_id cursor.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+def gallop(seq, target, lo=0):
+    """Index of the first element >= target in seq[lo:], via exponential then binary search."""
+    n = len(seq)
+    if lo >= n or seq[lo] >= target:
+        return lo
+    step = 1
+    hi = lo + 1
+    while hi < n and seq[hi] < target:
+        lo = hi
+        step *= 2
+        hi = lo + step
+    return bisect_left(seq, target, lo + 1, min(hi, n))
+
+def intersect(lists):
+    """
+    Yield values present in every list, in order. Drives from the smallest list and
+    gallops through the others, so cost is ~ len(smallest) * log(gap), not sum(len).
+    """
+    if not lists:
+        return
+    lists = sorted(lists, key=len)
+    smallest, others = lists[0], lists[1:]
+    positions = [0] * len(others)
+    for candidate in smallest:
+        for k, seq in enumerate(others):
+            pos = positions[k] = gallop(seq, candidate, positions[k])
+            if pos == len(seq):
+                return
+            if seq[pos] != candidate:
+                break
+        else:
+            yield candidate
+
+def union(lists):
+    """Yield values present in any list, in order, without duplicates."""
+    last = None
+    for value in heapq.merge(*lists):
+        if value != last:
+            yield value
+            last = value
+
+def clip(seq, start=None, end=None, after=None):
+    """Restrict a sorted list to [start, end] and to values strictly after the cursor."""
+    lo = 0
+    hi = len(seq)
+    if start:
+        lo = bisect_left(seq, start)
+    if after:
+        lo = max(lo, bisect_right(seq, after))
+    if end:
+        hi = bisect_right(seq, end)
+    return seq[lo:hi] if (lo, hi) != (0, len(seq)) else seq
+
+def clip_ranges(seq, ranges, after=None):
+    """clip() to several ordered, disjoint [low, high] ranges (see ids.key_ranges)."""
+    if len(ranges) == 1:
+        return clip(seq, ranges[0][0], ranges[0][1], after)
+    return [value for lo, hi in ranges for value in clip(seq, lo, hi, after)]
+
+def evaluate(posting_lists, mode='all', start=None, end=None, after=None, limit=None, ranges=None):
+    """
+    Combine posting lists (mode 'all' = AND, 'any' = OR) and return one page:
+    (image_ids, next_cursor), where next_cursor is None on the last page.
+    ranges, if given, replaces start/end with several image_id ranges.
+    """
+    if ranges is None:
+        lists = [clip(seq, start, end, after) for seq in posting_lists]
+    else:
+        lists = [clip_ranges(seq, ranges, after) for seq in posting_lists]
+    matches = intersect(lists) if mode == 'all' else union(lists)
+    if not limit:
+        return list(matches), None
+    page = list(islice(matches, limit + 1))
+    if len(page) > limit:
+        page = page[:limit]
+        return page, page[-1]
+    return page, None
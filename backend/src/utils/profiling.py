@@ -0,0 +1,321 @@
+"""
+Opt-in sampling profiler for handlers and for the api_server process.
+
+Per request: a handler wrapped with @profiled(route) is profiled when
+- the request carries `X-Profile-Token: <PROFILE_TOKEN>` (always written), or
+- it falls in the random PROFILE_SAMPLE_RATE fraction (written only if it took
+  at least PROFILE_MIN_MS, so the files are the slow requests).
+A background thread samples the handler's thread every PROFILE_INTERVAL_MS
+(sys._current_frames, no tracing), so the handler itself runs at full speed.
+Streamed responses are profiled until the stream is finished. The result goes to
+PROFILE_DIR as <time>_<route>_<ms>ms_<pid>.collapsed (one "a;b;c count" line per
+stack, for flamegraph.pl or speedscope), or as a speedscope JSON file with
+PROFILE_FORMAT=speedscope. At most PROFILE_MAX_CONCURRENT captures run at once,
+and the oldest files are pruned beyond PROFILE_MAX_FILES.
+
+Continuous: PROFILE_CONTINUOUS_HZ > 0 samples every thread of the process at
+that rate (keep it low, e.g. 19) and writes <time>_continuous_<ms>ms_<pid>.collapsed
+every PROFILE_FLUSH_SECONDS. Stacks are rooted at the thread name.
+"""
+import os
+import re
+import sys
+import json
+import hmac
+import time
+import random
+import logging
+import datetime
+import functools
+import threading
+from collections import Counter
+
+from src.utils import common, local_adapter
+
+logger = logging.getLogger()
+
+TOKEN = os.environ.get('PROFILE_TOKEN', '')
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+MIN_MS = float(os.environ.get('PROFILE_MIN_MS', '0'))
+INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+FORMAT = os.environ.get('PROFILE_FORMAT', 'collapsed').lower()
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(local_adapter.STORAGE_DIR, 'profiles')
+MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '200'))
+MAX_CONCURRENT = int(os.environ.get('PROFILE_MAX_CONCURRENT', '2'))
+CONTINUOUS_HZ = float(os.environ.get('PROFILE_CONTINUOUS_HZ', '0'))
+FLUSH_SECONDS = float(os.environ.get('PROFILE_FLUSH_SECONDS', '60'))
+TOKEN_HEADER = 'X-Profile-Token'
+
+_captures = threading.BoundedSemaphore(max(MAX_CONCURRENT, 1))
+_stats_lock = threading.Lock()
+_stats = {'captures': 0, 'requested': 0, 'sampled': 0, 'below_min_ms': 0, 'busy': 0, 'continuous_samples': 0}
+_continuous = None
+
+def _count(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+# --- Sampling ---
+
+_frame_names = {}  # code object -> "name (file:line)", built once per function
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = _frame_names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+def _stack(frame, root=None):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    if root:
+        names.append(root)
+    names.reverse()
+    return ';'.join(names)
+
+class Sampler:
+    """Samples the stacks of one thread (thread_id) or of every other thread (None) until stopped."""
+
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.counts = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frame = frames.get(self.thread_id)
+                stacks = [_stack(frame)] if frame is not None else []
+            else:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                stacks = [_stack(frame, names.get(ident, str(ident)))
+                          for ident, frame in frames.items() if ident != own]
+            if self._stop.is_set():
+                break  # the target is already in stop(), waiting for this thread: not its own work
+            with self._lock:
+                self.counts.update(stacks)
+                self.samples += len(stacks)
+
+    def drain(self):
+        """Counts so far, starting a new aggregate."""
+        with self._lock:
+            counts, self.counts = self.counts, Counter()
+            return counts
+
+# --- Output ---
+
+def to_collapsed(counts):
+    return ''.join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def to_speedscope(counts, name, interval_ms, duration_ms):
+    frames, index, samples, weights = [], {}, [], []
+    for stack, n in counts.most_common():
+        ids = []
+        for frame in stack.split(';'):
+            if frame not in index:
+                index[frame] = len(frames)
+                frames.append({'name': frame})
+            ids.append(index[frame])
+        samples.append(ids)
+        weights.append(n * interval_ms)
+    return json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'shared': {'frames': frames},
+        'profiles': [{'type': 'sampled', 'name': name, 'unit': 'milliseconds', 'startValue': 0,
+                      'endValue': max(duration_ms, sum(weights)), 'samples': samples, 'weights': weights}],
+    })
+
+def _slug(route):
+    # "GET /images/search" -> "get-images-search"
+    return re.sub(r'[^a-z0-9]+', '-', route.lower()).strip('-') or 'request'
+
+def write_profile(counts, route, duration_ms, interval_ms, fmt=None):
+    """Persist one capture under PROFILE_DIR; returns its path (None if it could not be written)."""
+    fmt = fmt or FORMAT
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')
+    if fmt == 'speedscope':
+        name, data = '.speedscope.json', to_speedscope(counts, f"{route} {duration_ms:.0f}ms", interval_ms, duration_ms)
+    else:
+        name, data = '.collapsed', to_collapsed(counts)
+    path = os.path.join(PROFILE_DIR, f"{stamp}_{_slug(route)}_{duration_ms:.0f}ms_{os.getpid()}{name}")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+        _prune()
+    except OSError as e:
+        logger.error(f"Failed to write profile {path}: {e}")
+        return None
+    _count('captures')
+    return path
+
+def _prune():
+    # Names start with a UTC timestamp, so the oldest sort first
+    names = sorted(os.listdir(PROFILE_DIR))
+    for name in names[:max(len(names) - MAX_FILES, 0)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+# --- Per request ---
+
+def _should_profile(event):
+    """'requested', 'sampled' or None."""
+    token = common.get_header(event, TOKEN_HEADER) if isinstance(event, dict) else None
+    if TOKEN and token and hmac.compare_digest(token, TOKEN):
+        return 'requested'
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        return 'sampled'
+    return None
+
+class _Capture:
+    def __init__(self, route, reason):
+        self.route = route
+        self.reason = reason
+        self.started = time.perf_counter()
+        self.sampler = Sampler(INTERVAL_MS / 1000.0, threading.get_ident()).start()
+
+    def finish(self):
+        try:
+            self.sampler.stop()
+            duration_ms = (time.perf_counter() - self.started) * 1000
+            if self.reason == 'sampled' and duration_ms < MIN_MS:
+                _count('below_min_ms')
+                return None
+            path = write_profile(self.sampler.counts, self.route, duration_ms, INTERVAL_MS)
+            if path:
+                logger.info(f"Profiled {self.route} ({self.reason}): {duration_ms:.0f} ms, "
+                            f"{self.sampler.samples} samples -> {path}")
+            return path
+        finally:
+            _captures.release()
+
+class _ProfiledStream:
+    """A streamed body that keeps its capture running until it is exhausted or closed."""
+
+    def __init__(self, stream, capture):
+        self._stream = iter(stream)
+        self._capture = capture
+        self._started = self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._started:
+            # Iterated by the WSGI worker, maybe not the thread that ran the handler
+            self._capture.sampler.thread_id = threading.get_ident()
+            self._started = True
+        try:
+            return next(self._stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        # The server calls close() even when the client went away before the first chunk
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._stream, 'close'):
+                self._stream.close()
+        finally:
+            self._capture.finish()
+
+def profiled(route):
+    """Decorator for an (event, context) handler: see the module docstring for when it profiles."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            reason = _should_profile(event)
+            if reason is None:
+                return handler(event, context)
+            if not _captures.acquire(blocking=False):
+                _count('busy')
+                return handler(event, context)
+            _count(reason)
+            capture = _Capture(route, reason)
+            try:
+                response = handler(event, context)
+            except BaseException:
+                capture.finish()
+                raise
+            if isinstance(response, dict) and 'stream' in response:
+                response['stream'] = _ProfiledStream(response['stream'], capture)
+                return response
+            path = capture.finish()
+            if path and reason == 'requested' and isinstance(response, dict):
+                response.setdefault('headers', {})['X-Profile'] = os.path.basename(path)
+            return response
+        return wrapper
+    return decorate
+
+# --- Continuous ---
+
+class _Continuous:
+    def __init__(self, hz, flush_seconds):
+        self.hz = hz
+        self.sampler = Sampler(1.0 / hz).start()
+        self.flush_seconds = flush_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        counts = self.sampler.drain()
+        if not counts:
+            return None
+        _count('continuous_samples', sum(counts.values()))
+        return write_profile(counts, 'continuous', self.flush_seconds * 1000, 1000.0 / self.hz, fmt='collapsed')
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sampler.stop()
+        return self.flush()
+
+def start_continuous(hz=None, flush_seconds=None):
+    """Start process-wide sampling (once); a no-op unless hz (or PROFILE_CONTINUOUS_HZ) is positive."""
+    global _continuous
+    hz = CONTINUOUS_HZ if hz is None else hz
+    if hz <= 0 or _continuous is not None:
+        return _continuous
+    _continuous = _Continuous(hz, FLUSH_SECONDS if flush_seconds is None else flush_seconds)
+    logger.info(f"Continuous profiling at {hz} Hz, flushed every {_continuous.flush_seconds}s to {PROFILE_DIR}")
+    return _continuous
+
+def stop_continuous():
+    """Stop process-wide sampling and write what is left; returns that file's path."""
+    global _continuous
+    if _continuous is None:
+        return None
+    continuous, _continuous = _continuous, None
+    return continuous.stop()
+
+def stats():
+    with _stats_lock:
+        return dict(_stats, continuous=_continuous is not None, sample_rate=SAMPLE_RATE)
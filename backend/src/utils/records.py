@@ -0,0 +1,203 @@
+"""
+Compact in-memory metadata records for the local JSON engine.
+
+A parsed item is a dict of ~11 entries with its own copy of every string: the
+ISO timestamps, content type, tags and an s3_key that repeats image_id.
+Record keeps the same data in fixed slots instead:
+- the known attributes live in __slots__, with no per-item key table
+- tags (a tuple), the primary tag, content type, camera and user_id are interned, so
+  each distinct value is stored once per process
+- upload_time / created_at / enriched_at are int epoch microseconds (converted back only
+  when the exact ISO string round-trips, so nothing is reformatted)
+- s3_key is not stored when it equals image_id
+- unknown attributes go into a small `extra` dict
+
+Records are never modified in place; writes build a new one, as the index is
+copy-on-write. They are turned back into plain dicts (to_dict / project) at
+the response boundary, so callers can still modify what they get back.
+`python -m src.jobs.bench_local_memory` measures bytes per item for both.
+"""
+import sys
+import datetime
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+class _Marker:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+_ABSENT = _Marker('<absent>')           # attribute not present on the item
+_SAME_AS_IMAGE_ID = _Marker('<image_id>')  # s3_key == image_id
+
+FIELDS = ('user_id', 'image_id', 'tag', 'tags', 'description', 'content_type', 'file_size',
+          's3_key', 'upload_time', 'created_at', 'original_filename', 'phash', 'sha256',
+          'width', 'height', 'taken_at', 'camera', 'enriched_at')
+TIMESTAMP_FIELDS = ('upload_time', 'created_at', 'enriched_at')
+_FIELD_SET = frozenset(FIELDS)
+# Fields stored as given, in FIELDS order around the encoded ones (tags, s3_key, timestamps)
+_PLAIN_HEAD = ('user_id', 'image_id', 'tag')
+_PLAIN_MIDDLE = ('description', 'content_type', 'file_size')
+_PLAIN_TAIL = ('original_filename', 'phash', 'sha256', 'width', 'height', 'taken_at', 'camera')
+
+def encode_timestamp(value):
+    """'2025-01-01T10:00:00.123456Z' -> epoch microseconds, or the value itself if it would not round-trip."""
+    if not isinstance(value, str):
+        return (value,)  # kept verbatim; an int here would read back as a timestamp
+    if not value.endswith('Z'):
+        return value
+    try:
+        parsed = datetime.datetime.fromisoformat(value[:-1])
+    except ValueError:
+        return value
+    if parsed.tzinfo is not None:
+        return value
+    micros = (parsed - _EPOCH) // _MICROSECOND
+    return micros if decode_timestamp(micros) == value else value
+
+def decode_timestamp(value):
+    if type(value) is int:
+        return (_EPOCH + _MICROSECOND * value).isoformat() + 'Z'
+    if type(value) is tuple:
+        return value[0]
+    return value
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+class Record:
+    __slots__ = FIELDS + ('extra',)
+
+    @classmethod
+    def from_dict(cls, item):
+        # Unrolled rather than looping over FIELDS: this runs once per item on every shard load
+        record = cls.__new__(cls)
+        get = item.get
+        image_id = get('image_id', _ABSENT)
+        record.user_id = _intern(get('user_id', _ABSENT))
+        record.image_id = image_id
+        record.tag = _intern(get('tag', _ABSENT))
+        tags = get('tags', _ABSENT)
+        if type(tags) is list and all(type(t) is str for t in tags):
+            tags = tuple(map(sys.intern, tags))
+        record.tags = tags
+        record.description = get('description', _ABSENT)
+        record.content_type = _intern(get('content_type', _ABSENT))
+        record.file_size = get('file_size', _ABSENT)
+        s3_key = get('s3_key', _ABSENT)
+        record.s3_key = _SAME_AS_IMAGE_ID if s3_key == image_id and s3_key is not _ABSENT else s3_key
+        upload_time = get('upload_time', _ABSENT)
+        record.upload_time = upload_time if upload_time is _ABSENT else encode_timestamp(upload_time)
+        created_at = get('created_at', _ABSENT)
+        record.created_at = created_at if created_at is _ABSENT else encode_timestamp(created_at)
+        record.original_filename = get('original_filename', _ABSENT)
+        record.phash = get('phash', _ABSENT)
+        record.sha256 = get('sha256', _ABSENT)
+        record.width = get('width', _ABSENT)
+        record.height = get('height', _ABSENT)
+        record.taken_at = get('taken_at', _ABSENT)
+        record.camera = _intern(get('camera', _ABSENT))
+        enriched_at = get('enriched_at', _ABSENT)
+        record.enriched_at = enriched_at if enriched_at is _ABSENT else encode_timestamp(enriched_at)
+        extra = None
+        if len(item) > len(FIELDS) or not _FIELD_SET.issuperset(item):
+            extra = {key: value for key, value in item.items() if key not in _FIELD_SET}
+        record.extra = extra or None
+        return record
+
+    def _decoded(self, field):
+        value = getattr(self, field)
+        if value is _ABSENT:
+            return _ABSENT
+        if field == 'tags' and type(value) is tuple:
+            return list(value)
+        if field in TIMESTAMP_FIELDS:
+            return decode_timestamp(value)
+        if value is _SAME_AS_IMAGE_ID:
+            return self.image_id
+        return value
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = self._decoded(key)
+            return default if value is _ABSENT else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def __getitem__(self, key):
+        value = self.get(key, _ABSENT)
+        if value is _ABSENT:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _ABSENT) is not _ABSENT
+
+    def has_tag(self, tag):
+        """Primary tag or tag list contains `tag`, without building a list."""
+        tags = self.tags
+        return self.tag == tag or (tags is not _ABSENT and tags is not None and tag in tags)
+
+    def to_dict(self):
+        # Unrolled like from_dict: shard saves serialize every item through here
+        item = {}
+        for field in _PLAIN_HEAD:
+            value = getattr(self, field)
+            if value is not _ABSENT:
+                item[field] = value
+        tags = self.tags
+        if tags is not _ABSENT:
+            item['tags'] = list(tags) if type(tags) is tuple else tags
+        for field in _PLAIN_MIDDLE:
+            value = getattr(self, field)
+            if value is not _ABSENT:
+                item[field] = value
+        s3_key = self.s3_key
+        if s3_key is not _ABSENT:
+            item['s3_key'] = self.image_id if s3_key is _SAME_AS_IMAGE_ID else s3_key
+        for field in TIMESTAMP_FIELDS:
+            value = getattr(self, field)
+            if value is not _ABSENT:
+                item[field] = decode_timestamp(value)
+        for field in _PLAIN_TAIL:
+            value = getattr(self, field)
+            if value is not _ABSENT:
+                item[field] = value
+        if self.extra:
+            item.update(self.extra)
+        return item
+
+    def project(self, fields):
+        # Mirrors DynamoDB ProjectionExpression: missing attributes are simply omitted
+        item = {}
+        for field in fields:
+            value = self.get(field, _ABSENT)
+            if value is not _ABSENT:
+                item[field] = value
+        return item
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Record({self.to_dict()!r})"
+
+def object_hook(obj):
+    """json object_hook: build Records straight from the parser, so the dicts never pile up."""
+    if 'user_id' in obj and 'image_id' in obj:
+        return Record.from_dict(obj)
+    return obj
+
+def to_json(obj):
+    """json `default`: write Records as plain objects."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,457 @@
+"""
+Resilience for DynamoDB and S3 calls: timeouts, retries, circuit breaking and hedged reads.
+
+Every client made by dynamo_utils / s3_utils goes through client_config() and
+instrument(), which hook botocore's request events:
+- timeouts: connect/read timeouts per service, plus a deadline per operation
+  (BACKEND_DEADLINES) that bounds the attempts and backoff sleeps together
+- retries: botocore's own retries are turned off. Transient errors (throttling,
+  5xx, timeouts, dropped connections) are retried up to BACKEND_MAX_ATTEMPTS
+  with full-jitter exponential backoff. Each retry spends a token from one
+  process-wide budget that earns RETRY_BUDGET_RATIO tokens per request. During
+  an outage, retries therefore add at most ~10% load instead of multiplying it.
+- circuit breaker: one per service. It opens when at least half of the recent
+  calls failed transiently. While it is open, calls fail at once with a
+  ClientError whose code is 'CircuitOpen', which the existing
+  `except ClientError` paths already handle. After BREAKER_COOLDOWN_SECONDS one
+  probe call is let through to test recovery.
+- hedged reads (HEDGE_READS=on): hedged() sends a duplicate of an idempotent
+  read once the first one has taken longer than the recent p95, and returns
+  whichever answer arrives first. Hedges spend the retry budget too.
+
+Reads that used to turn a backend failure into "no results" raise
+BackendUnavailable instead, and handlers answer 503 with Retry-After.
+
+faults is a fault injector for tests and local chaos runs. It sits in front of
+the real endpoint (or moto), e.g.
+FAULT_INJECTION="dynamodb.Query=throttle@0.3,s3.*=slow:0.5@0.1".
+"""
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from botocore.awsrequest import AWSResponse
+from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError, ReadTimeoutError
+
+logger = logging.getLogger()
+
+CONNECT_TIMEOUT = float(os.environ.get('BACKEND_CONNECT_TIMEOUT', '1'))
+READ_TIMEOUTS = {
+    'dynamodb': float(os.environ.get('DYNAMODB_READ_TIMEOUT', '2')),
+    's3': float(os.environ.get('S3_READ_TIMEOUT', '10')),
+}
+MAX_ATTEMPTS = int(os.environ.get('BACKEND_MAX_ATTEMPTS', '3'))
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2.0
+
+# Seconds an operation may take including retries: "<service>.<Operation>", or "<service>.*"
+_DEFAULT_DEADLINES = {
+    'dynamodb.*': 3.0,
+    'dynamodb.GetItem': 1.5,
+    'dynamodb.BatchWriteItem': 10.0,
+    'dynamodb.Scan': 30.0,
+    's3.*': 10.0,
+    's3.PutObject': 60.0,
+    's3.UploadPart': 120.0,
+    's3.CopyObject': 120.0,
+}
+
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', '0.1'))
+# Retries always allowed per second, so a quiet process can still ride out a blip
+RETRY_BUDGET_MIN_PER_SECOND = float(os.environ.get('RETRY_BUDGET_MIN_PER_SECOND', '5'))
+RETRY_BUDGET_CAPACITY = 100.0
+
+BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '10'))
+BREAKER_FAILURE_RATIO = float(os.environ.get('BREAKER_FAILURE_RATIO', '0.5'))
+BREAKER_COOLDOWN_SECONDS = float(os.environ.get('BREAKER_COOLDOWN_SECONDS', '5'))
+
+HEDGE_READS = os.environ.get('HEDGE_READS', '').lower() in ('1', 'on', 'true', 'yes')
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.005
+_LATENCY_WINDOW = 200
+
+_TRANSIENT_CODES = {
+    'ProvisionedThroughputExceededException', 'ThrottlingException', 'Throttling',
+    'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown', 'RequestThrottled',
+    'InternalServerError', 'InternalError', 'ServiceUnavailable', 'CircuitOpen',
+}
+
+def _parse_deadlines(spec):
+    deadlines = dict(_DEFAULT_DEADLINES)
+    for part in (spec or '').split(','):
+        name, _, seconds = part.strip().partition('=')
+        if name and seconds:
+            deadlines[name] = float(seconds)
+    return deadlines
+
+DEADLINES = _parse_deadlines(os.environ.get('BACKEND_DEADLINES'))
+
+def deadline_for(service, operation):
+    return DEADLINES.get(f'{service}.{operation}', DEADLINES.get(f'{service}.*', 10.0))
+
+class BackendUnavailable(Exception):
+    """A backend read failed for a transient reason (throttled, down, circuit open)."""
+
+    def __init__(self, service, cause=None, retry_after=1):
+        super().__init__(f"{service} unavailable: {cause}")
+        self.service = service
+        self.retry_after = retry_after
+
+def is_transient(error):
+    """True for errors worth retrying or reporting as 503: throttling, 5xx, timeouts, circuit open."""
+    if isinstance(error, HTTPClientError):
+        return True
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return status >= 500 or error.response.get('Error', {}).get('Code') in _TRANSIENT_CODES
+    return False
+
+def raise_if_transient(service, error):
+    """Re-raise a transient ClientError/timeout as BackendUnavailable; return for anything else."""
+    if is_transient(error):
+        retry_after = max(1, int(BREAKER_COOLDOWN_SECONDS)) if _code(error) == 'CircuitOpen' else 1
+        raise BackendUnavailable(service, error, retry_after) from error
+
+def _code(error):
+    return error.response.get('Error', {}).get('Code') if isinstance(error, ClientError) else None
+
+class RetryBudget:
+    """Token bucket shared by all retries and hedges: RATIO tokens per request, 1 per retry."""
+
+    def __init__(self, ratio=None, min_per_second=None, capacity=RETRY_BUDGET_CAPACITY):
+        self.ratio = RETRY_BUDGET_RATIO if ratio is None else ratio
+        self.min_per_second = RETRY_BUDGET_MIN_PER_SECOND if min_per_second is None else min_per_second
+        self.capacity = capacity
+        self.balance = capacity
+        self.exhausted = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self.balance = min(self.capacity, self.balance + (now - self._updated) * self.min_per_second)
+            self._updated = now
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            self.exhausted += 1
+            return False
+
+class CircuitBreaker:
+    """Closed -> open on a high transient failure ratio -> half-open probe after the cooldown."""
+
+    def __init__(self, name, window=None, min_calls=None, failure_ratio=None, cooldown=None):
+        self.name = name
+        self.window = BREAKER_WINDOW if window is None else window
+        self.min_calls = BREAKER_MIN_CALLS if min_calls is None else min_calls
+        self.failure_ratio = BREAKER_FAILURE_RATIO if failure_ratio is None else failure_ratio
+        self.cooldown = BREAKER_COOLDOWN_SECONDS if cooldown is None else cooldown
+        self.state = 'closed'
+        self._outcomes = deque(maxlen=self.window)
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if self.state == 'open' and now - self._opened_at >= self.cooldown:
+                self.state = 'half-open'
+            # One probe at a time; a probe that never reported back is replaced after a cooldown
+            if self.state == 'half-open' and (self._probe_started is None or now - self._probe_started >= self.cooldown):
+                self._probe_started = now
+                return True
+            self.short_circuited += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == 'half-open':
+                if ok:
+                    self.state = 'closed'
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                self._probe_started = None
+                return
+            if self.state == 'open':
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self._outcomes):
+                self._trip()
+
+    def _trip(self):
+        if self.state != 'open':
+            logger.error(f"Circuit for {self.name} opened; failing fast for {self.cooldown}s")
+        self.state = 'open'
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+class _ServiceStats:
+    __slots__ = ('calls', 'retries', 'failures', 'deadline_exceeded')
+
+    def __init__(self):
+        self.calls = self.retries = self.failures = self.deadline_exceeded = 0
+
+budget = RetryBudget()
+breakers = {service: CircuitBreaker(service) for service in READ_TIMEOUTS}
+_stats = {service: _ServiceStats() for service in READ_TIMEOUTS}
+
+def _breaker(service):
+    breaker = breakers.get(service)
+    if breaker is None:
+        breaker = breakers.setdefault(service, CircuitBreaker(service))
+        _stats.setdefault(service, _ServiceStats())
+    return breaker
+
+def client_config(service, **overrides):
+    """botocore Config with our timeouts and botocore's retries off (instrument() retries instead)."""
+    return Config(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUTS.get(service, 10.0),
+                  retries={'total_max_attempts': 1, 'mode': 'standard'}, **overrides)
+
+def instrument(client, service):
+    """Hook the breaker, retry policy and fault injector into a client made with client_config()."""
+    events = client.meta.events
+    events.register(f'before-call.{service}', _before_call_handler(service))
+    events.register(f'needs-retry.{service}', _needs_retry_handler(service))
+    events.register_first(f'before-send.{service}', faults.before_send(service))
+    return client
+
+def _circuit_open_response(service, operation):
+    http = AWSResponse(None, 503, {}, None)
+    return http, {
+        'Error': {'Code': 'CircuitOpen', 'Message': f"{service} circuit open; not calling {operation}"},
+        'ResponseMetadata': {'HTTPStatusCode': 503},
+    }
+
+def _before_call_handler(service):
+    def before_call(model, context, **kwargs):
+        breaker = _breaker(service)
+        _stats[service].calls += 1
+        if not breaker.allow():
+            return _circuit_open_response(service, model.name)
+        budget.deposit()
+        context['resilience_deadline'] = time.monotonic() + deadline_for(service, model.name)
+        return None
+    return before_call
+
+def _attempt_failed(response, caught_exception):
+    if caught_exception is not None:
+        return isinstance(caught_exception, HTTPClientError)
+    http, parsed = response
+    return http.status_code >= 500 or parsed.get('Error', {}).get('Code') in _TRANSIENT_CODES
+
+def _needs_retry_handler(service):
+    def needs_retry(response, attempts, caught_exception, request_dict, **kwargs):
+        failed = _attempt_failed(response, caught_exception)
+        breaker = _breaker(service)
+        breaker.record(not failed)
+        if not failed:
+            return None
+        stats = _stats[service]
+        stats.failures += 1
+        if attempts >= MAX_ATTEMPTS or breaker.state == 'open':
+            return None
+        delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempts))
+        deadline = request_dict.get('context', {}).get('resilience_deadline')
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            stats.deadline_exceeded += 1
+            return None
+        if not budget.withdraw():
+            return None
+        stats.retries += 1
+        return delay
+    return needs_retry
+
+class _Latencies:
+    def __init__(self):
+        self._samples = deque(maxlen=_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q):
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+_latencies = {}
+_hedge_stats = {'sent': 0, 'won': 0}
+_hedge_pool = None
+_hedge_lock = threading.Lock()
+
+def _pool():
+    global _hedge_pool
+    with _hedge_lock:
+        if _hedge_pool is None:
+            _hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+        return _hedge_pool
+
+def hedged(name, fn, *args, **kwargs):
+    """
+    fn(*args, **kwargs) for an idempotent read. With HEDGE_READS on, a second copy is
+    started when the first is slower than the recent p95 for `name`; the first
+    successful result wins. fn must be safe to run twice at once (no shared resources).
+    """
+    if not HEDGE_READS:
+        return fn(*args, **kwargs)
+    latencies = _latencies.get(name) or _latencies.setdefault(name, _Latencies())
+
+    def timed():
+        started = time.monotonic()
+        result = fn(*args, **kwargs)
+        latencies.add(time.monotonic() - started)
+        return result
+
+    delay = latencies.percentile(HEDGE_PERCENTILE)
+    if delay is None:
+        return timed()
+    primary = _pool().submit(timed)
+    done, _ = wait([primary], timeout=max(delay, HEDGE_MIN_DELAY))
+    if done or not budget.withdraw():
+        return primary.result()
+
+    _hedge_stats['sent'] += 1
+    hedge = _pool().submit(timed)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    _hedge_stats['won'] += 1
+                return future.result()
+    return primary.result()  # both failed: surface the original error
+
+class _RawBody(io.BytesIO):
+    def stream(self, **kwargs):
+        chunk = self.read()
+        while chunk:
+            yield chunk
+            chunk = self.read()
+
+class FaultInjector:
+    """
+    Injected failures in front of the real endpoint. Kinds: 'throttle', 'unavailable'
+    (5xx), 'timeout' (ReadTimeoutError) and 'slow' (sleep `delay`, then send).
+    """
+    _ERRORS = {
+        ('dynamodb', 'throttle'): (400, 'ProvisionedThroughputExceededException'),
+        ('dynamodb', 'unavailable'): (500, 'InternalServerError'),
+        ('s3', 'throttle'): (503, 'SlowDown'),
+        ('s3', 'unavailable'): (500, 'InternalError'),
+    }
+
+    def __init__(self, spec=None):
+        self._rules = []
+        self._lock = threading.Lock()
+        self.injected = 0
+        for part in (spec or '').split(','):
+            target, _, fault = part.strip().partition('=')
+            if not target or not fault:
+                continue
+            service, _, operation = target.partition('.')
+            kind, _, rate = fault.partition('@')
+            kind, _, delay = kind.partition(':')
+            self.add(service, operation or '*', kind, float(rate or 1), float(delay or 0))
+
+    def add(self, service, operation='*', kind='throttle', rate=1.0, delay=0.0, times=None):
+        """Inject `kind` into a `rate` fraction of matching requests, at most `times` times."""
+        with self._lock:
+            self._rules.append([service, operation, kind, rate, delay, times])
+
+    def clear(self):
+        with self._lock:
+            self._rules = []
+
+    def before_send(self, service):
+        def handler(request, event_name, **kwargs):
+            if not self._rules:
+                return None
+            operation = event_name.rsplit('.', 1)[-1]
+            for rule in list(self._rules):
+                rule_service, rule_operation, kind, rate, delay, times = rule
+                if rule_service != service or rule_operation not in ('*', operation) or random.random() >= rate:
+                    continue
+                with self._lock:
+                    if times is not None:
+                        if rule[5] <= 0:
+                            continue
+                        rule[5] -= 1
+                    self.injected += 1
+                if kind == 'slow':
+                    time.sleep(delay)
+                    continue
+                if kind == 'timeout':
+                    raise ReadTimeoutError(endpoint_url=request.url)
+                return self._error_response(service, kind, request.url)
+            return None
+        return handler
+
+    def _error_response(self, service, kind, url):
+        status, code = self._ERRORS[service, kind]
+        if service == 'dynamodb':
+            body = json.dumps({'__type': f'com.amazonaws.dynamodb.v20120810#{code}', 'message': 'injected fault'})
+            headers = {'Content-Type': 'application/x-amz-json-1.0'}
+        else:
+            body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>injected fault</Message></Error>'
+            headers = {'Content-Type': 'application/xml'}
+        return AWSResponse(url, status, headers, _RawBody(body.encode('utf-8')))
+
+faults = FaultInjector(os.environ.get('FAULT_INJECTION'))
+
+def stats():
+    """Counters for GET /metrics."""
+    return {
+        'services': {
+            service: {
+                'circuit': breakers[service].state,
+                'opened': breakers[service].opened,
+                'short_circuited': breakers[service].short_circuited,
+                'calls': counters.calls,
+                'failures': counters.failures,
+                'retries': counters.retries,
+                'deadline_exceeded': counters.deadline_exceeded,
+            }
+            for service, counters in _stats.items()
+        },
+        'retry_budget': {'balance': round(budget.balance, 2), 'exhausted': budget.exhausted},
+        'hedges': dict(_hedge_stats, enabled=HEDGE_READS),
+        'faults_injected': faults.injected,
+    }
+
+def reset():
+    """Fresh breakers, budget and counters (tests)."""
+    global budget
+    budget = RetryBudget()
+    for service in list(breakers):
+        breakers[service] = CircuitBreaker(service)
+        _stats[service] = _ServiceStats()
+    _latencies.clear()
+    _hedge_stats.update(sent=0, won=0)
+    faults.clear()
+    faults.injected = 0
@@ -1,17 +1,18 @@
 import boto3
 import logging
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
-from botocore.config import Config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def get_s3_client():
-    """Returns a boto3 S3 client."""
+def get_s3_client(**config):
+    """Returns a boto3 S3 client with timeouts, retries and circuit breaking (see resilience)."""
     # Config signature_version='s3v4' is important for presigned URLs
-    return boto3.client('s3', config=Config(signature_version='s3v4'))
+    client = boto3.client('s3', config=resilience.client_config('s3', signature_version='s3v4', **config))
+    return resilience.instrument(client, 's3')
 
-from src.utils import local_adapter
+from src.utils import local_adapter, resilience
 import os
 
 def generate_presigned_upload_url(bucket_name, object_name, expiration=3600):
@@ -19,7 +20,7 @@ def generate_presigned_upload_url(bucket_name, object_name, expiration=3600):
     if os.environ.get('USE_LOCAL_STORAGE'):
         # Use configured API URL or Render's default external URL, falling back to localhost
         host_url = os.environ.get('API_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL') or 'http://localhost:8000'
-        return local_adapter.generate_local_upload_url(host_url, object_name)
+        return local_adapter.generate_local_upload_url(host_url, object_name, expiration)
 
     s3_client = get_s3_client()
     try:
@@ -36,7 +37,7 @@ def generate_presigned_download_url(bucket_name, object_name, expiration=3600):
     """Generate a presigned URL to download a file from S3."""
     if os.environ.get('USE_LOCAL_STORAGE'):
         host_url = os.environ.get('API_BASE_URL') or os.environ.get('RENDER_EXTERNAL_URL') or 'http://localhost:8000'
-        return local_adapter.generate_local_download_url(host_url, object_name)
+        return local_adapter.generate_local_download_url(host_url, object_name, expiration)
 
     s3_client = get_s3_client()
     try:
@@ -61,3 +62,72 @@ def delete_s3_object(bucket_name, object_name):
     except ClientError as e:
         logger.error(f"Failed to delete {object_name} from {bucket_name}: {e}")
         return False
+
+def read_object(bucket_name, object_name):
+    """Return an object's bytes, or None if it is missing (server-side processing only)."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        path = local_adapter.get_file_content(object_name)
+        if not path:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    try:
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=object_name)
+        return response['Body'].read()
+    except ClientError as e:
+        logger.error(f"Failed to read {object_name} from {bucket_name}: {e}")
+        return None
+
+def open_object(bucket_name, object_name, s3_client=None):
+    """(readable stream, size) for an object, or None if it is missing. The caller closes the stream."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        path = local_adapter.get_file_content(object_name)
+        if not path:
+            return None
+        f = open(path, 'rb')
+        return f, os.fstat(f.fileno()).st_size
+
+    try:
+        response = (s3_client or get_s3_client()).get_object(Bucket=bucket_name, Key=object_name)
+        return response['Body'], response['ContentLength']
+    except ClientError as e:
+        logger.error(f"Failed to open {object_name} in {bucket_name}: {e}")
+        return None
+
+def read_range(bucket_name, object_name, start, length, s3_client=None):
+    """(bytes at [start, start + length), object size) via a ranged GET, or None if missing."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return local_adapter.read_range(object_name, start, length)
+
+    try:
+        response = (s3_client or get_s3_client()).get_object(Bucket=bucket_name, Key=object_name,
+                                                             Range=f'bytes={start}-{start + length - 1}')
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+            return b'', start  # start is at (or past) the end, e.g. an empty object
+        logger.error(f"Failed to read {object_name} in {bucket_name}: {e}")
+        return None
+    data = response['Body'].read()
+    # "bytes 0-65535/1048576"; a 200 (range covers the whole object) has no ContentRange
+    content_range = response.get('ContentRange')
+    size = int(content_range.rsplit('/', 1)[1]) if content_range else response['ContentLength']
+    return data, size
+
+def upload_stream(bucket_name, object_name, fileobj, content_type=None, s3_client=None, transfer_config=None):
+    """
+    Upload a readable stream server-side (bulk import). Bodies larger than
+    transfer_config.multipart_threshold go up as a multipart upload, parts in parallel.
+    A stream without seek() is read once, in order, so the caller can hash it as it goes.
+    """
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return local_adapter.save_file_stream(object_name, fileobj)
+
+    extra_args = {'ContentType': content_type} if content_type else None
+    try:
+        (s3_client or get_s3_client()).upload_fileobj(fileobj, bucket_name, object_name,
+                                                      ExtraArgs=extra_args, Config=transfer_config)
+        return True
+    except (ClientError, S3UploadFailedError) as e:
+        logger.error(f"Failed to upload {object_name} to {bucket_name}: {e}")
+        return False
@@ -0,0 +1,375 @@
+"""
+Per-user full-text index over description and original_filename (GET /images/search).
+
+On-disk format, one pair of files per user under SEARCH_INDEX_DIR/<xx>/<sha1(user_id)>:
+- .base.json  snapshot {"version": 1, "docs": {image_id: {term: tf}}}
+- .log        append-only JSON lines {"op": "put"|"del", "id": image_id, "terms": {term: tf}}
+A save or delete appends one line. Readers keep the parsed index in memory and
+replay only the lines appended since they last looked. Once the log outgrows the
+snapshot it is compacted into a new snapshot. Rebuild everything with
+`python -m src.jobs.rebuild_search_index`.
+
+Enabled in USE_LOCAL_STORAGE mode, or anywhere SEARCH_INDEX_DIR points at a
+persistent directory (e.g. an EFS mount for Lambda).
+"""
+import os
+import re
+import json
+import math
+import heapq
+import hashlib
+import logging
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict
+from operator import itemgetter
+
+from src.utils import local_adapter
+
+logger = logging.getLogger()
+
+SEARCH_INDEX_DIR = os.environ.get('SEARCH_INDEX_DIR') or os.path.join(local_adapter.STORAGE_DIR, 'search')
+INDEXED_FIELDS = ('description', 'original_filename')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Prefix completions of the query's last word, and their weight relative to an exact match
+PREFIX_EXPANSIONS = 32
+PREFIX_WEIGHT = 0.6
+# Terms in more than this share of a user's items score almost nothing (idf ~ 0) and
+# are left out of queries; a query made only of such terms keeps its rarest one
+COMMON_TERM_RATIO = 0.9
+# Ids scored per query at most. Postings are visited strongest first, so a query that
+# gets there (several common words) returns the best matches found so far.
+MAX_SCORED = 2000
+# Compact once the log is larger than the snapshot (and at least this big)
+COMPACT_MIN_BYTES = 1024 * 1024
+CACHE_USERS = 64
+
+_TOKEN_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+def is_enabled():
+    return bool(os.environ.get('USE_LOCAL_STORAGE') or os.environ.get('SEARCH_INDEX_DIR'))
+
+def tokenize(text):
+    """Lowercased word tokens; '_', '-' and '.' split words so 'IMG_2041-beach.jpg' -> img, 2041, beach, jpg."""
+    return [t for t in _TOKEN_RE.findall((text or '').lower()) if len(t) > 1 or t.isdigit()]
+
+def item_terms(item):
+    counts = Counter()
+    for field in INDEXED_FIELDS:
+        counts.update(tokenize(item.get(field)))
+    return dict(counts)
+
+class UserIndex:
+    """
+    In-memory inverted index for one user.
+
+    Postings are impact-ordered: a term's items are grouped by (tf, item length),
+    which is all its BM25 score depends on, so a query visits groups best first
+    and stops once nothing left unvisited can make the top `limit`.
+    """
+
+    def __init__(self):
+        self.docs = {}          # image_id -> {term: tf}
+        self.doc_len = {}       # image_id -> number of tokens
+        self.postings = {}      # term -> {(tf, doc_len): sorted [image_id]}
+        self.df = {}            # term -> number of items
+        self.vocab = []         # sorted terms, for prefix lookups
+        self.total_len = 0
+
+    def put(self, image_id, terms):
+        self.delete(image_id)
+        if not terms:
+            return
+        self.docs[image_id] = terms
+        length = sum(terms.values())
+        self.doc_len[image_id] = length
+        self.total_len += length
+        for term, tf in terms.items():
+            groups = self.postings.get(term)
+            if groups is None:
+                groups = self.postings[term] = {}
+                self.df[term] = 0
+                insort(self.vocab, term)
+            insort(groups.setdefault((tf, length), []), image_id)
+            self.df[term] += 1
+
+    def load(self, docs):
+        """Fill an empty index from {image_id: {term: tf}} (a snapshot), sorting once at the end."""
+        for image_id, terms in docs.items():
+            if not terms:
+                continue
+            self.docs[image_id] = terms
+            length = sum(terms.values())
+            self.doc_len[image_id] = length
+            self.total_len += length
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {}).setdefault((tf, length), []).append(image_id)
+        for term, groups in self.postings.items():
+            for ids in groups.values():
+                ids.sort()
+            self.df[term] = sum(len(ids) for ids in groups.values())
+        self.vocab = sorted(self.postings)
+
+    def delete(self, image_id):
+        terms = self.docs.pop(image_id, None)
+        if terms is None:
+            return
+        length = self.doc_len.pop(image_id)
+        self.total_len -= length
+        for term, tf in terms.items():
+            groups = self.postings[term]
+            ids = groups[(tf, length)]
+            del ids[bisect_left(ids, image_id)]
+            if not ids:
+                del groups[(tf, length)]
+            self.df[term] -= 1
+            if not self.df[term]:
+                del self.df[term]
+                del self.postings[term]
+                del self.vocab[bisect_left(self.vocab, term)]
+
+    def apply(self, record):
+        if record['op'] == 'put':
+            self.put(record['id'], record['terms'])
+        else:
+            self.delete(record['id'])
+
+    def expand(self, token):
+        """The token itself (if indexed) plus up to PREFIX_EXPANSIONS terms starting with it."""
+        start = bisect_left(self.vocab, token)
+        matches = []
+        for term in self.vocab[start:start + PREFIX_EXPANSIONS + 1]:
+            if not term.startswith(token):
+                break
+            matches.append(term)
+        return matches
+
+    def query_terms(self, query):
+        """
+        [[(term, weight)]], one list per query word. The last word may still be
+        being typed: its list holds the word and its completions, and an item
+        scores only its best one.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        last = tokens[-1]
+        words = [word for word in dict.fromkeys(tokens[:-1]) if word != last]
+        alternatives = [[(word, 1.0)] for word in words if word in self.postings]
+        completions = [(term, 1.0 if term == last else PREFIX_WEIGHT) for term in self.expand(last) if term not in words]
+        if completions:
+            alternatives.append(completions)
+
+        n_docs = len(self.docs)
+        selective = [[(term, boost) for term, boost in terms if self.df[term] <= COMMON_TERM_RATIO * n_docs]
+                     for terms in alternatives]
+        selective = [terms for terms in selective if terms]
+        if not selective and alternatives:
+            selective = [[min((tb for terms in alternatives for tb in terms), key=lambda tb: self.df[tb[0]])]]
+        return [[(term, boost * math.log(1 + (n_docs - self.df[term] + 0.5) / (self.df[term] + 0.5)))
+                 for term, boost in terms] for terms in selective]
+
+    def search(self, query, limit=20):
+        """
+        BM25 ranking; returns [(image_id, score)] best first.
+
+        Groups are visited best impact first and every id is scored in full when
+        first seen. The search stops once the top `limit` beat anything unvisited
+        could score (exact), or after MAX_SCORED ids (the best found so far).
+        """
+        n_docs = len(self.docs)
+        if not n_docs:
+            return []
+        words = self.query_terms(query)
+        weights = {term: (w, weight) for w, terms in enumerate(words) for term, weight in terms}
+        # BM25 length normalisation K1 * (1 - B + B * length / avgdl), as base + per_token * length
+        base_norm, per_token = K1 * (1 - B), K1 * B * n_docs / self.total_len
+
+        def score_of(image_id, norm):
+            doc = self.docs[image_id]
+            best = [0.0] * len(words)
+            if len(weights) <= len(doc):
+                for term, (w, weight) in weights.items():
+                    tf = doc.get(term)
+                    if tf:
+                        best[w] = max(best[w], weight * tf * (K1 + 1) / (tf + norm))
+            else:
+                for term, tf in doc.items():
+                    hit = weights.get(term)
+                    if hit:
+                        best[hit[0]] = max(best[hit[0]], hit[1] * tf * (K1 + 1) / (tf + norm))
+            return sum(best)
+
+        # Per query word, its terms' (impact, item length, ids) groups best first: every id in a group
+        # scores `impact` for that term. An end marker keeps the next impact readable.
+        streams = []
+        for terms in words:
+            stream = [(weight * tf * (K1 + 1) / (tf + base_norm + per_token * length), length, ids)
+                      for term, weight in terms for (tf, length), ids in self.postings[term].items()]
+            stream.sort(key=itemgetter(0), reverse=True)
+            streams.append(stream + [(0.0, 0, ())])
+        merged = heapq.merge(*[[(impact, w, length, ids) for impact, length, ids in stream[:-1]]
+                               for w, stream in enumerate(streams)], key=lambda group: -group[0])
+        visited = [0] * len(streams)
+        # An id not seen yet scores at most the best unvisited impact of every query word
+        unseen_bound = sum(stream[0][0] for stream in streams)
+
+        top = []  # min-heap of the best (score, image_id) so far
+        seen = set()
+        for impact, w, length, ids in merged:
+            if len(top) == limit and top[0][0] > unseen_bound:
+                break
+            visited[w] += 1
+            unseen_bound += streams[w][visited[w]][0] - impact
+            norm = base_norm + per_token * length
+            if len(words) == 1:
+                ids = ids[-limit:]  # equal scores rank newer ids first, so older ones cannot make the cut
+            for image_id in reversed(ids):
+                if len(seen) == MAX_SCORED:
+                    break
+                if image_id in seen:
+                    continue
+                seen.add(image_id)
+                entry = (score_of(image_id, norm), image_id)
+                if len(top) < limit:
+                    heapq.heappush(top, entry)
+                elif entry > top[0]:
+                    heapq.heapreplace(top, entry)
+            if len(seen) == MAX_SCORED:
+                break
+        return [(image_id, score) for score, image_id in sorted(top, reverse=True)]
+
+class _CacheEntry:
+    __slots__ = ('index', 'base_signature', 'log_offset', 'lock')
+
+    def __init__(self):
+        self.index = UserIndex()
+        self.base_signature = None
+        self.log_offset = 0
+        self.lock = threading.Lock()
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _paths(user_id):
+    digest = hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+    prefix = os.path.join(SEARCH_INDEX_DIR, digest[:2], digest)
+    return prefix + '.base.json', prefix + '.log'
+
+def _replay(index, log_path, offset):
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                index.apply(json.loads(line))
+            return f.tell()
+    except FileNotFoundError:
+        return 0
+
+def _load(user_id):
+    """Cached index for user_id, refreshed with anything other processes wrote since."""
+    base_path, log_path = _paths(user_id)
+    with _cache_lock:
+        entry = _cache.get(user_id)
+        if entry is None:
+            entry = _cache[user_id] = _CacheEntry()
+            if len(_cache) > CACHE_USERS:
+                _cache.popitem(last=False)
+        else:
+            _cache.move_to_end(user_id)
+
+    with entry.lock:
+        signature = local_adapter._file_signature(base_path)
+        try:
+            log_size = os.path.getsize(log_path)
+        except FileNotFoundError:
+            log_size = 0
+        if entry.base_signature == signature and log_size == entry.log_offset:
+            return entry.index
+        with local_adapter._file_lock(base_path, exclusive=False):
+            signature = local_adapter._file_signature(base_path)
+            if entry.base_signature != signature or log_size < entry.log_offset:
+                # New snapshot (compaction/rebuild): start over from it
+                entry.index = UserIndex()
+                if signature is not None:
+                    with open(base_path) as f:
+                        entry.index.load(json.load(f)['docs'])
+                entry.base_signature = signature
+                entry.log_offset = 0
+            entry.log_offset = _replay(entry.index, log_path, entry.log_offset)
+        return entry.index
+
+def _write_base(base_path, docs):
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    tmp_path = f"{base_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': 1, 'docs': docs}, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, base_path)
+
+def _compact(user_id):
+    base_path, log_path = _paths(user_id)
+    with local_adapter._file_lock(base_path, exclusive=True):
+        index = UserIndex()
+        if os.path.exists(base_path):
+            with open(base_path) as f:
+                index.load(json.load(f)['docs'])
+        _replay(index, log_path, 0)
+        # Snapshot first, then truncate: a crash in between just replays idempotent ops
+        _write_base(base_path, index.docs)
+        open(log_path, 'w').close()
+
+def _append(user_id, record):
+    base_path, log_path = _paths(user_id)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with local_adapter._file_lock(base_path, exclusive=True):
+        with open(log_path, 'a') as f:
+            f.write(line)
+            log_size = f.tell()
+    try:
+        base_size = os.path.getsize(base_path)
+    except FileNotFoundError:
+        base_size = 0
+    if log_size > max(COMPACT_MIN_BYTES, base_size):
+        _compact(user_id)
+
+def index_item(item):
+    """Add or replace one item in its owner's index (call after a successful metadata save)."""
+    if not is_enabled():
+        return False
+    try:
+        _append(item['user_id'], {'op': 'put', 'id': item['image_id'], 'terms': item_terms(item)})
+        return True
+    except OSError as e:
+        # The metadata write already succeeded; a rebuild brings the index back in line
+        logger.error(f"Failed to index {item.get('image_id')}: {e}")
+        return False
+
+def remove_item(user_id, image_id):
+    if not is_enabled():
+        return False
+    try:
+        _append(user_id, {'op': 'del', 'id': image_id})
+        return True
+    except OSError as e:
+        logger.error(f"Failed to remove {image_id} from search index: {e}")
+        return False
+
+def search(user_id, query, limit=20):
+    """[(image_id, score)] for the user's best matches."""
+    return _load(user_id).search(query, limit)
+
+def rebuild(user_id, items):
+    """Replace a user's index with one built from `items` (used by the rebuild job)."""
+    index = UserIndex()
+    index.load({item['image_id']: item_terms(item) for item in items})
+    base_path, log_path = _paths(user_id)
+    with local_adapter._file_lock(base_path, exclusive=True):
+        _write_base(base_path, index.docs)
+        open(log_path, 'w').close()
+    return len(index.docs)
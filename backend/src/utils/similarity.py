@@ -0,0 +1,150 @@
+"""
+Near-duplicate detection: a 64-bit perceptual hash (dHash) per image, stored as
+the `phash` metadata attribute (16 hex chars), and a per-user BK-tree for
+Hamming-distance radius queries (GET /images/<id>/similar).
+
+dHash shrinks the image to 9x8 grayscale and records whether each pixel is
+brighter than its right-hand neighbour, so resizing, recompression and small
+colour edits flip only a few of the 64 bits. Pillow is optional; without it
+nothing is hashed and the endpoint reports that similarity is unavailable.
+"""
+import io
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; only needed to compute hashes
+    Image = None
+
+from src.utils import dynamo_utils, s3_utils
+
+logger = logging.getLogger()
+
+# Hashes at most this many bits apart are "similar" by default (out of 64)
+DEFAULT_MAX_DISTANCE = int(os.environ.get('SIMILAR_MAX_DISTANCE', '10'))
+# Per-process trees are rebuilt from metadata after this long, to pick up other workers' writes
+INDEX_TTL_SECONDS = int(os.environ.get('SIMILAR_INDEX_TTL', '300'))
+CACHE_USERS = 64
+
+def is_available():
+    return Image is not None
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def dhash(data, hash_size=8):
+    """64-bit difference hash of encoded image bytes as a hex string, or None if undecodable."""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # Lets the JPEG decoder downscale via the DCT instead of decoding every pixel
+            img.draft('L', (hash_size * 8, hash_size * 8))
+            pixels = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).tobytes()
+    except Exception as e:
+        logger.warning(f"Cannot hash image: {e}")
+        return None
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f'{value:0{hash_size * hash_size // 4}x}'
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance."""
+
+    def __init__(self):
+        self.root = None  # [hash, [keys], {distance: child}]
+        self.size = 0
+
+    def add(self, value, key):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [key], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [key], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """[(distance, key)] for every key within `radius` bits of value."""
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                results.extend((d, key) for key in node[1])
+            # Triangle inequality: only children at distance d-radius..d+radius can match
+            for child_d, child in node[2].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return results
+
+_trees = OrderedDict()
+_trees_lock = threading.Lock()
+
+def _tree_for(table_name, user_id):
+    with _trees_lock:
+        cached = _trees.get(user_id)
+        if cached and time.monotonic() - cached[1] < INDEX_TTL_SECONDS:
+            _trees.move_to_end(user_id)
+            return cached[0]
+
+    tree = BKTree()
+    for item in dynamo_utils.query_images(table_name, user_id, fields=['image_id', 'phash']):
+        if item.get('phash'):
+            tree.add(int(item['phash'], 16), item['image_id'])
+    with _trees_lock:
+        _trees[user_id] = (tree, time.monotonic())
+        if len(_trees) > CACHE_USERS:
+            _trees.popitem(last=False)
+    return tree
+
+def _note_hash(user_id, image_id, phash):
+    with _trees_lock:
+        cached = _trees.get(user_id)
+        if cached:
+            cached[0].add(int(phash, 16), image_id)
+
+def hash_item(table_name, bucket_name, item):
+    """Compute and store an item's phash. Returns the hash, or None if it could not be computed."""
+    data = s3_utils.read_object(bucket_name, item.get('s3_key') or item['image_id'])
+    phash = dhash(data) if data else None
+    if phash and dynamo_utils.update_attributes(table_name, item['user_id'], item['image_id'], {'phash': phash}):
+        _note_hash(item['user_id'], item['image_id'], phash)
+        return phash
+    return None
+
+def find_similar(table_name, bucket_name, user_id, image_id, max_distance=None, limit=20):
+    """
+    [(image_id, distance)] of the user's images within max_distance bits of image_id, closest first.
+    Returns None if the image does not exist or cannot be hashed.
+    """
+    item = dynamo_utils.get_metadata(table_name, user_id, image_id)
+    if not item:
+        return None
+    phash = item.get('phash') or hash_item(table_name, bucket_name, item)
+    if not phash:
+        return None
+
+    radius = DEFAULT_MAX_DISTANCE if max_distance is None else max_distance
+    closest = {}
+    for d, key in _tree_for(table_name, user_id).search(int(phash, 16), radius):
+        if key != image_id and d < closest.get(key, 65):
+            closest[key] = d
+    matches = sorted((d, key) for key, d in closest.items())
+    return [(key, d) for d, key in matches[:limit]]
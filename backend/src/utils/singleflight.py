@@ -0,0 +1,173 @@
+"""
+Single-flight request coalescing: identical calls that overlap in time share one
+execution. A viral album link fans out into hundreds of identical
+`query_images(tag=...)` calls per instance; with this layer only the first one
+hits the backend and the rest wait for its result.
+
+Followers only join a call that is already in flight, so they can miss a write
+made after it started. Callers that need to read their own writes call forget()
+once a write completes (dynamo_utils does, per user). Shared results are handed
+to every caller, so treat them as read-only.
+
+Followers wait at most SINGLEFLIGHT_WAIT_SECONDS, then make the call themselves
+so a stuck leader cannot hold every request hostage. Per-group counters are
+exposed through stats() and GET /metrics.
+"""
+import os
+import asyncio
+import functools
+import threading
+
+WAIT_SECONDS = float(os.environ.get('SINGLEFLIGHT_WAIT_SECONDS', '10'))
+ENABLED = os.environ.get('SINGLEFLIGHT', 'on').lower() not in ('0', 'off', 'false')
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Group:
+    """Coalesces concurrent calls that use the same key."""
+
+    def __init__(self, name, wait_seconds=None):
+        self.name = name
+        self.wait_seconds = WAIT_SECONDS if wait_seconds is None else wait_seconds
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.calls = 0        # every do()/do_async()
+        self.executions = 0   # calls that actually ran fn
+        self.shared = 0       # calls answered with another call's result
+        self.timeouts = 0     # followers that gave up waiting and ran fn themselves
+        self.errors = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), sharing the result with identical in-flight calls."""
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            return self._lead(key, call, fn, args, kwargs)
+
+        if not call.done.wait(self.wait_seconds):
+            with self._lock:
+                self.timeouts += 1
+            return self._run(fn, args, kwargs)
+        if call.error is not None:
+            raise call.error
+        with self._lock:
+            self.shared += 1
+        return call.result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        do() for asyncio code with a blocking fn: tasks on one loop share a single
+        executor job, which in turn coalesces with threads calling do().
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.calls += 1
+            future = self._async_calls.get((loop, key))
+            leader = future is None
+            if leader:
+                # The executor job goes through do() as well; don't count this caller twice
+                self.calls -= 1
+                future = loop.run_in_executor(None, functools.partial(self.do, key, fn, *args, **kwargs))
+                self._async_calls[(loop, key)] = future
+                future.add_done_callback(lambda _: self._forget_async(loop, key, future))
+
+        if leader:
+            return await future
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.wait_seconds)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            return await loop.run_in_executor(None, functools.partial(self._run, fn, args, kwargs))
+        with self._lock:
+            self.shared += 1
+        return result
+
+    def _forget_async(self, loop, key, future):
+        with self._lock:
+            if self._async_calls.get((loop, key)) is future:
+                del self._async_calls[(loop, key)]
+
+    def forget(self, match):
+        """
+        Later calls whose key satisfies match(key) start a new execution instead of
+        joining the one in flight; callers already waiting still get its result.
+        """
+        with self._lock:
+            for key in [k for k in self._calls if match(k)]:
+                del self._calls[key]
+            for loop_key in [k for k in self._async_calls if match(k[1])]:
+                del self._async_calls[loop_key]
+
+    def _lead(self, key, call, fn, args, kwargs):
+        try:
+            call.result = self._run(fn, args, kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:  # not forgotten and replaced meanwhile
+                    del self._calls[key]
+            call.done.set()
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self.executions += 1
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'executions': self.executions,
+                'shared': self.shared,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'in_flight': len(self._calls),
+                # Fraction of calls that did not reach the backend
+                'coalescing_ratio': round(self.shared / self.calls, 4) if self.calls else 0.0,
+            }
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+def group(name):
+    """The process-wide Group for name (created on first use)."""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = Group(name)
+        return _groups[name]
+
+def do(name, key, fn, *args, **kwargs):
+    """Coalesce fn(*args, **kwargs) within group `name`; a plain call when SINGLEFLIGHT=off."""
+    if not ENABLED:
+        return fn(*args, **kwargs)
+    return group(name).do(key, fn, *args, **kwargs)
+
+def forget(name, match):
+    """Group.forget for group `name`, e.g. after a write the in-flight reads may have missed."""
+    group(name).forget(match)
+
+def stats():
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {g.name: g.stats() for g in groups}
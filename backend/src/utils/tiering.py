@@ -0,0 +1,104 @@
+import os
+import time
+import logging
+from botocore.exceptions import ClientError
+
+from src.utils import s3_utils, dynamo_utils, local_adapter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Optional DynamoDB table (PK: s3_key) holding the last download time of each object.
+# Without it, S3 tiering falls back to object age (LastModified).
+ACCESS_TABLE_NAME = os.environ.get('ACCESS_TABLE_NAME')
+
+COLD_AFTER_DAYS = int(os.environ.get('TIER_COLD_AFTER_DAYS', '30'))
+COLD_STORAGE_CLASS = os.environ.get('TIER_COLD_STORAGE_CLASS', 'STANDARD_IA')
+
+# Classes that need a restore_object before they can be read
+ARCHIVE_CLASSES = {'GLACIER', 'DEEP_ARCHIVE'}
+RESTORE_DAYS = int(os.environ.get('TIER_RESTORE_DAYS', '7'))
+RESTORE_TIER = os.environ.get('TIER_RESTORE_TIER', 'Standard')
+
+# Only rewrite an object's access record once per window, so a popular image costs
+# one conditional write per hour rather than one write per download
+ACCESS_WRITE_INTERVAL_SECONDS = 3600
+
+def record_access(bucket_name, object_name):
+    """Record a download of object_name (best effort, never fails the request)."""
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        return local_adapter.touch_file(object_name, ACCESS_WRITE_INTERVAL_SECONDS)
+    if not ACCESS_TABLE_NAME:
+        return False
+
+    now = int(time.time())
+    table = dynamo_utils.get_dynamodb_resource().Table(ACCESS_TABLE_NAME)
+    try:
+        table.update_item(
+            Key={'s3_key': object_name},
+            UpdateExpression='SET last_access = :now',
+            ConditionExpression='attribute_not_exists(last_access) OR last_access < :stale',
+            ExpressionAttributeValues={':now': now, ':stale': now - ACCESS_WRITE_INTERVAL_SECONDS}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            logger.error(f"Failed to record access for {object_name}: {e}")
+        return False
+
+def get_last_access(object_names):
+    """Batch lookup of last access times (epoch seconds) for up to any number of keys."""
+    if not ACCESS_TABLE_NAME or not object_names:
+        return {}
+    dynamodb = dynamo_utils.get_dynamodb_resource()
+    result = {}
+    keys = list(dict.fromkeys(object_names))
+    for i in range(0, len(keys), 100):  # BatchGetItem limit
+        request = {ACCESS_TABLE_NAME: {'Keys': [{'s3_key': k} for k in keys[i:i + 100]]}}
+        while request:
+            try:
+                response = dynamodb.batch_get_item(RequestItems=request)
+            except ClientError as e:
+                logger.error(f"Failed to read access records: {e}")
+                break
+            for record in response.get('Responses', {}).get(ACCESS_TABLE_NAME, []):
+                result[record['s3_key']] = int(record['last_access'])
+            request = response.get('UnprocessedKeys') or None
+    return result
+
+def ensure_hot(bucket_name, object_name):
+    """
+    Make sure a (possibly cold) object can be downloaded.
+    Returns 'hot' when it can be served now, or 'restoring' while an archive
+    restore is in progress (the client should retry later).
+    """
+    if os.environ.get('USE_LOCAL_STORAGE'):
+        local_adapter.get_file_content(object_name)  # rehydrates from the archive dir if needed
+        return 'hot'
+
+    # Instant-access classes (STANDARD_IA, GLACIER_IR, ...) are always readable;
+    # only pay for a HEAD when cold objects may live in an archive class
+    if COLD_STORAGE_CLASS not in ARCHIVE_CLASSES:
+        return 'hot'
+
+    s3_client = s3_utils.get_s3_client()
+    try:
+        head = s3_client.head_object(Bucket=bucket_name, Key=object_name)
+    except ClientError:
+        return 'hot'  # missing objects are reported by the download itself
+    if head.get('StorageClass') not in ARCHIVE_CLASSES:
+        return 'hot'
+
+    restore = head.get('Restore')
+    if restore and 'ongoing-request="false"' in restore:
+        return 'hot'
+    if not restore:
+        try:
+            s3_client.restore_object(
+                Bucket=bucket_name, Key=object_name,
+                RestoreRequest={'Days': RESTORE_DAYS, 'GlacierJobParameters': {'Tier': RESTORE_TIER}}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'RestoreAlreadyInProgress':
+                logger.error(f"Failed to restore {object_name}: {e}")
+    return 'restoring'
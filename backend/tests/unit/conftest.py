@@ -0,0 +1,30 @@
+import pytest
+from src.utils import change_feed, idempotency, local_adapter, local_sqlite, profiling, search_index
+
+@pytest.fixture
+def local_store(tmp_path, monkeypatch):
+    """
+    USE_LOCAL_STORAGE mode with every local path under tmp_path / 'store', so no
+    code path can reach the tracked backend/local_storage/. Yields the store root.
+    """
+    store = tmp_path / 'store'
+    monkeypatch.setenv('USE_LOCAL_STORAGE', 'true')
+    monkeypatch.setattr(local_adapter, 'STORAGE_DIR', str(store))
+    monkeypatch.setattr(local_adapter, 'IMAGES_DIR', str(store / 'images'))
+    monkeypatch.setattr(local_adapter, 'ARCHIVE_DIR', str(store / 'archive'))
+    monkeypatch.setattr(local_adapter, 'ACCESS_DIR', str(store / 'access'))
+    monkeypatch.setattr(local_adapter, 'DB_FILE', str(store / 'metadata.json'))
+    monkeypatch.setattr(local_adapter, 'SHARDS_DIR', str(store / 'metadata'))
+    monkeypatch.setattr(local_adapter, 'DB_SHARDS', 0)
+    monkeypatch.setattr(local_adapter, 'FANOUT_LEVELS', 0)
+    monkeypatch.setattr(local_adapter, '_index_cache', {})
+    monkeypatch.setattr(local_adapter, '_postings_cache', local_adapter.OrderedDict())
+    monkeypatch.setattr(local_adapter, '_url_secret_cache', None)
+    monkeypatch.setattr(local_sqlite, 'DB_FILE', str(store / 'metadata.db'))
+    monkeypatch.setattr(search_index, 'SEARCH_INDEX_DIR', str(store / 'search'))
+    monkeypatch.setattr(search_index, '_cache', search_index.OrderedDict())
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_DIR', str(store / 'idempotency'))
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(store / 'profiles'))
+    monkeypatch.setattr(change_feed, 'FEED_DIR', str(store / 'feed'))
+    (store / 'images').mkdir(parents=True)
+    yield store
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+import pytest
+from src.app import handlers
+from src.utils import change_feed, local_adapter
+
+@pytest.fixture
+def feed(monkeypatch):
+    fresh = change_feed.ChangeFeed()
+    monkeypatch.setattr(change_feed, 'feed', fresh)
+    yield fresh
+
+def _item(image_id, tag='a'):
+    return {'user_id': 'u1', 'image_id': image_id, 'tag': tag}
+
+def test_deltas_are_coalesced_per_image(feed):
+    subscription = change_feed.subscribe('u1')
+    change_feed.publish_saved(_item('img_1'))
+    change_feed.publish_saved(_item('img_2'))
+    change_feed.publish_saved(_item('img_1', tag='b'))
+    change_feed.publish_removed('u1', 'img_2')
+    change_feed.publish_saved(dict(_item('img_3'), user_id='u2'))  # another user's gallery
+
+    events = subscription.get(timeout=0)
+    assert [(e['type'], e['image_id']) for e in events] == [('add', 'img_1'), ('remove', 'img_2')]
+    assert events[0]['item']['tag'] == 'b'
+    assert subscription.get(timeout=0) == []
+
+def test_slow_subscriber_gets_a_reset_not_an_unbounded_queue(feed, monkeypatch):
+    monkeypatch.setattr(change_feed, 'QUEUE_SIZE', 5)
+    slow = change_feed.subscribe('u1')
+    fast = change_feed.subscribe('u1')
+    for i in range(8):
+        change_feed.publish_saved(_item(f'img_{i}'))
+        assert len(fast.get(timeout=0)) == 1
+
+    assert [e['type'] for e in slow.get(timeout=0)] == ['reset']
+    # Once a reset is pending, further deltas are redundant
+    change_feed.publish_saved(_item('img_9'))
+    change_feed.publish_reset('u1')
+    change_feed.publish_saved(_item('img_10'))
+    assert [e['type'] for e in slow.get(timeout=0)] == ['reset']
+    assert change_feed.stats()['overflows'] == 1
+
+def test_reconnect_replays_missed_deltas(feed, monkeypatch):
+    monkeypatch.setattr(change_feed, 'REPLAY_EVENTS', 3)
+    first = change_feed.subscribe('u1')
+    change_feed.publish_saved(_item('img_1'))
+    last_id = first.get(timeout=0)[-1]['id']
+    first.close()
+
+    change_feed.publish_saved(_item('img_2'))
+    change_feed.publish_removed('u1', 'img_1')
+    resumed = change_feed.subscribe('u1', last_event_id=last_id)
+    assert [(e['type'], e['image_id']) for e in resumed.get(timeout=0)] == [('add', 'img_2'), ('remove', 'img_1')]
+
+    # Too far behind (or an id from another process): start over
+    change_feed.publish_saved(_item('img_3'))
+    change_feed.publish_saved(_item('img_4'))
+    assert [e['type'] for e in change_feed.subscribe('u1', last_event_id=last_id).get(timeout=0)] == ['reset']
+    assert [e['type'] for e in change_feed.subscribe('u1', last_event_id='feedbeef-1').get(timeout=0)] == ['reset']
+
+def test_subscriber_limit(feed, monkeypatch):
+    monkeypatch.setattr(change_feed, 'MAX_SUBSCRIBERS', 1)
+    subscription = change_feed.subscribe('u1')
+    response = handlers.change_feed_handler({'queryStringParameters': {'user_id': 'u2'}}, None)
+    assert response['statusCode'] == 503 and response['headers']['Retry-After'] == '5'
+    subscription.close()
+    assert change_feed.stats()['subscribers'] == 0
+
+def test_sse_stream_carries_upload_and_delete(feed, local_store, monkeypatch):
+    monkeypatch.setattr(change_feed, 'HEARTBEAT_SECONDS', 0.05)
+    response = handlers.change_feed_handler({'queryStringParameters': {'user_id': 'u1'}}, None)
+    assert response['headers']['Content-Type'] == 'text/event-stream'
+    stream = response['stream']
+    assert next(stream) == b'retry: 3000\n\n'
+    assert next(stream) == b': keepalive\n\n'
+
+    upload = handlers.generate_upload_url_handler({'body': json.dumps({'filename': 'a.jpg', 'user_id': 'u1'})}, None)
+    image_id = json.loads(upload['body'])['object_name']
+    message = next(stream).decode()
+    assert message.startswith('id: ') and '\nevent: add\n' in message
+    data = json.loads(message.split('data: ', 1)[1])
+    assert data['item']['image_id'] == image_id and data['item']['original_filename'] == 'a.jpg'
+
+    local_adapter.save_file_content(image_id, b'jpeg')
+    handlers.delete_image_handler({'queryStringParameters': {'id': image_id, 'user_id': 'u1'}}, None)
+    assert '\nevent: remove\n' in next(stream).decode()
+
+    # The client went away: closing the generator unsubscribes
+    stream.close()
+    assert change_feed.stats()['subscribers'] == 0
+
+def test_file_broker_carries_events_between_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(change_feed, 'POLL_SECONDS', 0.01)
+    monkeypatch.setattr(change_feed, 'LOG_MAX_BYTES', 300)
+    publisher = change_feed.ChangeFeed(change_feed.FileBroker(str(tmp_path)))
+    listener_broker = change_feed.FileBroker(str(tmp_path))
+    listener = change_feed.ChangeFeed(listener_broker)
+    try:
+        subscription = listener.subscribe('u1')
+        received = []
+        for i in range(6):  # enough to rotate the log more than once
+            publisher.publish('u1', {'type': 'add', 'image_id': f'img_{i}', 'item': _item(f'img_{i}')})
+            events = subscription.get(timeout=2)
+            received.extend(e['image_id'] for e in events)
+        assert received == [f'img_{i}' for i in range(6)]
+        assert os.path.exists(tmp_path / 'changes.log.1')
+    finally:
+        listener_broker.stop()
+
+def test_websocket_route_sends_deltas(feed, local_store):
+    pytest.importorskip('flask_sock')
+    from simple_websocket import Client
+    from werkzeug.serving import make_server
+    saved = dict(os.environ)
+    import api_server  # sets local-dev env defaults on import; restored below
+    os.environ.clear()
+    os.environ.update(saved)
+    httpd = make_server('127.0.0.1', 0, api_server.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    ws = Client.connect(f'ws://127.0.0.1:{httpd.server_port}/images/changes/ws?user_id=u1')
+    try:
+        deadline = time.monotonic() + 5
+        while not change_feed.stats()['subscribers'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        change_feed.publish_saved(_item('img_1'))
+        events = json.loads(ws.receive(timeout=5))['events']
+        assert [(e['type'], e['image_id']) for e in events] == [('add', 'img_1')]
+    finally:
+        ws.close()
+        httpd.shutdown()
@@ -0,0 +1,74 @@
+import io
+import os
+import zipfile
+import boto3
+from moto import mock_s3
+from src.app import handlers
+from src.utils import export, local_adapter
+
+def _add(image_id, data, filename, tag='trip', user_id='u1'):
+    if data is not None:
+        local_adapter.save_file_content(image_id, data)
+    local_adapter.save_metadata({'user_id': user_id, 'image_id': image_id, 'tag': tag, 'tags': [tag],
+                                 's3_key': image_id, 'original_filename': filename})
+
+def test_export_streams_a_valid_zip(local_store):
+    big = os.urandom(3 * 1024 * 1024)
+    _add('2025-01-01T10-00-00Z_a', big, 'beach.jpg')
+    _add('2025-01-02T10-00-00Z_b', b'second', 'beach.jpg')          # duplicate name
+    _add('2025-01-03T10-00-00Z_c', b'third', '../../etc/passwd')    # path stripped
+    _add('2025-01-04T10-00-00Z_d', None, 'gone.jpg')                 # object missing
+    _add('2025-01-05T10-00-00Z_e', b'other tag', 'x.jpg', tag='home')
+
+    response = handlers.export_images_handler(
+        {'queryStringParameters': {'user_id': 'u1', 'tag': 'trip'}}, None)
+    assert response['statusCode'] == 200
+    assert response['headers']['Content-Disposition'] == 'attachment; filename="images-trip.zip"'
+    chunks = list(response['stream'])
+    # Streamed in bounded pieces, never as one archive-sized buffer
+    assert max(len(c) for c in chunks) <= export.CHUNK_SIZE + 1024
+
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['beach.jpg', 'beach (2).jpg', 'passwd']
+        assert zf.read('beach.jpg') == big
+        assert zf.read('beach (2).jpg') == b'second'
+        assert zf.getinfo('beach.jpg').date_time == (2025, 1, 1, 10, 0, 0)
+
+def test_export_validation(local_store):
+    assert handlers.export_images_handler({'queryStringParameters': {}}, None)['statusCode'] == 400
+    assert handlers.export_images_handler(
+        {'queryStringParameters': {'user_id': 'u1', 'start_date': 'soon'}}, None)['statusCode'] == 400
+    assert handlers.export_images_handler({'queryStringParameters': {'user_id': 'nobody'}}, None)['statusCode'] == 404
+
+def test_export_from_s3_with_prefetch():
+    with mock_s3():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        items = []
+        for n in range(12):
+            key = f'img_{n:02d}.png'
+            if n != 5:
+                s3.put_object(Bucket='test-bucket', Key=key, Body=f'bytes {n}'.encode() * 1000)
+            items.append({'image_id': key, 's3_key': key})
+
+        data = b''.join(export.iter_zip('test-bucket', items, chunk_size=4096, prefetch=3))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            assert zf.namelist() == [i['image_id'] for i in items if i['image_id'] != 'img_05.png']
+            assert zf.read('img_11.png') == b'bytes 11' * 1000
+
+def test_abandoned_export_closes_prefetched_streams(local_store):
+    opened = []
+    class Tracked(io.BytesIO):
+        def close(self):
+            opened.remove(self)
+            super().close()
+    def opener(item):
+        stream = Tracked(b'x' * 10)
+        opened.append(stream)
+        return stream, 10
+    stream = export._prefetch(range(10), opener, depth=4)
+    next(stream)
+    stream.close()
+    # The one handed out is the consumer's to close; the ones opened ahead are closed
+    assert len(opened) == 1
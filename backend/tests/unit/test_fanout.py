@@ -0,0 +1,65 @@
+import os
+import threading
+from src.jobs import migrate_local_fanout, tier_objects
+from src.utils import local_adapter
+
+def test_object_path_layouts(local_store):
+    flat = local_adapter.object_path('img_1.jpg', levels=0)
+    nested = local_adapter.object_path('img_1.jpg', levels=3)
+    assert flat == os.path.join(local_adapter.IMAGES_DIR, 'img_1.jpg')
+    parts = os.path.relpath(nested, local_adapter.IMAGES_DIR).split(os.sep)
+    assert len(parts) == 4 and all(len(p) == 2 for p in parts[:3]) and parts[3] == 'img_1.jpg'
+    # Stable across processes and layouts share the prefix
+    assert local_adapter.object_path('img_1.jpg', levels=1) == os.path.join(local_adapter.IMAGES_DIR, parts[0], 'img_1.jpg')
+
+def test_fanned_store_round_trip_with_tiering(local_store, monkeypatch):
+    monkeypatch.setattr(local_adapter, 'FANOUT_LEVELS', 2)
+    local_adapter.save_file_content('a.jpg', b'a' * 2048)
+    path = local_adapter.get_file_content('a.jpg')
+    assert path == local_adapter.object_path('a.jpg') and open(path, 'rb').read() == b'a' * 2048
+
+    assert local_adapter.archive_file('a.jpg')[0] == 2048
+    assert not os.path.exists(path)
+    assert os.path.exists(local_adapter.object_path('a.jpg', local_adapter.ARCHIVE_DIR) + '.gz')
+    assert tier_objects.run_local(cold_after_days=0, report_only=True).tiers['cold']['objects'] == 1
+    assert local_adapter.get_file_content('a.jpg') == path
+
+    assert local_adapter.delete_file('a.jpg') is True
+    assert local_adapter.get_file_content('a.jpg') is None
+
+def test_online_migration_never_loses_a_file(local_store, monkeypatch):
+    names = [f'img_{n:04d}.jpg' for n in range(400)]
+    for name in names:
+        local_adapter.save_file_content(name, name.encode())
+    local_adapter.archive_file(names[0])
+
+    # The server switches layout first; old files are still found via the fallback
+    monkeypatch.setattr(local_adapter, 'FANOUT_LEVELS', 2)
+    assert local_adapter.get_file_content(names[1]) == local_adapter.object_path(names[1], levels=0)
+    # A re-upload mid-migration lands in the new layout and must win over the old copy
+    local_adapter.save_file_content(names[2], b'new version')
+
+    misses = []
+    stop = threading.Event()
+    def reader():
+        while not stop.is_set():
+            for name in names[1:50]:
+                if local_adapter.get_file_content(name) is None:
+                    misses.append(name)
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        moved, in_place, duplicates = migrate_local_fanout.migrate(2)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert misses == []
+    # 397 hot files + 1 archived moved; the stale copy of names[2] dropped. in_place also counts
+    # files the walk meets again in directories it created, so it is only bounded below
+    assert (moved, duplicates) == (398 + 1, 1) and in_place >= 1
+    assert sorted(os.listdir(local_adapter.IMAGES_DIR)) == sorted({p.split(os.sep)[-3] for p in
+                                                                   (local_adapter.object_path(n) for n in names[1:])})
+    assert open(local_adapter.get_file_content(names[2]), 'rb').read() == b'new version'
+    assert local_adapter.get_file_content(names[0]) == local_adapter.object_path(names[0])  # rehydrated into new layout
+    assert migrate_local_fanout.migrate(2) == (0, 400, 0)
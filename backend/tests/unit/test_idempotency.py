@@ -0,0 +1,121 @@
+import boto3
+import json
+import threading
+import time
+import pytest
+from moto import mock_s3, mock_dynamodb
+from src.app import handlers
+from src.utils import dynamo_utils, idempotency, local_adapter
+
+@pytest.fixture
+def local_store(local_store, monkeypatch):
+    monkeypatch.setattr(idempotency, '_stats', dict.fromkeys(idempotency._stats, 0))
+    yield local_store
+
+@pytest.fixture
+def dynamo_store(monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_TABLE_NAME', 'test-idempotency')
+    monkeypatch.setattr(idempotency, '_stats', dict.fromkeys(idempotency._stats, 0))
+    with mock_s3(), mock_dynamodb():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='test-bucket')
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}, {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        table = dynamodb.create_table(
+            TableName='test-idempotency',
+            KeySchema=[{'AttributeName': 'idempotency_key', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'idempotency_key', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        yield table
+
+def _upload(key, **body):
+    body = dict({'filename': 'beach.jpg', 'user_id': 'u1', 'tags': ['trip']}, **body)
+    return handlers.generate_upload_url_handler({'body': json.dumps(body), 'headers': {'Idempotency-Key': key}}, None)
+
+def test_retried_upload_replays_the_first_response(local_store):
+    first = _upload('k1')
+    retry = _upload('k1')
+    assert first['statusCode'] == retry['statusCode'] == 200
+    assert retry['headers']['Idempotent-Replayed'] == 'true' and 'Idempotent-Replayed' not in first['headers']
+    assert json.loads(retry['body'])['object_name'] == json.loads(first['body'])['object_name']
+    assert '/local-store/' + json.loads(first['body'])['object_name'] in json.loads(retry['body'])['upload_url']
+    assert len(local_adapter.query_images('u1')) == 1
+
+    # Another key (or no key) is another upload; the same key with another body is refused
+    assert json.loads(_upload('k2')['body'])['object_name'] != json.loads(first['body'])['object_name']
+    assert _upload('k1', filename='other.jpg')['statusCode'] == 422
+    assert len(local_adapter.query_images('u1')) == 2
+    # Keys are per user: u2 reusing k1 gets its own upload
+    assert _upload('k1', user_id='u2')['statusCode'] == 200
+    assert idempotency.stats()['replayed'] == 1 and idempotency.stats()['stored'] == 3
+
+def test_in_progress_key_is_a_conflict_and_failures_are_not_stored(local_store, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    @idempotency.idempotent('POST /slow')
+    def slow(event, context):
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'statusCode': 201, 'headers': {}, 'body': '{"n":%d}' % len(calls)}
+
+    event = {'body': '{"user_id":"u1"}', 'headers': {'idempotency-key': 'k'}}
+    results = []
+    worker = threading.Thread(target=lambda: results.append(slow(event, None)))
+    worker.start()
+    started.wait(5)
+    conflict = slow(event, None)
+    assert conflict['statusCode'] == 409 and conflict['headers']['Retry-After'] == '1'
+    release.set()
+    worker.join()
+    assert results[0]['statusCode'] == 201 and slow(event, None)['body'] == '{"n":1}' and len(calls) == 1
+
+    # A 5xx releases the key, so the retry runs for real
+    outcomes = iter([{'statusCode': 500, 'headers': {}, 'body': '{}'}, {'statusCode': 200, 'headers': {}, 'body': '"ok"'}])
+    flaky = idempotency.idempotent('POST /flaky')(lambda event, context: next(outcomes))
+    assert flaky(event, None)['statusCode'] == 500
+    assert flaky(event, None)['body'] == '"ok"' and flaky(event, None)['headers']['Idempotent-Replayed'] == 'true'
+
+    # An expired lease (a crashed first attempt) can be taken over
+    monkeypatch.setattr(idempotency, 'LOCK_SECONDS', -1)
+    crashed = idempotency.idempotent('POST /crash')(lambda event, context: (_ for _ in ()).throw(SystemExit))
+    with pytest.raises(SystemExit):
+        crashed(event, None)
+    assert idempotency.idempotent('POST /crash')(lambda event, context: {'statusCode': 200, 'body': '1'})(event, None)['body'] == '1'
+
+def test_save_metadata_retry_writes_once_with_dynamodb(dynamo_store, monkeypatch):
+    saves = []
+    real_save = dynamo_utils.save_metadata
+
+    def counting_save(table_name, item):
+        saves.append(item['image_id'])
+        return real_save(table_name, item)
+
+    monkeypatch.setattr(dynamo_utils, 'save_metadata', counting_save)
+    event = {'body': json.dumps({'user_id': 'u1', 'image_id': 'img_1.jpg', 'tag': 'trip'}),
+             'headers': {'Idempotency-Key': 'retry-me'}}
+    first = handlers.save_metadata_handler(event, None)
+    replay = handlers.save_metadata_handler(event, None)
+    assert first['statusCode'] == replay['statusCode'] == 201 and replay['headers']['Idempotent-Replayed'] == 'true'
+    assert replay['body'] == first['body'] and saves == ['img_1.jpg']
+    [record] = dynamo_store.scan()['Items']
+    assert record['idempotency_key'] == 'POST /save-metadata#u1#retry-me' and record['status'] == 'completed'
+    assert record['expires_at'] > time.time() + idempotency.TTL_SECONDS - 60
+
+    # A retry that loses the race (its lookup ran before the first attempt's claim) is stopped by the conditional create
+    real_get = idempotency._get
+    lookups = iter([None])
+    monkeypatch.setattr(idempotency, '_get', lambda record_key: next(lookups, None) or real_get(record_key))
+    assert handlers.save_metadata_handler(event, None)['headers']['Idempotent-Replayed'] == 'true'
+    assert saves == ['img_1.jpg'] and idempotency.stats()['replayed'] == 2
+
+    # Without the header nothing changes
+    handlers.save_metadata_handler({'body': event['body']}, None)
+    assert len(saves) == 2 and len(dynamo_store.scan()['Items']) == 1
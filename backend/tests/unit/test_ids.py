@@ -0,0 +1,86 @@
+import datetime
+import json
+import boto3
+import pytest
+from moto import mock_dynamodb
+from src.app import handlers
+from src.utils import ids, local_adapter
+
+UTC = datetime.timezone.utc
+
+def _legacy_id(dt, name='photo.jpg'):
+    # What generate_upload_url_handler used to build
+    return f"{dt.replace(tzinfo=None).isoformat().replace(':', '-')}Z_123e4567-e89b-12d3-a456-426614174000-{name}"
+
+def test_new_ids_are_compact_sorted_and_after_legacy_ids():
+    t0 = datetime.datetime(2025, 3, 1, 12, 0, 0, tzinfo=UTC)
+    same_ms = [ids.new_image_id('IMG_1.JPG', now=t0) for _ in range(50)]
+    later = ids.new_image_id('x.tar.gz', now=t0 + datetime.timedelta(milliseconds=1))
+    
+    assert same_ms == sorted(same_ms) and len(set(same_ms)) == 50
+    assert later > same_ms[-1]
+    assert same_ms[0].startswith('img_') and same_ms[0].endswith('.jpg') and len(same_ms[0]) == 34
+    assert ids.new_image_id('no extension', now=t0)[-1] != '.'
+    assert _legacy_id(datetime.datetime(2099, 1, 1)) < same_ms[0]
+
+def test_parse_timestamp_handles_both_schemes():
+    t = datetime.datetime(2025, 3, 1, 12, 30, 45, 123000, tzinfo=UTC)
+    assert ids.parse_timestamp(ids.new_image_id(now=t)) == t
+    assert ids.parse_timestamp(_legacy_id(t)) == t
+    assert ids.parse_timestamp(_legacy_id(t.replace(microsecond=0))) == t.replace(microsecond=0)
+    assert ids.parse_timestamp('2023-01-02') == datetime.datetime(2023, 1, 2, tzinfo=UTC)
+    assert ids.parse_timestamp('holiday.jpg') is None
+
+def test_key_ranges_follow_dates_not_raw_strings():
+    t = datetime.datetime(2025, 3, 1, 12, 30, 45, 500000, tzinfo=UTC)
+    inside = [_legacy_id(t), ids.new_image_id(now=t), '2025-03-01']
+    before = [_legacy_id(t - datetime.timedelta(days=1)), ids.new_image_id(now=t - datetime.timedelta(days=1))]
+    after = [_legacy_id(t + datetime.timedelta(days=1)), ids.new_image_id(now=t + datetime.timedelta(days=1))]
+
+    # Date-only end covers the whole day; ISO times with ':' (the old bug) match '-' keys
+    for start, end in [('2025-03-01', '2025-03-01'), ('2025-03-01T00:00:00Z', '2025-03-01T23:59:59Z'),
+                       ('2025-03-01T14:00:00+02:00', '2025-03-01T12:31:00')]:
+        ranges = ids.key_ranges(start, end)
+        assert all(ids.in_ranges(i, ranges) for i in inside if i != '2025-03-01' or start == '2025-03-01')
+        assert not any(ids.in_ranges(i, ranges) for i in before + after)
+
+    ranges = ids.key_ranges('2025-03-01T12:31:00Z', None)
+    assert [i for i in inside + after if ids.in_ranges(i, ranges)] == after
+    assert ids.key_ranges(None, None) is None
+    assert ids.key_ranges('2025-03-02', '2025-03-01') == []
+    with pytest.raises(ValueError):
+        ids.key_ranges('yesterday', None)
+
+def test_date_filter_over_mixed_ids_in_dynamodb():
+    with mock_dynamodb():
+        table = boto3.resource('dynamodb', region_name='us-east-1').create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                       {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        days = [datetime.datetime(2025, 3, d, 9, 15, tzinfo=UTC) for d in (1, 2, 3, 4)]
+        expected = []
+        for n, day in enumerate(days):
+            for image_id in (_legacy_id(day), ids.new_image_id(now=day)):
+                table.put_item(Item={'user_id': 'u1', 'image_id': image_id, 'n': n})
+                if n in (1, 2):
+                    expected.append(image_id)
+
+        event = {'queryStringParameters': {'user_id': 'u1', 'start_date': '2025-03-02T00:00:00Z',
+                                           'end_date': '2025-03-03'}}
+        body = json.loads(handlers.list_images_handler(event, None)['body'])
+        assert [i['image_id'] for i in body['images']] == sorted(expected)
+
+        event['queryStringParameters']['end_date'] = 'next tuesday'
+        assert handlers.list_images_handler(event, None)['statusCode'] == 400
+
+def test_local_adapter_uses_the_same_ranges(local_store):
+    old = _legacy_id(datetime.datetime(2025, 3, 1, 9, 0))
+    new = ids.new_image_id(now=datetime.datetime(2025, 3, 5, 9, 0, tzinfo=UTC))
+    for image_id in (old, new):
+        local_adapter.save_metadata({'user_id': 'u1', 'image_id': image_id, 'tag': 'a'})
+
+    assert [i['image_id'] for i in local_adapter.query_images('u1', start_date='2025-03-01', end_date='2025-03-31')] == [old, new]
+    assert [i['image_id'] for i in local_adapter.query_images('u1', start_date='2025-03-02')] == [new]
@@ -0,0 +1,142 @@
+import boto3
+import os
+import struct
+import pytest
+from moto import mock_s3, mock_dynamodb
+from src.jobs import enrich_headers
+from src.utils import dynamo_utils, image_headers, local_adapter
+
+def _exif(orientation=6, taken='2023:07:14 18:02:11', offset='+02:00', make='Canon', model='Canon EOS R6'):
+    """Little-endian TIFF: IFD0 (Make, Model, Orientation, ExifIFD) -> Exif IFD (DateTimeOriginal, OffsetTime)."""
+    strings = [(0x010F, make), (0x0110, model)]
+    blob = b''
+    data_start = 8 + 2 + 12 * 4 + 4 + 2 + 12 * 2 + 4
+    entries, exif_entries = [], []
+    for tag, text in strings:
+        raw = text.encode() + b'\x00'
+        entries.append(struct.pack('<HHII', tag, 2, len(raw), data_start + len(blob)))
+        blob += raw
+    entries.append(struct.pack('<HHIHH', 0x0112, 3, 1, orientation, 0))
+    entries.append(struct.pack('<HHII', 0x8769, 4, 1, 8 + 2 + 12 * 4 + 4))
+    for tag, text in ((0x9003, taken), (0x9011, offset)):
+        raw = text.encode() + b'\x00'
+        exif_entries.append(struct.pack('<HHII', tag, 2, len(raw), data_start + len(blob)))
+        blob += raw
+    return (b'II*\x00' + struct.pack('<I', 8)
+            + struct.pack('<H', 4) + b''.join(entries) + b'\x00' * 4
+            + struct.pack('<H', 2) + b''.join(exif_entries) + b'\x00' * 4 + blob)
+
+def _jpeg(width, height, exif=None, padding=0):
+    segments = b''
+    if exif is not None:
+        payload = b'Exif\x00\x00' + exif
+        segments += b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+    # Large application segments (e.g. an embedded preview) push the frame header back
+    while padding > 0:
+        chunk = min(padding, 65000)
+        segments += b'\xff\xe2' + struct.pack('>H', chunk + 2) + b'\x00' * chunk
+        padding -= chunk
+    sof = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 1) + b'\x01\x11\x00'
+    return b'\xff\xd8' + segments + sof + b'\xff\xda\x00\x08' + os.urandom(200_000) + b'\xff\xd9'
+
+def _png(width, height):
+    ihdr = struct.pack('>II5B', width, height, 8, 2, 0, 0, 0)
+    chunk = lambda kind, data: struct.pack('>I', len(data)) + kind + data + b'\x00' * 4
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', os.urandom(100_000)) + chunk(b'IEND', b'')
+
+def _webp_extended(width, height, exif):
+    vp8x = bytes([0x08, 0, 0, 0]) + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+    image = os.urandom(300_001)
+    body = (b'WEBP' + b'VP8X' + struct.pack('<I', 10) + vp8x
+            + b'VP8 ' + struct.pack('<I', len(image)) + image + b'\x00'
+            + b'EXIF' + struct.pack('<I', len(exif)) + exif)
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+class _Counting:
+    def __init__(self, data):
+        self.data = data
+
+    def __call__(self, offset, length):
+        return self.data[offset:offset + length], len(self.data)
+
+def _parse(data):
+    reader = image_headers.RangeReader(_Counting(data))
+    return image_headers.parse(reader), reader
+
+def test_jpeg_dimensions_and_exif_from_the_first_block():
+    info, reader = _parse(_jpeg(4000, 3000, _exif()))
+    # Orientation 6 is rotated 90 degrees: displayed portrait
+    assert info == {'format': 'jpeg', 'width': 3000, 'height': 4000,
+                    'taken_at': '2023-07-14T18:02:11+02:00', 'camera': 'Canon EOS R6'}
+    assert (reader.requests, reader.fetched) == (1, image_headers.HEAD_BYTES)
+
+    info, _ = _parse(_jpeg(640, 480, _exif(orientation=1, offset='', make='Apple', model='iPhone 13')))
+    assert info['width'] == 640 and info['taken_at'] == '2023-07-14T18:02:11' and info['camera'] == 'Apple iPhone 13'
+
+def test_frame_header_past_the_first_block_costs_one_more_small_read():
+    info, reader = _parse(_jpeg(1920, 1080, padding=150_000))
+    assert (info['width'], info['height']) == (1920, 1080)
+    # Segments are skipped by length, reading only their 4-byte headers
+    assert reader.fetched < 150_000 and reader.requests <= 4
+
+    # A header that never ends is abandoned at the budget, not read to the end
+    with pytest.raises(image_headers.ReadBudgetExceeded):
+        image_headers.parse(image_headers.RangeReader(_Counting(_jpeg(10, 10, padding=1_000_000))))
+
+def test_png_gif_and_webp():
+    assert _parse(_png(800, 600))[0] == {'format': 'png', 'width': 800, 'height': 600}
+    assert _parse(b'GIF89a' + struct.pack('<HH', 32, 16) + b'\x00' * 100)[0] == {'format': 'gif', 'width': 32, 'height': 16}
+    info, reader = _parse(_webp_extended(1024, 768, _exif(orientation=1)))
+    assert info == {'format': 'webp', 'width': 1024, 'height': 768,
+                    'taken_at': '2023-07-14T18:02:11+02:00', 'camera': 'Canon EOS R6'}
+    # The EXIF chunk follows 300 KB of image data; only its block was fetched
+    assert reader.fetched < 100_000
+    assert _parse(b'not an image')[0] is None
+
+def test_enrich_local_store_reads_headers_only(local_store):
+    jpeg = _jpeg(4000, 3000, _exif())
+    local_adapter.save_file_content('a.jpg', jpeg)
+    local_adapter.save_file_content('b.png', _png(800, 600))
+    local_adapter.save_file_content('c.bin', b'plain text')
+    local_adapter.archive_file('b.png')
+    for image_id in ('a.jpg', 'b.png', 'c.bin', 'gone.jpg'):
+        dynamo_utils.save_metadata('test-table', {'user_id': 'u1', 'image_id': image_id, 'file_size': 1})
+
+    scanned, enriched, failed, bytes_read = enrich_headers.enrich('test-table', 'test-bucket', workers=2)
+    assert (scanned, enriched, failed) == (4, 3, 1)
+    assert bytes_read < 3 * image_headers.HEAD_BYTES
+    a = dynamo_utils.get_metadata('test-table', 'u1', 'a.jpg')
+    assert (a['width'], a['height'], a['file_size'], a['taken_at']) == (3000, 4000, len(jpeg), '2023-07-14T18:02:11+02:00')
+    assert a['enriched_at'].endswith('Z')
+    # Read from the cold tier in place: still archived
+    assert dynamo_utils.get_metadata('test-table', 'u1', 'b.png')['width'] == 800
+    assert local_adapter._locate('b.png') is None
+    c = dynamo_utils.get_metadata('test-table', 'u1', 'c.bin')
+    assert c['file_size'] == 10 and 'width' not in c
+
+    # Enriched items are not visited again
+    assert enrich_headers.enrich('test-table', 'test-bucket') == (1, 0, 1, 0)
+
+def test_enrich_from_s3_uses_ranged_gets(monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    with mock_s3(), mock_dynamodb():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        boto3.resource('dynamodb', region_name='us-east-1').create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}, {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        )
+        jpeg = _jpeg(1920, 1080, padding=100_000)
+        s3.put_object(Bucket='test-bucket', Key='a.jpg', Body=jpeg)
+        s3.put_object(Bucket='test-bucket', Key='empty.jpg', Body=b'')
+        for image_id in ('a.jpg', 'empty.jpg'):
+            dynamo_utils.save_metadata('test-table', {'user_id': 'u1', 'image_id': image_id})
+
+        scanned, enriched, failed, bytes_read = enrich_headers.enrich('test-table', 'test-bucket', workers=2)
+        assert (scanned, enriched, failed) == (2, 2, 0)
+        assert bytes_read < len(jpeg) // 2
+        a = dynamo_utils.get_metadata('test-table', 'u1', 'a.jpg')
+        assert (a['width'], a['height'], a['file_size']) == (1920, 1080, len(jpeg))
+        assert dynamo_utils.get_metadata('test-table', 'u1', 'empty.jpg')['file_size'] == 0
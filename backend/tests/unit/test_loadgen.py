@@ -0,0 +1,103 @@
+import asyncio
+import random
+import threading
+import pytest
+from collections import Counter
+from werkzeug.serving import make_server
+from src.jobs import loadgen
+
+@pytest.fixture
+def server(local_store):
+    import api_server
+    httpd = make_server('127.0.0.1', 0, api_server.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+def test_zipf_skew_and_mix():
+    rng = random.Random(1)
+    counts = Counter(loadgen.Zipf(100, 1.2, rng).sample() for _ in range(20000))
+    assert counts[0] > 5 * counts[9] > 0 and max(counts) < 100
+    uniform = Counter(loadgen.Zipf(4, 0, rng).sample() for _ in range(20000))
+    assert min(uniform.values()) > 4000
+
+    assert loadgen.parse_mix('list=3,upload=1,delete=0') == (['list', 'upload'], [3.0, 4.0])
+    with pytest.raises(ValueError):
+        loadgen.parse_mix('browse=1')
+
+def test_replay_schedule_parses_common_log_formats():
+    lines = [
+        '10.0.0.1 - - [19/Oct/2026:13:55:36 +0000] "GET /images?user_id=u1 HTTP/1.1" 200 2326 "-" "curl/8"',
+        '10.0.0.1 - - [19/Oct/2026:15:55:38 +0200] "GET /images/img_01JAB/download HTTP/1.1" 200 90',
+        '127.0.0.1 - - [19/Oct/2026 13:55:40] "DELETE /images/img_01JAB?user_id=u1 HTTP/1.1" 200 -',
+        '127.0.0.1 - - [19/Oct/2026 13:55:41] "PUT /local-store/img_01JAB?sig=x HTTP/1.1" 200 -',
+        '127.0.0.1 - - [19/Oct/2026 13:55:41] "GET /local-store/img_01JAB?sig=x HTTP/1.1" 200 -',
+        '127.0.0.1 - - [19/Oct/2026 13:55:41] "OPTIONS /images HTTP/1.1" 204 -',
+        'not a log line',
+    ]
+    skipped = Counter()
+    assert list(loadgen.replay_schedule(lines, speed=2, skipped=skipped)) == [
+        (0.0, 'GET', '/images?user_id=u1'), (1.0, 'GET', '/images/img_01JAB/download')]
+    assert skipped == {'DELETE': 1, 'PUT': 1, 'signed_url': 1, 'unparsed': 1}
+    assert [m for _, m, _ in loadgen.replay_schedule(lines, writes=True)] == ['GET', 'GET', 'DELETE']
+    assert loadgen.route_label('GET', '/images/img_01JAB/download') == 'GET /images/{id}/download'
+
+def test_open_loop_mixed_workload_against_api_server(server):
+    generator = loadgen.LoadGenerator(server, users=5, tags=3, payload_bytes=1024, seed=7,
+                                      mix='upload=4,list=2,download=2,delete=1,usage=1')
+    report = asyncio.run(generator.run_synthetic(rate=200, duration=1.0))
+    steps = report['steps']
+    assert set(steps) == {'upload_url', 'put', 'list', 'download_url', 'get', 'delete', 'usage'}
+    assert report['errors'] == 0 and report['dropped'] == 0
+    assert steps['put']['requests'] == steps['upload_url']['requests']
+    assert 0 < steps['list']['p50_ms'] <= steps['list']['p99_ms'] <= steps['list']['max_ms']
+    assert 'upload_url' in loadgen.format_report(report)
+
+    # Replaying what was just generated, as a dev-server log
+    log = [f'127.0.0.1 - - [19/Oct/2026 13:55:{i:02d}] "GET /usage?user_id=load_user_{i % 5} HTTP/1.1" 200 -'
+           for i in range(5)]
+    replay = asyncio.run(loadgen.LoadGenerator(server).run_replay(log, speed=20))
+    assert replay['steps']['GET /usage']['requests'] == 5 and replay['errors'] == 0
+
+def test_arrivals_beyond_max_in_flight_are_dropped_not_queued():
+    async def slow(*args):
+        await asyncio.sleep(0.2)
+
+    generator = loadgen.LoadGenerator('http://unused', max_in_flight=3)
+    report = asyncio.run(generator._run(((i * 0.001, 'x') for i in range(10)), slow))
+    assert report['dropped'] == 7 and report['peak_in_flight'] == 3
+
+def test_client_reuses_connections_and_reads_chunked_bodies():
+    async def scenario():
+        requests_seen = []
+
+        async def handle(reader, writer):
+            # Keep-alive server: chunked and sized bodies; closes after three requests on a connection
+            for n in range(3):
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) != b'\r\n':
+                    pass
+                requests_seen.append(request_line.split()[1])
+                if n % 2:
+                    writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+                else:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 4\r\n\r\nnope')
+                await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        url = f'http://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+        client = loadgen.HttpClient(timeout=5)
+        responses = [await client.request('GET', f'{url}/r{i}') for i in range(7)]
+        client.close()
+        server.close()
+        return client, responses, requests_seen
+
+    client, responses, seen = asyncio.run(scenario())
+    assert responses[:2] == [(404, b'nope'), (200, b'abcde')]
+    assert len(seen) == 7
+    # Three requests per connection; a request on a connection the server closed is retried on a new one
+    assert client.connections_opened == 3
@@ -0,0 +1,211 @@
+import json
+import os
+import pytest
+from src.utils import local_adapter, local_sqlite, dynamo_utils
+from src.jobs import migrate_local_shards, migrate_local_sqlite
+
+def _item(user_id, image_id, tag='a'):
+    return {'user_id': user_id, 'image_id': image_id, 'tag': tag, 'tags': [tag]}
+
+def test_save_query_delete_legacy_file(local_store):
+    local_adapter.save_metadata(_item('u1', 'img2'))
+    local_adapter.save_metadata(_item('u1', 'img1', 'b'))
+    local_adapter.save_metadata(_item('u2', 'img3'))
+    
+    assert [i['image_id'] for i in local_adapter.query_images('u1')] == ['img1', 'img2']
+    assert [i['image_id'] for i in local_adapter.query_images('u1', 'b')] == ['img1']
+    assert local_adapter.delete_metadata('u1', 'img1') is True
+    assert local_adapter.delete_metadata('u1', 'img1') is False
+    
+    with open(local_store / 'metadata.json') as f:
+        assert len(json.load(f)) == 2
+
+def test_sharded_writes_touch_one_file(local_store, monkeypatch):
+    monkeypatch.setattr(local_adapter, 'DB_SHARDS', 8)
+    users = [f'user{i}' for i in range(20)]
+    for u in users:
+        local_adapter.save_metadata(_item(u, 'img'))
+    
+    for u in users:
+        path = local_adapter.shard_path(local_adapter.shard_for_user(u))
+        with open(path) as f:
+            assert any(i['user_id'] == u for i in json.load(f))
+        assert len(local_adapter.query_images(u)) == 1
+    assert not os.path.exists(local_store / 'metadata.json')
+
+def test_migrate_legacy_file_to_shards(local_store, monkeypatch):
+    for i in range(10):
+        local_adapter.save_metadata(_item(f'user{i % 3}', f'img{i}'))
+    
+    count = migrate_local_shards.migrate(4)
+    assert count == 10
+    assert os.path.exists(local_store / 'metadata.json.migrated')
+    
+    monkeypatch.setattr(local_adapter, 'DB_SHARDS', 4)
+    assert len(local_adapter.query_images('user0')) == 4
+    assert sum(1 for _ in local_adapter.iter_all_metadata()) == 10
+
+def _write_many(worker, count):
+    for n in range(count):
+        local_adapter.save_metadata(_item('shared_user', f'w{worker:02d}-{n:03d}'))
+
+@pytest.mark.skipif(local_adapter.fcntl is None, reason="needs fcntl (POSIX)")
+def test_concurrent_process_writes_are_not_lost(local_store):
+    import multiprocessing
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=_write_many, args=(w, 25)) for w in range(8)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+    
+    assert len(local_adapter.query_images('shared_user')) == 8 * 25
+    assert not [f for f in os.listdir(local_store) if '.tmp.' in f]
+
+def test_group_commit_thread_writes_are_not_lost(local_store, monkeypatch):
+    import threading
+    monkeypatch.setattr(local_adapter, 'GROUP_COMMIT', True)
+    saves = []
+    original_save = local_adapter._save_index
+    monkeypatch.setattr(local_adapter, '_save_index', lambda path, index: (saves.append(path), original_save(path, index)))
+    
+    threads = [threading.Thread(target=_write_many, args=(w, 20)) for w in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    assert len(local_adapter.query_images('shared_user')) == 16 * 20
+    assert len(saves) <= 16 * 20
+
+def test_corrupt_metadata_file_is_not_treated_as_empty(local_store):
+    local_adapter.save_metadata(_item('u1', 'img1'))
+    with open(local_store / 'metadata.json', 'w') as f:
+        f.write('[{"user_id": "u1", "ima')
+    
+    with pytest.raises(ValueError):
+        local_adapter.save_metadata(_item('u2', 'img2'))
+    with open(local_store / 'metadata.json') as f:
+        assert f.read().startswith('[{"user_id": "u1"')
+
+PARITY_ITEMS = [
+    {'user_id': 'user1', 'image_id': '2023-01-03', 'tag': 'a', 'tags': ['a', 'b']},
+    {'user_id': 'user1', 'image_id': '2023-01-01', 'tag': 'a', 'tags': ['a']},
+    {'user_id': 'user1', 'image_id': '2023-01-02', 'tag': 'b', 'tags': ['b']},
+    {'user_id': 'user2', 'image_id': '2023-01-01T08-00-00Z', 'tag': 'a', 'tags': ['a']},
+    # A legacy item without a tag list, and a new-scheme id whose tag list omits the primary tag
+    {'user_id': 'user1', 'image_id': '2023-01-04', 'tag': 'b'},
+    {'user_id': 'user1', 'image_id': 'img_01J1K2M3N4P5Q6R7S8T9V0W1X2.jpg', 'tag': 'c', 'tags': ['a']},
+]
+
+PARITY_QUERIES = [
+    ('user1', None, None, None),
+    ('user1', 'b', None, None),
+    ('user1', 'a', None, None),
+    ('user1', None, '2023-01-02', '2023-01-03'),
+    (None, 'a', None, None),
+    (None, 'a', '2023-01-01', '2023-01-01'),
+    ('nobody', None, None, None),
+    (None, None, None, None),
+]
+
+def _streamed_keys(user_id, tag, start, end):
+    pages = list(dynamo_utils.iter_image_pages('test-table', user_id, tag, start, end, page_size=2))
+    assert all(0 < len(page) <= 2 for page in pages)
+    return [(i['user_id'], i['image_id']) for page in pages for i in page]
+
+def _run_parity_queries():
+    """Each query's keys in the order returned, by query_images and by 2-item streamed pages."""
+    results = []
+    for user_id, tag, start, end in PARITY_QUERIES:
+        items = dynamo_utils.query_images('test-table', user_id, tag, start, end)
+        results.append([(i['user_id'], i['image_id']) for i in items])
+        if user_id:  # moto pages a GSI query out of order; tag-only streams are checked locally
+            results.append(_streamed_keys(user_id, tag, start, end))
+    # A date range without user or tag is a Scan, which is unordered on DynamoDB
+    items = dynamo_utils.query_images('test-table', None, None, '2023-01-01', '2023-01-02')
+    results.append(sorted((i['user_id'], i['image_id']) for i in items))
+
+    # Cursor pagination walks the same pages, cursors included
+    for tags, mode in ((['a'], 'all'), (['a', 'b'], 'any'), (['a', 'b'], 'all')):
+        cursor, pages = None, []
+        while True:
+            items, cursor = dynamo_utils.query_images_by_tags('test-table', 'user1', tags, mode, limit=2, cursor=cursor)
+            pages.append(([i['image_id'] for i in items], cursor))
+            if cursor is None:
+                break
+        results.append(pages)
+    return results
+
+@pytest.mark.parametrize('engine', ['json', 'sqlite'])
+def test_local_engines_match_dynamodb(local_store, monkeypatch, engine):
+    monkeypatch.delenv('USE_LOCAL_STORAGE')
+    import boto3
+    from moto import mock_dynamodb
+    with mock_dynamodb():
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'image_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'tag', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'tag-index',
+                'KeySchema': [{'AttributeName': 'tag', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+            }]
+        )
+        # moto applies Limit to insertion order before sorting a page, so it gets them in key order
+        for item in sorted(PARITY_ITEMS, key=lambda i: i['image_id']):
+            table.put_item(Item=item)
+        expected = _run_parity_queries()
+    
+    # Upload order, not insertion or sorted-by-test order, and a primary tag counts as a tag
+    assert expected[0] == [('user1', '2023-01-01'), ('user1', '2023-01-02'), ('user1', '2023-01-03'),
+                           ('user1', '2023-01-04'), ('user1', 'img_01J1K2M3N4P5Q6R7S8T9V0W1X2.jpg')]
+    assert [image_id for _, image_id in expected[2]] == ['2023-01-02', '2023-01-03', '2023-01-04']
+    assert expected[-2] == [(['2023-01-01', '2023-01-02'], '2023-01-02'), (['2023-01-03', '2023-01-04'], '2023-01-04'),
+                            (['img_01J1K2M3N4P5Q6R7S8T9V0W1X2.jpg'], None)]
+
+    monkeypatch.setenv('USE_LOCAL_STORAGE', 'true')
+    monkeypatch.setenv('LOCAL_DB_ENGINE', engine)
+    for item in PARITY_ITEMS:
+        assert dynamo_utils.save_metadata('test-table', item)
+    assert _run_parity_queries() == expected
+    for user_id, tag, start, end in PARITY_QUERIES:
+        items = dynamo_utils.query_images('test-table', user_id, tag, start, end)
+        assert _streamed_keys(user_id, tag, start, end) == [(i['user_id'], i['image_id']) for i in items]
+    
+    assert dynamo_utils.get_metadata('test-table', 'user1', '2023-01-02')['tag'] == 'b'
+    assert dynamo_utils.delete_metadata_item('test-table', 'user1', '2023-01-02') is True
+    assert dynamo_utils.get_metadata('test-table', 'user1', '2023-01-02') is None
+
+def test_migrate_json_to_sqlite(local_store):
+    for item in PARITY_ITEMS:
+        local_adapter.save_metadata(item)
+    
+    assert migrate_local_sqlite.migrate(batch_size=3) == 6
+    assert [i['image_id'] for i in local_sqlite.query_images('user1', 'b')] == ['2023-01-02', '2023-01-03', '2023-01-04']
+    assert local_sqlite.query_images('user1', fields=['image_id'])[0] == {'image_id': '2023-01-01'}
+
+@pytest.mark.parametrize('engine', ['json', 'sqlite'])
+def test_multi_tag_queries(local_store, monkeypatch, engine):
+    monkeypatch.setenv('USE_LOCAL_STORAGE', 'true')
+    monkeypatch.setenv('LOCAL_DB_ENGINE', engine)
+    for n in range(1, 31):
+        tags = [t for t, step in (('two', 2), ('three', 3), ('five', 5)) if n % step == 0]
+        dynamo_utils.save_metadata('t', {'user_id': 'u1', 'image_id': f'{n:03d}', 'tag': tags[0] if tags else 'none', 'tags': tags})
+    
+    items, cursor = dynamo_utils.query_images_by_tags('t', 'u1', ['two', 'three'], 'all')
+    assert [i['image_id'] for i in items] == ['006', '012', '018', '024', '030']
+    
+    items, cursor = dynamo_utils.query_images_by_tags('t', 'u1', ['three', 'five'], 'any', limit=5, fields=['tags'])
+    assert cursor == '010'
+    assert items[0] == {'tags': ['three']}
+    items, cursor = dynamo_utils.query_images_by_tags('t', 'u1', ['three', 'five'], 'any', limit=20, cursor=cursor)
+    assert [i['image_id'] for i in items] == ['012', '015', '018', '020', '021', '024', '025', '027', '030']
+    assert cursor is None
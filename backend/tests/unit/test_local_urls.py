@@ -0,0 +1,56 @@
+import os
+from urllib.parse import urlsplit
+import pytest
+from src.utils import local_adapter, s3_utils
+
+@pytest.fixture
+def client(local_store):
+    saved = dict(os.environ)
+    import api_server  # sets local-dev env defaults on import; restored below
+    os.environ.clear()
+    os.environ.update(saved)
+    yield api_server.app.test_client()
+
+def _path(url):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}"
+
+def test_signed_urls_are_bound_to_method_object_and_expiry(client):
+    upload = s3_utils.generate_presigned_upload_url('bucket', 'img_1.jpg')
+    download = s3_utils.generate_presigned_download_url('bucket', 'img_1.jpg')
+    assert 'sig=' in upload and 'expires=' in upload
+
+    assert client.put('/local-store/img_1.jpg', data=b'jpeg bytes').status_code == 403
+    assert client.put(_path(download), data=b'jpeg bytes').status_code == 403  # GET-only signature
+    assert client.put(_path(upload), data=b'jpeg bytes').status_code == 200
+
+    assert client.get(_path(upload)).status_code == 403
+    assert client.get(_path(download).replace('img_1', 'img_2')).status_code == 403
+    response = client.get(_path(download))
+    assert response.status_code == 200 and response.data == b'jpeg bytes'
+
+    expired = local_adapter.generate_local_download_url('http://h', 'img_1.jpg', expiration=-1)
+    assert client.get(_path(expired)).status_code == 403
+
+def test_secret_is_shared_between_processes(client):
+    signature = local_adapter.sign_local_url('GET', 'a.jpg', 123)
+    # Another worker process starts without the cached key and reads the same file
+    local_adapter._url_secret_cache = None
+    assert local_adapter.sign_local_url('GET', 'a.jpg', 123) == signature
+    assert local_adapter.verify_local_url('GET', 'a.jpg', 123, signature, now=100)
+    assert not local_adapter.verify_local_url('GET', 'a.jpg', 123, signature, now=200)
+    assert not local_adapter.verify_local_url('GET', 'a.jpg', 'soon', signature)
+
+@pytest.mark.parametrize('mode,header', [('x-accel', 'X-Accel-Redirect'), ('x-sendfile', 'X-Sendfile')])
+def test_sendfile_modes_leave_the_bytes_to_the_proxy(client, monkeypatch, mode, header):
+    monkeypatch.setattr(local_adapter, 'SENDFILE_MODE', mode)
+    local_adapter.save_file_content('img_2.png', b'png bytes')
+    
+    response = client.get(_path(local_adapter.generate_local_download_url('http://h', 'img_2.png')))
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.headers['Content-Type'] == 'image/png'
+    if mode == 'x-accel':
+        assert response.headers[header] == '/protected-images/img_2.png'
+    else:
+        assert response.headers[header] == os.path.join(local_adapter.IMAGES_DIR, 'img_2.png')
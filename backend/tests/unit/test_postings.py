@@ -0,0 +1,29 @@
+import random
+from src.utils import postings
+
+def test_gallop_finds_first_not_less():
+    seq = list(range(0, 1000, 3))
+    for target in (-1, 0, 1, 2, 3, 500, 998, 999, 2000):
+        for lo in (0, 10, 200):
+            expected = next((i for i in range(lo, len(seq)) if seq[i] >= target), len(seq))
+            assert postings.gallop(seq, target, lo) == expected
+
+def test_intersect_and_union_match_set_operations():
+    rng = random.Random(7)
+    lists = [sorted(rng.sample(range(5000), n)) for n in (40, 900, 2500)]
+    
+    assert list(postings.intersect(lists)) == sorted(set(lists[0]) & set(lists[1]) & set(lists[2]))
+    assert list(postings.union(lists)) == sorted(set(lists[0]) | set(lists[1]) | set(lists[2]))
+    assert list(postings.intersect([lists[0], []])) == []
+
+def test_evaluate_paginates_with_cursor():
+    a = ['01', '02', '03', '05', '08', '13']
+    b = ['02', '03', '05', '07', '13', '21']
+    
+    page, cursor = postings.evaluate([a, b], 'all', limit=2)
+    assert (page, cursor) == (['02', '03'], '03')
+    page, cursor = postings.evaluate([a, b], 'all', after=cursor, limit=2)
+    assert (page, cursor) == (['05', '13'], None)
+    
+    page, cursor = postings.evaluate([a, b], 'any', start='03', end='08')
+    assert (page, cursor) == (['03', '05', '07', '08'], None)
@@ -0,0 +1,94 @@
+import json
+import os
+import time
+import pytest
+from src.app import handlers
+from src.utils import dynamo_utils, profiling
+
+@pytest.fixture
+def profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+    monkeypatch.setattr(profiling, 'TOKEN', 'secret')
+    monkeypatch.setattr(profiling, 'INTERVAL_MS', 1)
+    monkeypatch.setattr(profiling, '_stats', dict.fromkeys(profiling._stats, 0))
+    yield tmp_path
+
+def _busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+def slow_query(*args, **kwargs):
+    _busy(0.05)
+    return [{'image_id': 'a', 'file_size': 10}]
+
+def test_token_header_writes_a_collapsed_profile(profiles, monkeypatch):
+    monkeypatch.setattr(dynamo_utils, 'query_images', slow_query)
+    event = {'queryStringParameters': {'user_id': 'u1'}, 'headers': {'x-profile-token': 'secret'}}
+    response = handlers.get_storage_usage_handler(event, None)
+    assert json.loads(response['body'])['total_bytes'] == 10
+
+    name = response['headers']['X-Profile']
+    assert name.startswith(time.strftime('%Y')) and '_get-usage_' in name and name.endswith('.collapsed')
+    stacks = dict(line.rsplit(' ', 1) for line in (profiles / name).read_text().splitlines())
+    hot = max(stacks, key=lambda stack: int(stacks[stack]))
+    assert 'get_storage_usage_handler (handlers.py:' in hot and hot.split(';')[-1].startswith('_busy ')
+
+    # A wrong token (or none) is an ordinary request
+    event['headers']['x-profile-token'] = 'guess'
+    assert 'X-Profile' not in handlers.get_storage_usage_handler(event, None)['headers']
+    assert len(os.listdir(profiles)) == 1 and profiling.stats()['requested'] == 1
+
+def test_sampled_requests_keep_only_slow_ones(profiles, monkeypatch):
+    monkeypatch.setattr(dynamo_utils, 'query_images', slow_query)
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(profiling, 'MIN_MS', 10_000)
+    monkeypatch.setattr(profiling, 'FORMAT', 'speedscope')
+    event = {'queryStringParameters': {'user_id': 'u1'}}
+    handlers.get_storage_usage_handler(event, None)
+    assert os.listdir(profiles) == [] and profiling.stats()['below_min_ms'] == 1
+
+    monkeypatch.setattr(profiling, 'MIN_MS', 20)
+    response = handlers.get_storage_usage_handler(event, None)
+    assert 'X-Profile' not in response['headers']  # sampled captures are not announced to the client
+    [name] = os.listdir(profiles)
+    assert name.endswith('.speedscope.json')
+    profile = json.loads((profiles / name).read_text())
+    frames = [frame['name'] for frame in profile['shared']['frames']]
+    assert any(frame.startswith('slow_query ') for frame in frames)
+    assert profile['profiles'][0]['type'] == 'sampled' and profile['profiles'][0]['endValue'] >= 50
+
+def test_streamed_response_is_profiled_until_closed(profiles, monkeypatch):
+    monkeypatch.setattr(profiling, 'MAX_CONCURRENT', 1)
+    monkeypatch.setattr(profiling, '_captures', profiling.threading.BoundedSemaphore(1))
+
+    def chunks():
+        yield b'first'
+        _busy(0.03)
+        yield b'second'
+
+    @profiling.profiled('GET /stream')
+    def handler(event, context):
+        return {'statusCode': 200, 'headers': {}, 'stream': chunks()}
+
+    event = {'headers': {'X-Profile-Token': 'secret'}}
+    assert list(handler(event, None)['stream']) == [b'first', b'second']
+    [name] = os.listdir(profiles)
+    assert 'chunks (test_profiling.py:' in (profiles / name).read_text()
+
+    # A client that goes away before the first chunk still ends the capture and frees its slot
+    handler(event, None)['stream'].close()
+    assert len(os.listdir(profiles)) == 2
+    handler(event, None)['stream'].close()
+    assert profiling.stats()['busy'] == 0
+
+def test_continuous_sampling_covers_every_thread(profiles):
+    profiling.start_continuous(hz=500, flush_seconds=3600)
+    try:
+        _busy(0.05)
+    finally:
+        path = profiling.stop_continuous()
+    lines = open(path).read().splitlines()
+    assert '_continuous_' in os.path.basename(path)
+    assert any(line.startswith('MainThread;') and '_busy (test_profiling.py:' in line for line in lines)
+    assert profiling.stats()['continuous_samples'] >= 1 and profiling.stop_continuous() is None
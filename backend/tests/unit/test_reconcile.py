@@ -0,0 +1,99 @@
+import boto3
+import datetime
+import gzip
+import os
+import random
+import pytest
+from botocore.exceptions import ReadTimeoutError
+from moto import mock_s3, mock_dynamodb
+from src.jobs import reconcile
+from src.utils import local_adapter
+
+@pytest.fixture
+def resource_setup():
+    with mock_s3(), mock_dynamodb():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}, {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        )
+        yield s3, table
+
+def test_external_sort_spills_runs(tmp_path):
+    values = [[random.random()] for _ in range(1000)]
+    result = list(reconcile.external_sort(iter(values), key=lambda r: r[0], run_size=64, tmp_dir=str(tmp_path)))
+    
+    assert result == sorted(values)
+    assert not list(tmp_path.iterdir())
+
+def test_reconcile_finds_and_deletes_orphans(resource_setup, monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    s3, table = resource_setup
+    old = (datetime.datetime.utcnow() - datetime.timedelta(days=3)).isoformat() + 'Z'
+    for key in ('both-1', 'both-2', 'orphan-1', 'orphan-2'):
+        s3.put_object(Bucket='test-bucket', Key=key, Body=b'data')
+    for key in ('both-1', 'both-2', 'dangling-1'):
+        table.put_item(Item={'user_id': 'u1', 'image_id': key, 'upload_time': old})
+    recent = (datetime.datetime.utcnow() + datetime.timedelta(hours=2)).isoformat() + 'Z'
+    table.put_item(Item={'user_id': 'u1', 'image_id': 'in-flight', 'upload_time': recent})
+    
+    def run(apply):
+        return reconcile.reconcile(
+            reconcile.iter_s3_objects('test-bucket'),
+            reconcile.iter_dynamodb_metadata('test-table', segments=1, run_size=2),
+            grace_seconds=3600, apply=apply,
+            delete_objects=reconcile._delete_s3_objects('test-bucket'),
+            delete_metadata=reconcile._delete_dynamodb_items('test-table'),
+            # objects were just uploaded; run the job as if two hours later
+            now=datetime.datetime.utcnow().timestamp() + 7200)
+    
+    dry = run(apply=False)
+    assert (dry.orphan_objects, dry.dangling_metadata, dry.skipped_recent) == (2, 1, 1)
+    assert dry.deleted_objects == 0
+    
+    report = run(apply=True)
+    assert (report.deleted_objects, report.deleted_metadata) == (2, 1)
+    keys = [o['Key'] for o in s3.list_objects_v2(Bucket='test-bucket')['Contents']]
+    assert keys == ['both-1', 'both-2']
+    assert 'Item' not in table.get_item(Key={'user_id': 'u1', 'image_id': 'dangling-1'})
+
+def test_duplicate_local_copies_of_a_key_are_not_orphans(local_store):
+    old = (datetime.datetime.utcnow() - datetime.timedelta(days=3)).isoformat() + 'Z'
+    # A hot copy next to an archived copy (e.g. a rehydration racing the tier job), for a live key and an orphan
+    for key in ('live.jpg', 'orphan.jpg'):
+        local_adapter.save_file_content(key, b'data')
+        os.makedirs(local_store / 'archive', exist_ok=True)
+        with gzip.open(local_store / 'archive' / (key + '.gz'), 'wb') as f:
+            f.write(b'data')
+    local_adapter.save_metadata({'user_id': 'u1', 'image_id': 'live.jpg', 'upload_time': old})
+
+    report = reconcile.reconcile(reconcile.iter_local_objects(), reconcile.iter_local_metadata(),
+                                 grace_seconds=3600, apply=True,
+                                 delete_objects=reconcile._delete_local_objects,
+                                 delete_metadata=reconcile._delete_local_metadata,
+                                 now=datetime.datetime.utcnow().timestamp() + 7200)
+    assert (report.orphan_objects, report.dangling_metadata, report.deleted_objects) == (1, 0, 1)
+    assert os.path.exists(local_store / 'images' / 'live.jpg')
+    assert os.path.exists(local_store / 'archive' / 'live.jpg.gz')
+    assert not os.path.exists(local_store / 'images' / 'orphan.jpg')
+
+def test_a_segment_failing_mid_scan_deletes_nothing(monkeypatch):
+    class Table:
+        def scan(self, Segment=0, ExclusiveStartKey=None, **kwargs):
+            if Segment == 1 and ExclusiveStartKey:
+                raise ReadTimeoutError(endpoint_url='https://dynamodb')
+            return {'Items': [{'user_id': 'u1', 'image_id': f'seen-{Segment}'}],
+                    **({'LastEvaluatedKey': {'image_id': 'next'}} if Segment == 1 else {})}
+    monkeypatch.setattr(reconcile.dynamo_utils, 'get_dynamodb_resource',
+                        lambda: type('Resource', (), {'Table': lambda self, name: Table()})())
+    deleted = []
+    objects = iter([['seen-0', 4, 0.0], ['seen-1', 4, 0.0], ['unscanned-1', 4, 0.0], ['unscanned-2', 4, 0.0]])
+
+    with pytest.raises(ReadTimeoutError):
+        reconcile.reconcile(objects, reconcile.iter_dynamodb_metadata('test-table', segments=2),
+                            grace_seconds=0, apply=True, delete_objects=deleted.extend, delete_metadata=deleted.extend)
+    assert deleted == []
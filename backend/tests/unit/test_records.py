@@ -0,0 +1,74 @@
+import json
+import sys
+import pytest
+from src.utils import local_adapter, records
+
+def _upload_item(image_id='1700000000000_ab12cd34_photo.jpg'):
+    return {
+        'user_id': 'u1',
+        'image_id': image_id,
+        'tag': 'beach',
+        'tags': ['beach', 'sunset'],
+        'description': 'evening',
+        'content_type': 'image/jpeg',
+        'file_size': 2048,
+        's3_key': image_id,
+        'upload_time': '2025-03-01T18:30:05.123456Z',
+        'original_filename': 'photo.jpg',
+    }
+
+def test_round_trip_is_exact():
+    item = _upload_item()
+    record = records.Record.from_dict(item)
+    assert record.to_dict() == item
+    assert json.loads(json.dumps(record, default=records.to_json)) == item
+    # Stored compactly: int micros for the timestamp, s3_key not repeated, tags shared
+    assert type(record.upload_time) is int
+    assert record.s3_key is records._SAME_AS_IMAGE_ID
+    assert record.tags == ('beach', 'sunset')
+    assert record.tags[0] is sys.intern('beach')
+
+@pytest.mark.parametrize('value', [
+    '2025-03-01T18:30:05Z',         # isoformat() drops zero microseconds...
+    '2025-03-01T18:30:05.000000Z',  # ...so this one must be kept as written
+    '2025-03-01T18:30:05+00:00',
+    'yesterday',
+    1740853805,
+    None,
+])
+def test_timestamps_come_back_as_written(value):
+    record = records.Record.from_dict({'user_id': 'u1', 'image_id': 'i', 'created_at': value})
+    assert record['created_at'] == value
+    assert record.to_dict() == {'user_id': 'u1', 'image_id': 'i', 'created_at': value}
+
+def test_missing_and_unknown_attributes():
+    item = {'user_id': 'u1', 'image_id': 'i', 's3_key': 'other/key', 'rating': 5}
+    record = records.Record.from_dict(item)
+    assert record.to_dict() == item
+    assert 'tags' not in record and record.get('tags') is None
+    assert record.project(['image_id', 'rating', 'tags']) == {'image_id': 'i', 'rating': 5}
+    with pytest.raises(KeyError):
+        record['description']
+
+def test_local_adapter_keeps_records_and_returns_dicts(local_store):
+    item = _upload_item()
+    local_adapter.save_metadata(item)
+    local_adapter.save_metadata(dict(_upload_item('img_2'), tag='city', tags=['city']))
+
+    # Re-read from disk: the index holds records, the API still sees dicts
+    local_adapter._index_cache.clear()
+    fetched = local_adapter.get_metadata('u1', item['image_id'])
+    assert fetched == item
+    fetched['tags'].append('mutated')
+    assert local_adapter.get_metadata('u1', item['image_id']) == item
+
+    index = local_adapter._load_index(local_adapter.DB_FILE)
+    assert all(isinstance(r, records.Record) for r in index['u1'].values())
+    assert [i['image_id'] for i in local_adapter.query_images('u1', 'sunset')] == [item['image_id']]
+    assert local_adapter.query_images('u1', 'city', fields=['image_id', 'upload_time']) == [
+        {'image_id': 'img_2', 'upload_time': item['upload_time']}]
+
+    assert local_adapter.update_attributes('u1', 'img_2', {'phash': 'ff00'}) is True
+    assert local_adapter.get_metadata('u1', 'img_2')['phash'] == 'ff00'
+    with open(local_store / 'metadata.json') as f:
+        assert sorted(json.load(f), key=lambda i: i['image_id'])[0] == item
@@ -0,0 +1,131 @@
+import json
+import time
+import boto3
+import pytest
+from moto import mock_s3, mock_dynamodb
+from src.app import handlers
+from src.utils import dynamo_utils, resilience, s3_utils, search_index
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    resilience.reset()
+    yield
+    resilience.reset()
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    with mock_s3(), mock_dynamodb():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        table = boto3.resource('dynamodb', region_name='us-east-1').create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}, {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        )
+        table.put_item(Item={'user_id': 'u1', 'image_id': 'img_1', 'tag': 'trip'})
+        s3.put_object(Bucket='test-bucket', Key='img_1', Body=b'pixels')
+        yield s3, table
+
+def _service_stats(service):
+    return resilience.stats()['services'][service]
+
+def test_transient_throttling_is_retried(aws):
+    resilience.faults.add('dynamodb', 'GetItem', 'throttle', times=2)
+    resilience.faults.add('s3', 'GetObject', 'unavailable', times=1)
+
+    assert dynamo_utils.get_metadata('test-table', 'u1', 'img_1')['tag'] == 'trip'
+    assert s3_utils.read_object('test-bucket', 'img_1') == b'pixels'
+    assert _service_stats('dynamodb')['retries'] == 2
+    assert _service_stats('s3')['retries'] == 1
+
+def test_persistent_throttling_is_a_503_not_an_empty_gallery(aws):
+    resilience.faults.add('dynamodb', 'Query', 'throttle')
+    response = handlers.list_images_handler({'queryStringParameters': {'user_id': 'u1'}}, None)
+
+    assert response['statusCode'] == 503
+    assert response['headers']['Retry-After'] == '1'
+    assert _service_stats('dynamodb')['retries'] == resilience.MAX_ATTEMPTS - 1
+
+def test_throttled_multi_tag_and_search_reads_are_a_503(aws, monkeypatch):
+    resilience.faults.add('dynamodb', 'BatchGetItem', 'throttle')
+    response = handlers.list_images_handler({'queryStringParameters': {'user_id': 'u1', 'tags': 'trip'}}, None)
+    assert response['statusCode'] == 503 and response['headers']['Retry-After'] == '1'
+
+    monkeypatch.setattr(search_index, 'is_enabled', lambda: True)
+    monkeypatch.setattr(search_index, 'search', lambda user_id, q, limit: [('img_1', 1.0)])
+    response = handlers.search_images_handler({'queryStringParameters': {'user_id': 'u1', 'q': 'trip'}}, None)
+    assert response['statusCode'] == 503 and response['headers']['Retry-After'] == '1'
+
+def test_timeouts_are_retried_then_reported(aws):
+    resilience.faults.add('dynamodb', 'GetItem', 'timeout')
+    with pytest.raises(resilience.BackendUnavailable):
+        dynamo_utils.get_metadata('test-table', 'u1', 'img_1')
+    assert resilience.faults.injected == resilience.MAX_ATTEMPTS
+
+def test_deadline_stops_retries(aws, monkeypatch):
+    monkeypatch.setitem(resilience.DEADLINES, 'dynamodb.GetItem', 0.0)
+    resilience.faults.add('dynamodb', 'GetItem', 'throttle', times=1)
+    with pytest.raises(resilience.BackendUnavailable):
+        dynamo_utils.get_metadata('test-table', 'u1', 'img_1')
+    assert _service_stats('dynamodb')['deadline_exceeded'] == 1
+
+def test_retry_budget_caps_retries(aws, monkeypatch):
+    monkeypatch.setattr(resilience, 'budget', resilience.RetryBudget(ratio=0, min_per_second=0, capacity=1))
+    resilience.faults.add('dynamodb', 'GetItem', 'throttle')
+    for _ in range(3):
+        with pytest.raises(resilience.BackendUnavailable):
+            dynamo_utils.get_metadata('test-table', 'u1', 'img_1')
+    # Only the one budgeted retry happened; every other failure went straight back to the caller
+    assert resilience.faults.injected == 4
+    assert resilience.budget.exhausted == 3
+
+def test_circuit_opens_fails_fast_and_recovers(aws, monkeypatch):
+    monkeypatch.setattr(resilience, 'MAX_ATTEMPTS', 1)
+    resilience.faults.add('dynamodb', 'GetItem', 'unavailable')
+    for _ in range(resilience.BREAKER_MIN_CALLS):
+        with pytest.raises(resilience.BackendUnavailable):
+            dynamo_utils.get_metadata('test-table', 'u1', 'img_1')
+    assert _service_stats('dynamodb')['circuit'] == 'open'
+
+    # Open: callers fail without the request being sent, and the error says so
+    injected = resilience.faults.injected
+    with pytest.raises(resilience.BackendUnavailable) as excinfo:
+        dynamo_utils.get_metadata('test-table', 'u1', 'img_1')
+    assert 'CircuitOpen' in str(excinfo.value)
+    assert resilience.faults.injected == injected
+    assert dynamo_utils.save_metadata('test-table', {'user_id': 'u1', 'image_id': 'img_2'}) is False
+
+    # After the cooldown one probe goes through; its success closes the circuit
+    resilience.faults.clear()
+    resilience.breakers['dynamodb'].cooldown = 0
+    assert dynamo_utils.get_metadata('test-table', 'u1', 'img_1')['tag'] == 'trip'
+    assert _service_stats('dynamodb')['circuit'] == 'closed'
+    assert _service_stats('s3')['circuit'] == 'closed'
+
+def test_hedged_read_answers_from_the_faster_copy(monkeypatch):
+    monkeypatch.setattr(resilience, 'HEDGE_READS', True)
+    calls = []
+    def read(key):
+        calls.append(key)
+        if len(calls) == resilience.HEDGE_MIN_SAMPLES + 1:
+            time.sleep(0.5)  # the straggler
+            return 'slow'
+        return 'fast'
+
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        assert resilience.hedged('test.read', read, 'k') == 'fast'
+    started = time.monotonic()
+    assert resilience.hedged('test.read', read, 'k') == 'fast'
+    assert time.monotonic() - started < 0.4
+    assert resilience.stats()['hedges']['won'] == 1
+
+def test_fault_injection_spec():
+    injector = resilience.FaultInjector('dynamodb.Query=throttle@0.25, s3.*=slow:0.5')
+    assert injector._rules == [['dynamodb', 'Query', 'throttle', 0.25, 0.0, None],
+                               ['s3', '*', 'slow', 1.0, 0.5, None]]
+
+def test_metrics_report_circuit_state():
+    body = json.loads(handlers.metrics_handler({}, None)['body'])
+    assert body['resilience']['services']['dynamodb']['circuit'] == 'closed'
@@ -0,0 +1,141 @@
+import heapq
+import json
+import os
+import random
+import pytest
+from src.app import handlers
+from src.jobs import rebuild_search_index
+from src.utils import local_adapter, search_index
+
+def _item(image_id, description='', filename='', user_id='u1'):
+    return {'user_id': user_id, 'image_id': image_id, 'tag': 'a',
+            'description': description, 'original_filename': filename}
+
+def test_tokenize_splits_filenames():
+    assert search_index.tokenize('IMG_2041-Beach.JPG') == ['img', '2041', 'beach', 'jpg']
+    assert search_index.tokenize('Café à la plage') == ['café', 'la', 'plage']
+
+def test_bm25_ranks_rarer_and_denser_matches_first():
+    index = search_index.UserIndex()
+    index.put('1', search_index.item_terms(_item('1', 'sunset over the beach', 'beach.jpg')))
+    index.put('2', search_index.item_terms(_item('2', 'a long walk on the beach with the dog and friends')))
+    index.put('3', search_index.item_terms(_item('3', 'dog in the park')))
+    
+    assert [i for i, _ in index.search('beach')] == ['1', '2']
+    assert [i for i, _ in index.search('dog beach')][0] == '2'
+    # Prefix completions match, ranked below exact hits
+    assert [i for i, _ in index.search('sun')] == ['1']
+    assert index.search('zebra') == []
+
+    index.delete('1')
+    assert [i for i, _ in index.search('beach')] == ['2']
+    assert 'sunset' not in index.postings and 'sunset' not in index.vocab
+
+def test_only_the_last_word_is_a_prefix_and_ubiquitous_words_are_skipped():
+    index = search_index.UserIndex()
+    for image_id, description in [('1', 'beach sunset'), ('2', 'sunny beach'), ('3', 'sun hat'), ('4', 'hat')]:
+        index.put(image_id, search_index.item_terms(_item(image_id, description, f'IMG_{image_id}.jpg')))
+
+    assert [i for i, _ in index.search('sun hat')] == ['3', '4']
+    assert [i for i, _ in index.search('hat sun')][0] == '3' and len(index.search('hat sun')) == 4
+    # "img" and "jpg" are in every item: dropped next to a real word, the rarest one kept on its own
+    terms = lambda query: [[term for term, _ in word] for word in index.query_terms(query)]
+    assert terms('img beach') == [['beach']] and terms('sunset su') == [['sunset'], ['sun', 'sunny']]
+    assert terms('img jpg') == [['img']] and len(index.search('img jpg')) == 4
+
+def test_early_termination_matches_exhaustive_ranking(monkeypatch):
+    rng = random.Random(3)
+    words = [f'w{n}' for n in range(40)]
+    index = search_index.UserIndex()
+    for n in range(2000):
+        # Low-numbered words are in most items, high-numbered ones in few
+        description = ' '.join(rng.choice(words[:rng.randint(1, 40)]) for _ in range(rng.randint(1, 8)))
+        index.put(f'{n:05d}', search_index.item_terms(_item(f'{n:05d}', description)))
+    avgdl = index.total_len / len(index.docs)
+    scored = []
+
+    class CountingDocs(dict):
+        def __getitem__(self, image_id):
+            scored.append(image_id)
+            return dict.__getitem__(self, image_id)
+
+    index.docs = CountingDocs(index.docs)
+    monkeypatch.setattr(search_index, 'MAX_SCORED', len(index.docs))
+    for query in ('w0', 'w39', 'w1 w7', 'w3 w20 w38', 'w0 w1', 'w7 w2'):
+        words = index.query_terms(query)
+        exhaustive = {}
+        for image_id, doc in dict.items(index.docs):
+            norm = search_index.K1 * (1 - search_index.B + search_index.B * index.doc_len[image_id] / avgdl)
+            # An item counts each query word once, by its best matching term
+            score = sum(max([w * doc[t] * (search_index.K1 + 1) / (doc[t] + norm) for t, w in terms if t in doc] or [0])
+                        for terms in words)
+            if score:
+                exhaustive[image_id] = score
+        del scored[:]
+        hits = index.search(query, limit=10)
+        assert [s for _, s in hits] == pytest.approx(heapq.nlargest(10, exhaustive.values()))
+        assert all(exhaustive[image_id] == pytest.approx(s) for image_id, s in hits)
+        if query in ('w0', 'w1 w7'):
+            assert len(scored) < len(exhaustive) / 4  # stopped once nothing unvisited could make the top 10
+
+    # Past MAX_SCORED the best matches seen so far come back
+    monkeypatch.setattr(search_index, 'MAX_SCORED', 30)
+    del scored[:]
+    hits = index.search('w0 w1', limit=10)
+    assert len(scored) == 30 and len(hits) == 10
+    assert [s for _, s in hits] == sorted((s for _, s in hits), reverse=True)
+
+def test_incremental_updates_visible_to_other_readers(local_store):
+    search_index.index_item(_item('1', 'red car'))
+    search_index.index_item(_item('2', 'blue car'))
+    search_index.index_item(_item('3', 'blue car', user_id='u2'))
+    # Equal scores: newer (larger) image_id first
+    assert [i for i, _ in search_index.search('u1', 'car')] == ['2', '1']
+
+    # A fresh process (empty cache) rebuilds the same state from snapshot + log
+    search_index._cache.clear()
+    search_index.index_item(_item('1', 'red bicycle'))
+    search_index.remove_item('u1', '2')
+    assert search_index.search('u1', 'car') == []
+    assert [i for i, _ in search_index.search('u1', 'bicy')] == ['1']
+    assert [i for i, _ in search_index.search('u2', 'blue')] == ['3']
+
+def test_log_compacts_into_snapshot(local_store, monkeypatch):
+    monkeypatch.setattr(search_index, 'COMPACT_MIN_BYTES', 200)
+    for n in range(50):
+        search_index.index_item(_item(f'{n:03d}', f'photo number{n}'))
+    base_path, log_path = search_index._paths('u1')
+    
+    with open(base_path) as f:
+        assert len(json.load(f)['docs']) > 1
+    assert os.path.getsize(log_path) <= os.path.getsize(base_path)
+    assert len(search_index.search('u1', 'photo', limit=100)) == 50
+    search_index._cache.clear()
+    assert len(search_index.search('u1', 'photo', limit=100)) == 50
+
+def test_search_handler_and_rebuild(local_store):
+    for image_id, desc, name in [('img1', 'Sunset at the beach', 'IMG_1.jpg'),
+                                 ('img2', 'Mountain hike', 'hike-alps.png'),
+                                 ('img3', 'Beach volleyball', 'IMG_3.jpg')]:
+        body = {'user_id': 'u1', 'image_id': image_id, 'tag': 'a', 'description': desc}
+        assert handlers.save_metadata_handler({'body': json.dumps(body)}, None)['statusCode'] == 201
+    local_adapter.save_metadata(dict(_item('img4', 'beach house'), original_filename='beach.jpg'))
+
+    event = {'queryStringParameters': {'user_id': 'u1', 'q': 'beach', 'fields': 'description'}}
+    response = handlers.search_images_handler(event, None)
+    images = json.loads(response['body'])['images']
+    assert response['statusCode'] == 200
+    assert sorted(i['description'] for i in images) == ['Beach volleyball', 'Sunset at the beach']
+    assert all(set(i) == {'description', 'score'} for i in images)
+
+    # img4 bypassed the handlers; a rebuild picks it up from metadata
+    assert rebuild_search_index.rebuild('test-table') == {'u1': 4}
+    response = handlers.search_images_handler(event, None)
+    assert len(json.loads(response['body'])['images']) == 3
+
+    handlers.delete_image_handler({'queryStringParameters': {'id': 'img3', 'user_id': 'u1'}}, None)
+    response = handlers.search_images_handler(event, None)
+    assert 'Beach volleyball' not in response['body']
+
+    missing = handlers.search_images_handler({'queryStringParameters': {'user_id': 'u1'}}, None)
+    assert missing['statusCode'] == 400
@@ -0,0 +1,100 @@
+import io
+import json
+import random
+import boto3
+import pytest
+from moto import mock_dynamodb
+from src.app import handlers
+from src.jobs import backfill_phash
+from src.utils import dynamo_utils, local_adapter, similarity
+
+@pytest.fixture
+def local_store(local_store, monkeypatch):
+    monkeypatch.setattr(similarity, '_trees', similarity.OrderedDict())
+    yield local_store
+
+def _jpeg(seed, size=(320, 240), quality=90):
+    Image = pytest.importorskip('PIL.Image')
+    rng = random.Random(seed)
+    img = Image.new('RGB', (16, 12))
+    img.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+    buf = io.BytesIO()
+    img.resize(size, Image.BILINEAR).save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+def test_bk_tree_matches_brute_force():
+    rng = random.Random(3)
+    hashes = [rng.getrandbits(64) for _ in range(2000)]
+    # A cluster of near-duplicates around the first hash
+    hashes += [hashes[0] ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for _ in range(20)]
+    tree = similarity.BKTree()
+    for i, h in enumerate(hashes):
+        tree.add(h, i)
+
+    for probe in (hashes[0], hashes[7], rng.getrandbits(64)):
+        for radius in (0, 4, 12):
+            expected = sorted((similarity.hamming(probe, h), i) for i, h in enumerate(hashes)
+                              if similarity.hamming(probe, h) <= radius)
+            assert sorted(tree.search(probe, radius)) == expected
+
+def test_dhash_survives_resize_and_recompression():
+    original = similarity.dhash(_jpeg(1))
+    resized = similarity.dhash(_jpeg(1, size=(160, 120), quality=60))
+    other = similarity.dhash(_jpeg(2))
+    assert len(original) == 16
+    assert similarity.hamming(int(original, 16), int(resized, 16)) <= 6
+    assert similarity.hamming(int(original, 16), int(other, 16)) > 16
+    assert similarity.dhash(b'not an image') is None
+
+def _upload(image_id, data, user_id='u1'):
+    local_adapter.save_file_content(image_id, data)
+    local_adapter.save_metadata({'user_id': user_id, 'image_id': image_id, 'tag': 'a', 's3_key': image_id})
+
+def test_backfill_and_similar_endpoint(local_store):
+    _upload('a.jpg', _jpeg(1))
+    _upload('a-small.jpg', _jpeg(1, size=(160, 120), quality=60))
+    _upload('b.jpg', _jpeg(2))
+    _upload('c.jpg', _jpeg(1), user_id='u2')
+    local_adapter.save_metadata({'user_id': 'u1', 'image_id': 'gone.jpg', 'tag': 'a'})
+
+    assert backfill_phash.backfill('test-table', 'test-bucket', workers=2, batch_size=2) == (5, 4, 1)
+    assert backfill_phash.backfill('test-table', 'test-bucket', workers=0) == (1, 0, 1)
+    assert local_adapter.get_metadata('u1', 'a.jpg')['tag'] == 'a'
+
+    event = {'queryStringParameters': {'id': 'a.jpg', 'user_id': 'u1', 'fields': 'image_id'}}
+    response = handlers.similar_images_handler(event, None)
+    body = json.loads(response['body'])
+    assert response['statusCode'] == 200
+    # Only the same user's near-duplicate, not the unrelated image or the other tenant's copy
+    assert [i['image_id'] for i in body['images']] == ['a-small.jpg']
+    assert set(body['images'][0]) == {'image_id', 'distance'}
+
+    # Uploaded after the backfill: hashed on demand and added to the cached tree
+    _upload('a-copy.jpg', _jpeg(1, quality=75))
+    event = {'queryStringParameters': {'id': 'a-copy.jpg', 'user_id': 'u1'}}
+    body = json.loads(handlers.similar_images_handler(event, None)['body'])
+    assert [i['image_id'] for i in body['images']][:2] in (['a.jpg', 'a-small.jpg'], ['a-small.jpg', 'a.jpg'])
+    body = json.loads(handlers.similar_images_handler(
+        {'queryStringParameters': {'id': 'a.jpg', 'user_id': 'u1'}}, None)['body'])
+    assert 'a-copy.jpg' in [i['image_id'] for i in body['images']]
+
+    missing = handlers.similar_images_handler({'queryStringParameters': {'id': 'nope', 'user_id': 'u1'}}, None)
+    assert missing['statusCode'] == 404
+
+def test_update_attributes_does_not_create_items():
+    with mock_dynamodb():
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                       {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'},
+                                  {'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        table.put_item(Item={'user_id': 'u1', 'image_id': 'i1', 'tag': 'a'})
+
+        assert dynamo_utils.update_attributes('test-table', 'u1', 'i1', {'phash': 'ff00'}) is True
+        assert dynamo_utils.update_attributes('test-table', 'u1', 'deleted', {'phash': 'ff00'}) is False
+        assert table.get_item(Key={'user_id': 'u1', 'image_id': 'i1'})['Item'] == \
+            {'user_id': 'u1', 'image_id': 'i1', 'tag': 'a', 'phash': 'ff00'}
+        assert 'Item' not in table.get_item(Key={'user_id': 'u1', 'image_id': 'deleted'})
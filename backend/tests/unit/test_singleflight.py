@@ -0,0 +1,174 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from src.app import handlers
+from src.utils import dynamo_utils, singleflight
+
+def _slow(result, calls, delay=0.2):
+    def fn():
+        calls.append(1)
+        time.sleep(delay)
+        return result
+    return fn
+
+def _run_threads(n, target):
+    results = [None] * n
+    def worker(i):
+        results[i] = target()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_concurrent_identical_calls_share_one_execution():
+    group = singleflight.Group('test')
+    calls = []
+    fn = _slow(['item'], calls)
+    results = _run_threads(20, lambda: group.do('k', fn))
+    
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    stats = group.stats()
+    assert (stats['calls'], stats['executions'], stats['shared'], stats['in_flight']) == (20, 1, 19, 0)
+    assert stats['coalescing_ratio'] == 0.95
+
+    # Once the call finished, the next one runs again
+    group.do('k', fn)
+    assert len(calls) == 2
+
+def test_different_keys_do_not_coalesce_and_errors_are_shared():
+    group = singleflight.Group('test')
+    calls = []
+    _run_threads(4, lambda: group.do(threading.get_ident(), _slow(1, calls, 0.05)))
+    assert len(calls) == 4
+
+    def boom():
+        time.sleep(0.1)
+        raise RuntimeError('backend down')
+    errors = []
+    def call():
+        try:
+            group.do('e', boom)
+        except RuntimeError as e:
+            errors.append(e)
+    _run_threads(5, call)
+    assert len(errors) == 5
+    assert group.stats()['errors'] == 1
+
+def test_followers_stop_waiting_on_a_stuck_leader():
+    group = singleflight.Group('test', wait_seconds=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: group.do('k', release.wait))
+    leader.start()
+    time.sleep(0.02)
+    
+    start = time.monotonic()
+    assert group.do('k', lambda: 'fallback') == 'fallback'
+    assert time.monotonic() - start < 1
+    assert group.stats()['timeouts'] == 1
+    release.set()
+    leader.join()
+
+def test_async_tasks_coalesce_with_each_other():
+    group = singleflight.Group('test')
+    calls = []
+    fn = _slow('result', calls, 0.1)
+
+    async def main():
+        return await asyncio.gather(*(group.do_async('k', fn) for _ in range(50)))
+    results = asyncio.run(main())
+    
+    assert results == ['result'] * 50
+    assert len(calls) == 1
+    assert group.stats()['calls'] == 50 and group.stats()['shared'] == 49
+
+def test_query_images_and_usage_are_coalesced(monkeypatch):
+    group = singleflight.Group('query_images')
+    monkeypatch.setitem(singleflight._groups, 'query_images', group)
+    calls = []
+    def fake_query(table_name, user_id=None, tag=None, start_date=None, end_date=None, fields=None):
+        calls.append((user_id, tag, fields))
+        time.sleep(0.2)
+        return [{'file_size': 10}, {'file_size': 5}]
+    monkeypatch.setattr(dynamo_utils, '_query_images', fake_query)
+
+    event = {'queryStringParameters': {'user_id': 'u1'}}
+    responses = _run_threads(10, lambda: handlers.get_storage_usage_handler(event, None))
+    assert [json.loads(r['body'])['total_bytes'] for r in responses] == [15] * 10
+    assert calls == [('u1', None, ['file_size'])]
+
+    metrics = json.loads(handlers.metrics_handler({}, None)['body'])
+    assert metrics['singleflight']['query_images']['shared'] == 9
+
+def test_query_images_after_own_write_does_not_join_an_older_query(monkeypatch):
+    group = singleflight.Group('query_images')
+    monkeypatch.setitem(singleflight._groups, 'query_images', group)
+    monkeypatch.setenv('USE_LOCAL_STORAGE', 'true')
+    rows = []
+    started, release = threading.Event(), threading.Event()
+    class Backend:
+        save_metadata = staticmethod(lambda item: rows.append(item) or True)
+        delete_metadata = staticmethod(lambda user_id, image_id: rows.clear() or True)
+    monkeypatch.setattr(dynamo_utils, '_local_backend', lambda: Backend)
+    def fake_query(table_name, user_id=None, *args):
+        snapshot = list(rows)
+        if not started.is_set():
+            started.set()
+            release.wait()
+        return snapshot
+    monkeypatch.setattr(dynamo_utils, '_query_images', fake_query)
+
+    results = {}
+    reader = threading.Thread(target=lambda: results.setdefault('old', dynamo_utils.query_images('t', 'u1')))
+    reader.start()
+    started.wait()
+    # The in-flight query read before this save; a read after it starts its own query
+    dynamo_utils.save_metadata('t', {'user_id': 'u1', 'image_id': 'img_1'})
+    assert dynamo_utils.query_images('t', 'u1') == [{'user_id': 'u1', 'image_id': 'img_1'}]
+    release.set()
+    reader.join()
+    assert results['old'] == []
+
+    # A delete does the same, and nothing is kept per user once the queries are done
+    dynamo_utils.delete_metadata_item('t', 'u1', 'img_1')
+    assert dynamo_utils.query_images('t', 'u1') == []
+    assert group.stats()['executions'] == 3 and group.stats()['in_flight'] == 0
+
+def test_forget_starts_a_new_call_and_leaves_its_replacement_in_place():
+    group = singleflight.Group('test')
+    started, release = threading.Event(), threading.Event()
+    def first():
+        started.set()
+        release.wait()
+        return 'old'
+    leader = threading.Thread(target=lambda: group.do(('u1', 'x'), first))
+    leader.start()
+    started.wait()
+
+    group.forget(lambda key: key[0] == 'u2')
+    assert group.stats()['in_flight'] == 1
+    group.forget(lambda key: key[0] == 'u1')
+    second_started, second_release = threading.Event(), threading.Event()
+    def second():
+        second_started.set()
+        second_release.wait()
+        return 'new'
+    results = {}
+    follower = threading.Thread(target=lambda: results.setdefault('new', group.do(('u1', 'x'), second)))
+    follower.start()
+    second_started.wait()
+    release.set()
+    leader.join()
+    # The forgotten leader finishing must not drop the call that replaced it
+    assert group.stats()['in_flight'] == 1
+    joiner = threading.Thread(target=lambda: results.setdefault('joined', group.do(('u1', 'x'), lambda: 'own')))
+    joiner.start()
+    time.sleep(0.05)
+    second_release.set()
+    follower.join()
+    joiner.join()
+    assert results == {'new': 'new', 'joined': 'new'}
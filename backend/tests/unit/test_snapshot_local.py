@@ -0,0 +1,128 @@
+import json
+import os
+import sqlite3
+import time
+import pytest
+from src.jobs import snapshot_local, tier_objects
+from src.utils import local_adapter, local_sqlite, tiering
+
+def _item(image_id, user_id='u1'):
+    return {'user_id': user_id, 'image_id': image_id, 'file_size': 3, 'upload_date': '2026-10-19T10:00:00'}
+
+def _files(root):
+    return {os.path.relpath(os.path.join(d, name), root): open(os.path.join(d, name), 'rb').read()
+            for d, _, names in os.walk(root) for name in names if not name.endswith('.lock')}
+
+def test_incremental_snapshots_copy_only_new_content(local_store, tmp_path):
+    repo = str(tmp_path / 'repo')
+    for n in range(5):
+        local_adapter.save_file_content(f'img_{n}.jpg', b'%d' % n * 1000)
+    local_adapter.save_file_content('copy.jpg', b'0' * 1000)  # same bytes as img_0: one blob
+    local_adapter.save_metadata(_item('img_0'))
+
+    first = snapshot_local.create_snapshot(repo, workers=4)
+    assert first['stats']['objects'] == 6 and first['stats']['hashed'] == 6
+    assert first['parent'] is None and [m['path'] for m in first['metadata']] == ['metadata.json']
+    blobs = list(local_adapter.iter_object_files(os.path.join(repo, 'blobs')))
+    assert len(blobs) == 6  # 5 distinct objects + metadata.json
+    assert not [name for name in os.listdir(local_store) if name.startswith('.snapshot-')]
+
+    # Unchanged files are not read again; only the new object and the rewritten metadata are copied
+    local_adapter.save_file_content('img_5.jpg', b'5' * 1000)
+    local_adapter.save_metadata(_item('img_5'))
+    second = snapshot_local.create_snapshot(repo)
+    stats = second['stats']
+    assert (stats['reused'], stats['hashed'], stats['objects']) == (6, 1, 7)
+    assert 1000 < stats['bytes_copied'] < 2000 and second['parent'] == first['id']
+    assert snapshot_local.list_snapshots(repo) == [first['id'], second['id']]
+
+def test_restore_is_point_in_time_and_skips_unchanged_files(local_store, tmp_path):
+    repo = str(tmp_path / 'repo')
+    for n in range(3):
+        local_adapter.save_file_content(f'img_{n}.jpg', b'%d' % n * 100)
+        local_adapter.save_metadata(_item(f'img_{n}'))
+    snapshot = snapshot_local.create_snapshot(repo)
+    expected = _files(local_store)
+
+    # A fresh directory gets an identical tree, mtimes included
+    target = tmp_path / 'restored'
+    stats = snapshot_local.restore_snapshot(repo, 'latest', str(target), workers=4)
+    assert stats['copied'] == 3 and _files(target) == expected
+    assert os.stat(target / 'images' / 'img_1.jpg').st_mtime_ns == os.stat(local_store / 'images' / 'img_1.jpg').st_mtime_ns
+
+    # Later changes are undone in place; files that still match are not copied
+    local_adapter.save_file_content('img_1.jpg', b'changed')
+    local_adapter.save_file_content('img_9.jpg', b'new')
+    local_adapter.delete_metadata('u1', 'img_2')
+    stats = snapshot_local.restore_snapshot(repo, snapshot['id'])
+    assert (stats['copied'], stats['removed']) == (1, 1)
+    assert _files(local_store) == expected
+    local_adapter._index_cache.clear()
+    assert local_adapter.get_metadata('u1', 'img_2')['file_size'] == 3
+
+def test_sharded_and_sqlite_metadata_are_checkpointed(local_store, tmp_path, monkeypatch):
+    repo = str(tmp_path / 'repo')
+    monkeypatch.setattr(local_adapter, 'DB_SHARDS', 4)
+    for n in range(8):
+        local_adapter.save_metadata(_item(f'img_{n}', user_id=f'user_{n}'))
+    db = sqlite3.connect(local_sqlite.DB_FILE)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('CREATE TABLE t (x)')
+    db.execute("INSERT INTO t VALUES ('committed')")
+    db.commit()  # kept open: the row lives in the WAL, which a file copy would miss
+
+    snapshot = snapshot_local.create_snapshot(repo)
+    paths = [m['path'] for m in snapshot['metadata']]
+    assert paths[-1] == 'metadata.db' and len(paths) == 5
+    assert all(p.startswith(os.path.join('metadata', 'shard-')) for p in paths[:-1])
+
+    target = tmp_path / 'restored'
+    os.makedirs(target)
+    (target / 'metadata.db-wal').write_bytes(b'stale')
+    (target / 'metadata.json').write_text('{}')  # another layout's file: not part of the snapshot
+    snapshot_local.restore_snapshot(repo, target=str(target))
+    assert not os.path.exists(target / 'metadata.db-wal') and not os.path.exists(target / 'metadata.json')
+    assert sqlite3.connect(str(target / 'metadata.db')).execute('SELECT x FROM t').fetchall() == [('committed',)]
+    restored = [json.load(open(target / p)) for p in paths[:-1]]
+    assert sum(len(shard) for shard in restored) > 0
+    db.close()
+
+def test_prune_keeps_blobs_still_referenced(local_store, tmp_path, capsys):
+    repo = str(tmp_path / 'repo')
+    local_adapter.save_file_content('keep.jpg', b'k' * 10)
+    local_adapter.save_file_content('gone.jpg', b'g' * 10)
+    snapshot_local.main(['--repo', repo, 'create'])
+    os.remove(local_store / 'images' / 'gone.jpg')
+    snapshot_local.main(['--repo', repo, 'create'])
+    assert 'Snapshot ' in capsys.readouterr().out
+
+    snapshot_local.main(['--repo', repo, 'prune', '--keep', '1'])
+    assert capsys.readouterr().out.strip() == 'Removed 1 snapshots and 1 unreferenced blobs'
+    [remaining] = snapshot_local.list_snapshots(repo)
+    target = tmp_path / 'restored'
+    snapshot_local.main(['--repo', repo, 'restore', remaining, '--target', str(target)])
+    assert os.listdir(target / 'images') == ['keep.jpg']
+
+def test_restored_store_keeps_its_tiering_decisions(local_store, tmp_path, monkeypatch):
+    repo = str(tmp_path / 'repo')
+    month_ago = time.time() - 30 * 86400
+    for name in ('idle.jpg', 'popular.jpg', 'fresh.jpg'):
+        local_adapter.save_file_content(name, b'x' * 100)
+    for name in ('idle.jpg', 'popular.jpg'):
+        os.utime(local_store / 'images' / name, (month_ago, month_ago))
+    tiering.record_access(None, 'popular.jpg')  # uploaded a month ago, downloaded today
+    snapshot_local.create_snapshot(repo)
+
+    target = tmp_path / 'restored'
+    snapshot_local.restore_snapshot(repo, target=str(target))
+    st = os.stat(target / 'images' / 'popular.jpg')
+    assert st.st_mtime == pytest.approx(month_ago) and st.st_atime > time.time() - 60
+
+    # Tier the restored store: only the object idle since its upload a month ago is archived
+    monkeypatch.setattr(local_adapter, 'STORAGE_DIR', str(target))
+    monkeypatch.setattr(local_adapter, 'IMAGES_DIR', str(target / 'images'))
+    monkeypatch.setattr(local_adapter, 'ARCHIVE_DIR', str(target / 'archive'))
+    monkeypatch.setattr(local_adapter, 'ACCESS_DIR', str(target / 'access'))
+    stats = tier_objects.run_local(cold_after_days=7)
+    assert stats.moved == 1 and os.listdir(target / 'archive') == ['idle.jpg.gz']
+    assert sorted(os.listdir(target / 'images')) == ['fresh.jpg', 'popular.jpg']
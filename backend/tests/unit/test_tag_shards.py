@@ -0,0 +1,94 @@
+import boto3
+import json
+import pytest
+from moto import mock_dynamodb
+from src.app import handlers
+from src.utils import dynamo_utils
+from src.jobs import shard_tag_index
+
+@pytest.fixture
+def dynamo_setup(monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    with mock_dynamodb():
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table = dynamodb.create_table(
+            TableName='test-table',
+            KeySchema=[
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'image_id', 'KeyType': 'RANGE'}
+            ],
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'image_id', 'AttributeType': 'S'},
+                {'AttributeName': 'tag_shard', 'AttributeType': 'S'}
+            ],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5},
+            GlobalSecondaryIndexes=[{
+                'IndexName': 'tag-shard-index',
+                'KeySchema': [
+                    {'AttributeName': 'tag_shard', 'KeyType': 'HASH'},
+                    {'AttributeName': 'image_id', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+            }]
+        )
+        yield table
+
+def test_sharded_tag_query_merges_by_image_id(dynamo_setup, monkeypatch):
+    monkeypatch.setattr(dynamo_utils, 'TAG_INDEX_SHARDS', 4)
+    for i in range(20):
+        dynamo_utils.save_metadata('test-table', {'user_id': f'u{i % 3}', 'image_id': f'2023-01-{i:02d}', 'tag': 'uncategorized'})
+    
+    shards = {item['tag_shard'] for item in dynamo_setup.scan()['Items']}
+    assert len(shards) > 1
+    
+    event = {'queryStringParameters': {'tag': 'uncategorized', 'start_date': '2023-01-05', 'end_date': '2023-01-14',
+                                       'fields': 'user_id'}}
+    response = handlers.list_images_handler(event, None)
+    images = json.loads(response['body'])['images']
+    assert len(images) == 10
+    assert set(images[0].keys()) == {'user_id'}
+    
+    images = dynamo_utils.query_images('test-table', tag='uncategorized')
+    assert [i['image_id'] for i in images] == [f'2023-01-{i:02d}' for i in range(20)]
+
+    # Streamed: the same merge, done lazily a page at a time
+    pages = list(dynamo_utils.iter_image_pages('test-table', tag='uncategorized', fields=['user_id'], page_size=6))
+    assert [len(page) for page in pages] == [6, 6, 6, 2]
+    assert [i['user_id'] for page in pages for i in page] == [f'u{i % 3}' for i in range(20)]
+
+def test_backfill_existing_items(dynamo_setup, monkeypatch):
+    for i in range(10):
+        dynamo_setup.put_item(Item={'user_id': 'u1', 'image_id': f'img{i}', 'tag': 'legacy'})
+    
+    assert shard_tag_index.backfill('test-table', 4) == (10, 10, 0)
+    assert shard_tag_index.backfill('test-table', 4) == (10, 0, 0)
+    
+    monkeypatch.setattr(dynamo_utils, 'TAG_INDEX_SHARDS', 4)
+    assert len(dynamo_utils.query_images('test-table', tag='legacy')) == 10
+
+def test_migration_drops_the_unsharded_tag_index(dynamo_setup, monkeypatch, capsys):
+    client = dynamo_setup.meta.client
+    client.update_table(
+        TableName='test-table',
+        AttributeDefinitions=[{'AttributeName': 'tag', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': 'tag-index',
+            'KeySchema': [{'AttributeName': 'tag', 'KeyType': 'HASH'}, {'AttributeName': 'image_id', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': {'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}}}]
+    )
+    for i in range(6):
+        dynamo_setup.put_item(Item={'user_id': 'u1', 'image_id': f'img{i}', 'tag': 'uncategorized'})
+
+    shard_tag_index.main(['--table', 'test-table', '--shards', '4', '--drop-tag-index'])
+    assert 'Deleting tag-index' in capsys.readouterr().out
+    indexes = [index['IndexName'] for index in client.describe_table(TableName='test-table')['Table']['GlobalSecondaryIndexes']]
+    assert indexes == ['tag-shard-index']
+
+    # New writes only update the sharded index, and tag queries keep working
+    monkeypatch.setattr(dynamo_utils, 'TAG_INDEX_SHARDS', 4)
+    dynamo_utils.save_metadata('test-table', {'user_id': 'u2', 'image_id': 'img9', 'tag': 'uncategorized'})
+    assert len(dynamo_utils.query_images('test-table', tag='uncategorized')) == 7
+    assert shard_tag_index.drop_tag_index('test-table') is False
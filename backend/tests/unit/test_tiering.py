@@ -0,0 +1,81 @@
+import boto3
+import json
+import os
+import time
+import pytest
+from moto import mock_s3
+from src.app import handlers
+from src.utils import local_adapter, tiering
+from src.jobs import tier_objects
+
+@pytest.fixture
+def s3_setup(monkeypatch):
+    with mock_s3():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket='test-bucket')
+        yield s3
+
+def test_local_cold_objects_are_archived_and_rehydrated(local_store):
+    local_adapter.save_file_content('old.jpg', b'x' * 4096)
+    local_adapter.save_file_content('new.jpg', b'y' * 100)
+    week_ago = time.time() - 7 * 86400
+    os.utime(local_store / 'images' / 'old.jpg', (week_ago, week_ago))
+    
+    stats = tier_objects.run_local(cold_after_days=1)
+    assert stats.moved == 1
+    assert stats.tiers['hot'] == {'objects': 1, 'bytes': 100}
+    assert stats.tiers['cold']['objects'] == 1
+    assert not os.path.exists(local_store / 'images' / 'old.jpg')
+    
+    # Requesting the download rehydrates the file and records the access
+    event = {'queryStringParameters': {'id': 'old.jpg'}}
+    response = handlers.generate_download_url_handler(event, None)
+    assert response['statusCode'] == 200
+    with open(local_adapter.get_file_content('old.jpg'), 'rb') as f:
+        assert f.read() == b'x' * 4096
+    assert local_adapter.last_access('old.jpg') > week_ago
+    assert not os.listdir(local_store / 'archive')
+
+def test_local_tiering_uses_recorded_downloads_not_atime(local_store):
+    week_ago = time.time() - 7 * 86400
+    for name in ('read_by_jobs.jpg', 'downloaded.jpg'):
+        local_adapter.save_file_content(name, b'x' * 100)
+        os.utime(local_store / 'images' / name, (week_ago, week_ago))
+    # A background job reading the bytes refreshes atime; that is not a download
+    os.utime(local_store / 'images' / 'read_by_jobs.jpg', (time.time(), week_ago))
+    assert tiering.record_access(None, 'downloaded.jpg')
+    assert not tiering.record_access(None, 'downloaded.jpg')  # at most one marker write per hour
+
+    stats = tier_objects.run_local(cold_after_days=1)
+    assert stats.moved == 1 and os.path.exists(local_store / 'archive' / 'read_by_jobs.jpg.gz')
+    assert os.path.exists(local_store / 'images' / 'downloaded.jpg')
+
+    # Deleting an object drops its marker too
+    local_adapter.delete_file('downloaded.jpg')
+    assert local_adapter.last_access('downloaded.jpg') is None and not tiering.record_access(None, 'downloaded.jpg')
+
+def test_s3_idle_objects_move_to_cold_class(s3_setup, monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    s3_setup.put_object(Bucket='test-bucket', Key='a.jpg', Body=b'a' * 10)
+    s3_setup.put_object(Bucket='test-bucket', Key='b.jpg', Body=b'b' * 20)
+    
+    # cold_after_days=-1 puts the cutoff in the future, so both objects count as idle
+    stats = tier_objects.run_s3('test-bucket', cold_after_days=-1)
+    assert stats.moved == 2
+    assert stats.tiers == {'STANDARD_IA': {'objects': 2, 'bytes': 30}}
+    assert s3_setup.head_object(Bucket='test-bucket', Key='a.jpg')['StorageClass'] == 'STANDARD_IA'
+    
+    report = tier_objects.run_s3('test-bucket', cold_after_days=30, report_only=True)
+    assert report.tiers['STANDARD_IA']['bytes'] == 30
+
+def test_download_of_archived_object_starts_restore(s3_setup, monkeypatch):
+    monkeypatch.delenv('USE_LOCAL_STORAGE', raising=False)
+    monkeypatch.setattr(tiering, 'COLD_STORAGE_CLASS', 'GLACIER')
+    s3_setup.put_object(Bucket='test-bucket', Key='frozen.jpg', Body=b'data', StorageClass='GLACIER')
+    
+    event = {'queryStringParameters': {'id': 'frozen.jpg'}}
+    response = handlers.generate_download_url_handler(event, None)
+    
+    assert response['statusCode'] == 202
+    assert json.loads(response['body'])['status'] == 'restoring'
+    assert 'Restore' in s3_setup.head_object(Bucket='test-bucket', Key='frozen.jpg')
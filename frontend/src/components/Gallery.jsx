@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import { Trash2, Upload, Grid as GridIcon, List as ListIcon, Filter, X, Search, Download, Check, RotateCcw, Cloud, Edit, Link as LinkIcon, Share2 } from 'lucide-react';
 import axios from 'axios';
@@ -75,9 +75,40 @@ export default function Gallery({ refreshTrigger }) {
         }
     };
 
+    // True while the change feed is connected: its deltas keep `images` current
+    const liveRef = useRef(false);
+
     useEffect(() => {
         fetchImages();
-    }, [refreshTrigger, currentUser]);
+    }, [currentUser]);
+
+    // After an upload, the feed's "add" deltas already brought the new images in;
+    // re-fetch the whole listing only when live updates are not connected
+    useEffect(() => {
+        if (refreshTrigger && !liveRef.current) fetchImages();
+    }, [refreshTrigger]);
+
+    // Live updates: apply add/remove deltas from the change feed instead of re-fetching.
+    // EventSource reconnects on its own and resumes with Last-Event-ID; "reset" means deltas were lost.
+    useEffect(() => {
+        if (!currentUser || typeof EventSource === 'undefined') return;
+        const source = new EventSource(`${API_URL}/images/changes?user_id=${encodeURIComponent(currentUser)}`);
+        source.onopen = () => { liveRef.current = true; };
+        source.onerror = () => { liveRef.current = false; };
+        source.addEventListener('add', (e) => {
+            const { item } = JSON.parse(e.data);
+            setImages(prev => [...prev.filter(img => img.image_id !== item.image_id), { id: item.image_id, ...item }]);
+        });
+        source.addEventListener('remove', (e) => {
+            const { image_id } = JSON.parse(e.data);
+            setImages(prev => prev.filter(img => img.image_id !== image_id));
+        });
+        source.addEventListener('reset', () => fetchImages());
+        return () => {
+            liveRef.current = false;
+            source.close();
+        };
+    }, [currentUser]);
 
     const toggleSelection = (id) => {
         setSelectedImages(prev => {
@@ -259,6 +290,7 @@ export default function Gallery({ refreshTrigger }) {
 
     const GalleryImageCard = ({ item, onDelete, onDownload, onSelect, isSelected }) => {
         const [src, setSrc] = useState(null);
+        const [attempt, setAttempt] = useState(0);
         const [showActions, setShowActions] = useState(false);
         const [activeFilter, setActiveFilter] = useState('');
         const [showFilterMenu, setShowFilterMenu] = useState(false);
@@ -273,7 +305,12 @@ export default function Gallery({ refreshTrigger }) {
                 }
             };
             getUrl();
-        }, [item]);
+        }, [item, attempt]);
+
+        // An "add" can arrive before the upload itself has finished: retry the image a few times
+        const handleImageError = () => {
+            if (attempt < 3) setTimeout(() => setAttempt(a => a + 1), 1000 * (attempt + 1));
+        };
 
         const handleCardClick = (e) => {
             if (e.ctrlKey || e.metaKey) {
@@ -309,7 +346,9 @@ export default function Gallery({ refreshTrigger }) {
                     {/* Image Area */}
                     <div className={`relative h-[calc(100%-2rem)] p-2 ${selectedImages.has(item.image_id) ? 'bg-blue-500/20' : ''}`}>
                         <img
+                            key={attempt}
                             onClick={handleCardClick}
+                            onError={handleImageError}
                             src={src}
                             className={`w-full h-full object-cover rounded-lg transition-all duration-300 cursor-pointer ${activeFilter} ${selectedImages.has(item.image_id) ? 'ring-4 ring-blue-500 scale-95' : ''}`}
                             alt=""
@@ -54,8 +54,9 @@ export default function Dashboard() {
     const navigate = useNavigate();
 
     const handleUploadComplete = () => {
-        console.log("Upload completed, refreshing gallery...");
+        console.log("Upload completed");
         setShowConfetti(true);
+        // The gallery re-fetches on this only when its live updates are disconnected
         setRefreshGallery(prev => prev + 1);
     };
 
@@ -9,6 +9,7 @@ awslocal dynamodb create-table \
         AttributeName=user_id,AttributeType=S \
         AttributeName=image_id,AttributeType=S \
         AttributeName=tag,AttributeType=S \
+        AttributeName=tag_shard,AttributeType=S \
     --key-schema \
         AttributeName=user_id,KeyType=HASH \
         AttributeName=image_id,KeyType=RANGE \
@@ -18,8 +19,31 @@ awslocal dynamodb create-table \
                 \"IndexName\": \"tag-index\",
                 \"KeySchema\": [{\"AttributeName\": \"tag\",\"KeyType\": \"HASH\"}, {\"AttributeName\": \"image_id\",\"KeyType\": \"RANGE\"}],
                 \"Projection\": {\"ProjectionType\": \"ALL\"}
+            },
+            {
+                \"IndexName\": \"tag-shard-index\",
+                \"KeySchema\": [{\"AttributeName\": \"tag_shard\",\"KeyType\": \"HASH\"}, {\"AttributeName\": \"image_id\",\"KeyType\": \"RANGE\"}],
+                \"Projection\": {\"ProjectionType\": \"ALL\"}
             }
         ]" \
     --provisioned-throughput ReadCapacityUnits=5,WriteCapacityUnits=5
 
+# Last-download times for hot/cold tiering (ACCESS_TABLE_NAME)
+awslocal dynamodb create-table \
+    --table-name ImageAccess \
+    --attribute-definitions AttributeName=s3_key,AttributeType=S \
+    --key-schema AttributeName=s3_key,KeyType=HASH \
+    --billing-mode PAY_PER_REQUEST
+
+# Per-user tag posting lists for multi-tag queries (TAG_MEMBERSHIP_TABLE)
+awslocal dynamodb create-table \
+    --table-name ImageTagMembership \
+    --attribute-definitions \
+        AttributeName=user_tag,AttributeType=S \
+        AttributeName=image_id,AttributeType=S \
+    --key-schema \
+        AttributeName=user_tag,KeyType=HASH \
+        AttributeName=image_id,KeyType=RANGE \
+    --billing-mode PAY_PER_REQUEST
+
 echo "Resources created."